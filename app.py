@@ -1,40 +1,169 @@
-from flask import Flask, jsonify, request
-from db_logic.neo4j_logic import Api
+import os
+import time
+import orjson
+from flask import Flask, Response, g, jsonify, request
+from db_logic.neo4j_logic import Api, TOP_NODES_ORDER, PATHS_FROM_SOURCE_ORDER, get_next_cursor
+from db_logic.driver import get_pool_stats
+from db_logic.metrics import metrics
 from processing_and_loading.run_data_processing import DataProcessor
 
 
 
 app = Flask(__name__)
+# Uses the driver shared by every request of the process. With GRAPH_ENGINE=embedded paths are found in-process
+use_engine = os.environ.get('GRAPH_ENGINE') == 'embedded'
+api = Api(use_engine=use_engine)
+
+# The data is processed and loaded in a background thread, so the app answers (and reports the progress) right away.
+# With INGEST_ON_STARTUP=0 it must be loaded before with python -m processing_and_loading.run_data_processing
+ingest_on_startup = os.environ.get('INGEST_ON_STARTUP', '1') == '1'
+# The similar jobs endpoint needs the neighbour index, built with SIMILAR_JOBS_K neighbours per job (0 doesn't build it)
+processor = DataProcessor(build_engine=use_engine, top_k=int(os.environ.get('SIMILAR_JOBS_K', 0)))
+
+@app.before_request
+def start_timer():
+    g.start_time = time.perf_counter()
+
+@app.after_request
+def record_latency(response):
+    # Streamed responses are measured until their first byte, their encoding is in serialization_seconds
+    endpoint = request.url_rule.rule if request.url_rule is not None else 'unknown'
+    metrics.observe('http_request_duration_seconds', time.perf_counter() - g.start_time, endpoint=endpoint, status=response.status_code)
+    return response
+
+# Encodes a response as JSON with orjson (several times faster than jsonify for big lists), timed apart from the query
+def json_response(data, headers=None):
+    with metrics.timer('serialization_seconds', endpoint=request.path):
+        body = orjson.dumps(data, option=orjson.OPT_SERIALIZE_NUMPY)
+    return Response(body, mimetype='application/json', headers=headers)
+
+# Streams one JSON line per item while they are produced, timing the encoding of all the lines. With the sort keys
+# of a page, a last line {"nextCursor": ...} is added when the page is full, as the cursor is only known at the end
+def ndjson_response(items, size=None, cursor_keys=None, headers=None):
+    endpoint = request.path
+
+    def lines():
+        seconds, count, item = 0, 0, None
+        for item in items:
+            start = time.perf_counter()
+            line = orjson.dumps(item, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_APPEND_NEWLINE)
+            seconds += time.perf_counter() - start
+            count += 1
+            yield line
+        cursor = get_next_cursor(item, count, size, cursor_keys) if cursor_keys else None
+        if cursor:
+            yield orjson.dumps({'nextCursor': cursor}, option=orjson.OPT_APPEND_NEWLINE)
+        metrics.observe('serialization_seconds', seconds, endpoint=endpoint)
+
+    return Response(lines(), mimetype='application/x-ndjson', headers=headers)
+
+@app.errorhandler(ValueError)
+def bad_request(exception):
+    return jsonify({'error': str(exception)}), 400
 
 @app.route("/")
 def landing():
     return f"Welcome! You can find the api documentation in the documentation folder"
 
+@app.route("/healthz")
+def healthz():
+    return jsonify({'status': 'ok'})
+
+@app.route("/readyz")
+def readyz():
+    status = processor.get_status()
+    if not ingest_on_startup:
+        try:
+            status['ready'] = api.check_graph_exists()
+        except Exception as exception:
+            status['error'] = repr(exception)
+    return jsonify(status), 200 if status['ready'] else 503
+
 @app.route("/api/top_n", methods=['GET'])
 def get_top_n():
     n =int(request.args['n'])
     cluster = request.args['cluster']
-    nodes = Api().get_top_nodes(n,cluster)
-    return jsonify(nodes)
+    nodes = api.get_top_nodes(n,cluster,request.args.get('cursor'))
+
+    # The cursor of the next page, if there may be one
+    cursor = get_next_cursor(nodes[-1] if nodes else None, len(nodes), n, TOP_NODES_ORDER)
+    headers = {'X-Next-Cursor': cursor} if cursor else None
+    if request.args.get('format') == 'ndjson':
+        return ndjson_response(nodes, n, TOP_NODES_ORDER, headers)
+    return json_response(nodes, headers)
 
 @app.route("/api/find_shortest/path_weight")
 def get_shortest_path_weight():
 
     jobId1 =request.args['JobId1']
     jobId2 = request.args['JobId2']
-    nodes = Api().get_shortest_path_by_weight(jobId1,jobId2)
+    # Only the embedded engine stops searching past max_cost, the database filters the path it found
+    max_cost = request.args.get('max_cost', type=float)
+    nodes = api.get_shortest_path_by_weight(jobId1,jobId2,max_cost)
 
-    return jsonify(nodes)
+    return json_response(nodes)
 
 @app.route("/api/find_shortest/num_nodes")
 def get_shortest_path_numnodes():
 
     jobId1 =request.args['JobId1']
     jobId2 = request.args['JobId2']
-    nodes = Api().get_shortest_path_by_num_nodes(jobId1,jobId2)
+    nodes = api.get_shortest_path_by_num_nodes(jobId1,jobId2)
     
-    return jsonify(nodes)
+    return json_response(nodes)
+
+@app.route("/api/find_shortest/batch", methods=['POST'])
+def get_shortest_paths_batch():
+
+    body = request.get_json(force=True)
+    if not isinstance(body, dict) or not isinstance(body.get('pairs'), list):
+        raise ValueError('The body must be a JSON object with a list of pairs')
+    # Objects without one of the job IDs get None, which the api rejects like any other invalid pair
+    pairs = [(pair.get('JobId1'), pair.get('JobId2')) if isinstance(pair, dict) else pair for pair in body['pairs']]
+    results = api.get_shortest_paths_batch(pairs, body.get('mode', 'weight'))
+
+    # One JSON line per pair, in the same order as the request
+    return ndjson_response({'JobId1': jobId1, 'JobId2': jobId2, 'paths': paths} for (jobId1, jobId2), paths in zip(pairs, results))
+
+@app.route("/api/find_shortest/from_source")
+def get_paths_from_source():
+
+    jobId = request.args['JobId']
+    max_hops = request.args.get('max_hops', type=int)
+    max_cost = request.args.get('max_cost', type=float)
+    limit = request.args.get('limit', 100, type=int)
+    jobs = api.get_paths_from_source(jobId, request.args.get('mode', 'weight'), max_hops, max_cost,
+                                     limit, request.args.get('offset', 0, type=int), request.args.get('cursor'))
+
+    return ndjson_response(jobs, limit, PATHS_FROM_SOURCE_ORDER)
+
+@app.route("/api/similar_jobs")
+def get_similar_jobs():
+
+    jobId = request.args['JobId']
+    jobs = api.get_similar_jobs(jobId, request.args.get('k', 10, type=int))
+
+    return json_response(jobs)
+
+@app.route("/api/cache_stats")
+def get_cache_stats():
+    return jsonify(api.get_cache_stats())
+
+@app.route("/metrics")
+def get_metrics():
+    # The gauges are read when scraped
+    pool = get_pool_stats()
+    if pool:
+        metrics.set('neo4j_pool_max_connections', pool['max'])
+        metrics.set('neo4j_pool_connections', pool['in_use'], state='in_use')
+        metrics.set('neo4j_pool_connections', pool['idle'], state='idle')
+    paths = api.get_cache_stats()['paths']
+    metrics.set('path_cache_events_total', paths['hits'], event='hit')
+    metrics.set('path_cache_events_total', paths['misses'], event='miss')
+    metrics.set('path_cache_entries', paths['size'])
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
 
-DataProcessor().process_data()
+if ingest_on_startup:
+    processor.start()
 if __name__=='__main__':
     app.run()
\ No newline at end of file
@@ -0,0 +1,114 @@
+import asyncio
+import os
+from contextlib import asynccontextmanager
+from functools import wraps
+import orjson
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse, PlainTextResponse
+from starlette.routing import Route
+from db_logic.async_neo4j_logic import AsyncApi
+from db_logic.neo4j_logic import TOP_NODES_ORDER, get_next_cursor
+
+# Async serving mode, with the same routes as app.py. Run it with several workers, e.g.
+# gunicorn asgi_app:app -k uvicorn.workers.UvicornWorker -w 4 -b 0.0.0.0:5000
+# The data must have been loaded before (python -m processing_and_loading.run_data_processing)
+
+MAX_CONCURRENT_REQUESTS = int(os.environ.get('MAX_CONCURRENT_REQUESTS', 256))  # per worker
+QUEUE_TIMEOUT = float(os.environ.get('QUEUE_TIMEOUT', 1))                      # seconds waiting for a slot
+REQUEST_TIMEOUT = float(os.environ.get('REQUEST_TIMEOUT', 30))                 # seconds
+
+api = AsyncApi(use_engine=os.environ.get('GRAPH_ENGINE') == 'embedded')
+_slots = None
+
+class FastJSONResponse(JSONResponse):
+    """JSON response encoded with orjson, several times faster than the json module for big lists"""
+
+    def render(self, content) -> bytes:
+        return orjson.dumps(content, option=orjson.OPT_SERIALIZE_NUMPY)
+
+def limited(handler):
+    """Limits the requests handled at the same time and how long each one can take
+
+    Requests that can't get a slot in QUEUE_TIMEOUT get a 503 and requests that take longer than
+    REQUEST_TIMEOUT get a 504. Invalid parameters get a 400
+    """
+    @wraps(handler)
+    async def wrapper(request):
+        global _slots
+        if _slots is None:
+            _slots = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+        try:
+            await asyncio.wait_for(_slots.acquire(), QUEUE_TIMEOUT)
+        except asyncio.TimeoutError:
+            return JSONResponse({'error': 'Too many requests in progress'}, status_code=503)
+        try:
+            return await asyncio.wait_for(handler(request), REQUEST_TIMEOUT)
+        except asyncio.TimeoutError:
+            return JSONResponse({'error': 'The request took too long'}, status_code=504)
+        except (KeyError, ValueError) as exception:
+            return JSONResponse({'error': str(exception)}, status_code=400)
+        finally:
+            _slots.release()
+    return wrapper
+
+async def landing(request):
+    return PlainTextResponse("Welcome! You can find the api documentation in the documentation folder")
+
+async def healthz(request):
+    return JSONResponse({'status': 'ok'})
+
+async def readyz(request):
+    # Ready once the data has been loaded and the graph projected
+    try:
+        ready = await asyncio.wait_for(api.check_graph_exists(), REQUEST_TIMEOUT)
+    except Exception as exception:
+        return JSONResponse({'ready': False, 'error': repr(exception)}, status_code=503)
+    return JSONResponse({'ready': ready}, status_code=200 if ready else 503)
+
+@limited
+async def get_top_n(request):
+    n = int(request.query_params['n'])
+    cluster = request.query_params['cluster']
+    nodes = await api.get_top_nodes(n, cluster, request.query_params.get('cursor'))
+    # The cursor of the next page, if there may be one
+    cursor = get_next_cursor(nodes[-1] if nodes else None, len(nodes), n, TOP_NODES_ORDER)
+    return FastJSONResponse(nodes, headers={'X-Next-Cursor': cursor} if cursor else None)
+
+@limited
+async def get_shortest_path_weight(request):
+    jobId1 = request.query_params['JobId1']
+    jobId2 = request.query_params['JobId2']
+    max_cost = request.query_params.get('max_cost')
+    nodes = await api.get_shortest_path_by_weight(jobId1, jobId2, float(max_cost) if max_cost is not None else None)
+    return FastJSONResponse(nodes)
+
+@limited
+async def get_shortest_path_numnodes(request):
+    jobId1 = request.query_params['JobId1']
+    jobId2 = request.query_params['JobId2']
+    nodes = await api.get_shortest_path_by_num_nodes(jobId1, jobId2)
+    return FastJSONResponse(nodes)
+
+@limited
+async def get_similar_jobs(request):
+    jobId = request.query_params['JobId']
+    jobs = await api.get_similar_jobs(jobId, int(request.query_params.get('k', 10)))
+    return FastJSONResponse(jobs)
+
+@asynccontextmanager
+async def lifespan(app):
+    yield
+    await api.close()
+
+app = Starlette(
+    routes=[
+        Route("/", landing),
+        Route("/healthz", healthz),
+        Route("/readyz", readyz),
+        Route("/api/top_n", get_top_n),
+        Route("/api/find_shortest/path_weight", get_shortest_path_weight),
+        Route("/api/find_shortest/num_nodes", get_shortest_path_numnodes),
+        Route("/api/similar_jobs", get_similar_jobs),
+    ],
+    lifespan=lifespan,
+)
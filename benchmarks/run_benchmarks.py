@@ -0,0 +1,313 @@
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+from neo4j import GraphDatabase
+from benchmarks.synthetic import write_jobs_csv
+from processing_and_loading.data_processing import CLUSTER_COLUMNS, read_jobs, load_data, calculate_self_similarity_matrix, get_relation_pairs, calculate_blocked_similarities, calculate_candidate_similarities, calculate_top_neighbours
+from processing_and_loading.neo4j_loader import create_constraints, load_nodes_into_db_batch, load_df_into_db_batch
+from processing_and_loading.run_data_processing import DataProcessor
+from db_logic.driver import URI, AUTH
+from db_logic.cache import bump_data_version, path_cache
+from db_logic.graph_engine import GraphEngine
+from db_logic.neo4j_logic import Api, CLUSTERS
+
+# Deletes every node in batches, so the loading benchmarks start from an empty database. The data version
+# is kept, so the caches of the previous size are seen as stale
+CLEAR_QUERY = '''
+    MATCH (n) WHERE NOT n:DataVersion
+    CALL { WITH n DETACH DELETE n } IN TRANSACTIONS OF 10000 ROWS
+'''
+
+
+class BenchmarkRecorder:
+    """
+    Collects the results of the benchmarks and writes them as a JSON file after each one, so the results of
+    a run that fails half way are kept
+
+    tracemalloc slows down Python-heavy code several times, so a recorder either times the benchmarks or
+    traces their memory, never both (see run_size)
+
+    ...
+    Methods
+    -------
+    measure(name: str, function, *args, **kwargs)
+        Runs a function once and records its time, or its peak memory when tracing
+
+    measure_latencies(name: str, function, calls: list)
+        Runs a function once per set of arguments and records the distribution of the times (not when tracing)
+    """
+
+    def __init__(self, path, metadata: dict, trace_memory=False) -> None:
+        """
+        Parameters
+        ----------
+        path : str
+            The location of the JSON file, it is overwritten
+        metadata : dict
+            What the results were measured with (version of the code, machine, parameters)
+        trace_memory : bool, optional
+            If True, the peak memory of the benchmarks is recorded instead of their time
+        """
+        self.path = path
+        self.metadata = metadata
+        self.trace_memory = trace_memory
+        self.results = []
+        self.context = {}
+
+    def _record(self, name: str, result: dict) -> None:
+        record = {'benchmark': name, **self.context, **result}
+        if not self.trace_memory:
+            # Peak of the process, which only runs one size (see run_size)
+            record['max_rss_bytes'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        self.results.append(record)
+        print(json.dumps(record))
+        with open(self.path, 'w') as file:
+            json.dump({**self.metadata, 'results': self.results}, file, indent=2)
+
+    def measure(self, name: str, function, *args, **kwargs):
+        """Runs a function once and records its time or, when tracing, the peak memory it allocated (traced by
+        tracemalloc, which includes numpy arrays)
+
+        Parameters
+        ----------
+        name : str
+            The name of the benchmark
+        function : callable
+            The function to measure
+
+        Returns
+        -------
+        object
+            what the function returned
+        """
+        if not self.trace_memory:
+            start = time.perf_counter()
+            result = function(*args, **kwargs)
+            self._record(name, {'seconds': time.perf_counter() - start})
+            return result
+        tracemalloc.start()
+        try:
+            result = function(*args, **kwargs)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        self._record(name, {'peak_memory_bytes': peak})
+        return result
+
+    def measure_latencies(self, name: str, function, calls: list) -> None:
+        """Runs a function once per set of arguments and records the mean and percentiles of the times
+
+        Parameters
+        ----------
+        name : str
+            The name of the benchmark
+        function : callable
+            The function to measure, its results are consumed if they are iterators
+        calls : list
+            A tuple of arguments per call
+        """
+        if self.trace_memory:
+            return
+        latencies = []
+        for args in calls:
+            start = time.perf_counter()
+            result = function(*args)
+            if hasattr(result, '__next__'):
+                result = list(result)
+            latencies.append(time.perf_counter() - start)
+        latencies = np.array(latencies)
+        self._record(name, {'calls': len(latencies), 'mean_seconds': latencies.mean(),
+                            'p50_seconds': np.percentile(latencies, 50), 'p95_seconds': np.percentile(latencies, 95),
+                            'p99_seconds': np.percentile(latencies, 99), 'max_seconds': latencies.max()})
+
+# Describes the code and the machine the benchmarks ran on
+def get_metadata(args) -> dict:
+    """Returns the commit, versions and machine of the run and its arguments"""
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'created': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()), 'commit': commit,
+            'python': platform.python_version(), 'numpy': np.__version__, 'platform': platform.platform(),
+            'cpus': os.cpu_count(), 'arguments': vars(args)}
+
+# Benchmarks the processing of the csv file into jobs and relationships
+def benchmark_processing(recorder: BenchmarkRecorder, csv_path, args):
+    """Measures each stage of the data processing on a csv file
+
+    The dense matrix (calculate_self_similarity_matrix and get_relation_pairs) is only measured up to
+    args.dense_limit jobs and the exact tiled calculation up to args.exact_limit jobs, as their time
+    (and for the dense matrix, memory) grows with the square of the number of jobs
+
+    Returns
+    -------
+    tuple
+        the DataFrame of the jobs and the one of the relationships (exact when measured, otherwise from the candidate index)
+    """
+    job_ids, clusters, scores, vectors = recorder.measure('read_jobs', read_jobs, csv_path)
+    num_jobs = len(job_ids)
+
+    if num_jobs <= args.dense_limit:
+        df = load_data(csv_path)
+        matrix = recorder.measure('calculate_self_similarity_matrix', calculate_self_similarity_matrix, df[CLUSTER_COLUMNS])
+        recorder.measure('get_relation_pairs', get_relation_pairs, matrix)
+        del df, matrix
+
+    edges = recorder.measure('calculate_candidate_similarities', calculate_candidate_similarities, vectors, block_size=args.block_size)
+    if num_jobs <= args.exact_limit:
+        edges = recorder.measure('calculate_blocked_similarities', calculate_blocked_similarities, vectors, block_size=args.block_size)
+        recorder.measure('calculate_top_neighbours', calculate_top_neighbours, vectors, 10, block_size=args.block_size)
+
+    nodes_df = DataProcessor.get_jobs_frame(job_ids, clusters, scores, vectors)
+    edges_df = DataProcessor.get_relationships_frame(nodes_df, *edges)
+    print(f'{num_jobs} jobs, {len(edges_df)} relationships')
+    return nodes_df, edges_df
+
+# Picks the pairs of jobs of the path queries
+def get_query_pairs(edges_df, num_queries: int, seed=0) -> list:
+    """Returns pairs of jobs with relationships: half of them related to each other (so a path exists)
+    and half random (which may be in different components of the graph)"""
+    rng = np.random.default_rng(seed)
+    if len(edges_df) == 0:
+        return []
+    sources = edges_df['JobId'].astype(str).to_numpy()
+    targets = edges_df['SimilarJobId'].astype(str).to_numpy()
+    related = rng.integers(0, len(edges_df), num_queries // 2)
+    job_ids = np.unique(np.concatenate([sources, targets]))
+    random = rng.choice(job_ids, (num_queries - len(related), 2))
+    return list(zip(sources[related], targets[related])) + [tuple(pair) for pair in random]
+
+# Benchmarks the in-process graph engine
+def benchmark_engine(recorder: BenchmarkRecorder, nodes_df, edges_df, pairs: list) -> None:
+    """Measures building the graph engine and its path queries"""
+    engine = recorder.measure('GraphEngine.from_frames', GraphEngine.from_frames, nodes_df, edges_df)
+    recorder.measure_latencies('GraphEngine.shortest_path_by_weight', engine.shortest_path_by_weight, pairs)
+    recorder.measure_latencies('GraphEngine.shortest_path_by_num_nodes', engine.shortest_path_by_num_nodes, pairs)
+    recorder.measure_latencies('GraphEngine.reachable_from', lambda jobId: engine.reachable_from(jobId, False, 2), [pair[:1] for pair in pairs])
+
+# Benchmarks loading the data into Neo4j and the queries of the Api
+def benchmark_database(recorder: BenchmarkRecorder, nodes_df, edges_df, pairs: list, args) -> None:
+    """Measures loading the data into an emptied database, projecting the graph and every query of the Api
+
+    Every path query is run twice, first with the path cache empty and then answered from the cache
+    """
+    with GraphDatabase.driver(URI, auth=AUTH) as driver:
+        with driver.session() as session:
+            session.run(CLEAR_QUERY).consume()
+    create_constraints()
+    recorder.measure('load_nodes_into_db_batch', load_nodes_into_db_batch, nodes_df, args.batch_size, args.writers)
+    recorder.measure('load_df_into_db_batch', load_df_into_db_batch, edges_df, args.batch_size, args.writers)
+    bump_data_version()
+
+    api = Api()
+    recorder.measure('Api.project_graph', api.project_graph, refresh=True)
+
+    def top_nodes_query(n, cluster):
+        with api.driver.session() as session:
+            return session.execute_read(api._get_top_nodes, n, cluster)
+
+    top_n_calls = [(10, cluster) for cluster in CLUSTERS]
+    recorder.measure_latencies('top nodes query', top_nodes_query, top_n_calls)
+    recorder.measure('Api.load_top_nodes_cache', api.load_top_nodes_cache)
+    recorder.measure_latencies('Api.get_top_nodes', api.get_top_nodes, top_n_calls)
+
+    path_cache.clear()
+    recorder.measure_latencies('Api.get_shortest_path_by_weight', api.get_shortest_path_by_weight, pairs)
+    recorder.measure_latencies('Api.get_shortest_path_by_weight (cached)', api.get_shortest_path_by_weight, pairs)
+    recorder.measure_latencies('Api.get_shortest_path_by_num_nodes', api.get_shortest_path_by_num_nodes, pairs)
+    recorder.measure_latencies('Api.get_shortest_path_by_num_nodes (cached)', api.get_shortest_path_by_num_nodes, pairs)
+    path_cache.clear()
+    recorder.measure('Api.get_shortest_paths_batch', lambda: list(api.get_shortest_paths_batch(pairs, 'weight')))
+    recorder.measure_latencies('Api.get_paths_from_source', lambda jobId: api.get_paths_from_source(jobId, 'num_nodes', max_hops=2),
+                               [pair[:1] for pair in pairs])
+
+# Runs every benchmark of one size in the current process
+def benchmark_size(recorder: BenchmarkRecorder, size: int, args) -> None:
+    """Generates the jobs of a size and runs the processing, engine and (with --neo4j) database benchmarks"""
+    recorder.context = {'jobs': size, 'duplicate_fraction': args.duplicate_fraction}
+    with tempfile.TemporaryDirectory() as directory:
+        csv_path = os.path.join(directory, f'jobs_{size}.csv')
+        write_jobs_csv(csv_path, size, args.duplicate_fraction, seed=args.seed)
+        nodes_df, edges_df = benchmark_processing(recorder, csv_path, args)
+    recorder.context['relationships'] = len(edges_df)
+    pairs = get_query_pairs(edges_df, args.queries, args.seed)
+    if pairs:
+        benchmark_engine(recorder, nodes_df, edges_df, pairs)
+        if args.neo4j:
+            benchmark_database(recorder, nodes_df, edges_df, pairs, args)
+
+# Runs the benchmarks of one size in a new process
+def run_size(size: int, trace_memory: bool) -> list:
+    """Runs the benchmarks of a size in a child process and returns its results
+
+    Each size gets its own process, so max_rss_bytes is the peak of that size and not of the largest size
+    before it. The times and the memory are measured in separate processes, as tracing the memory slows down
+    what it traces
+
+    Parameters
+    ----------
+    size : int
+        The number of jobs
+    trace_memory : bool
+        If True, the child records the peak memory of each benchmark instead of its time
+
+    Returns
+    -------
+    list
+        the results of the child
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'results.json')
+        command = [sys.executable, '-m', 'benchmarks.run_benchmarks', *sys.argv[1:], '--child-size', str(size), '--output', path]
+        subprocess.run(command + (['--trace-memory'] if trace_memory else []), check=True)
+        with open(path) as file:
+            return json.load(file)['results']
+
+# Adds the peak memory of the memory run to the records of the timed run
+def merge_results(timed: list, traced: list) -> list:
+    """Returns the timed records with the peak_memory_bytes of the traced record of the same benchmark"""
+    peaks = {record['benchmark']: record['peak_memory_bytes'] for record in traced}
+    return [dict(record, peak_memory_bytes=peaks[record['benchmark']]) if record['benchmark'] in peaks else record
+            for record in timed]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks the processing, loading and queries on synthetic job data')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000, 1000000], help='numbers of jobs to generate')
+    parser.add_argument('--duplicate-fraction', type=float, default=0.01, help='fraction of the jobs that are near-duplicates of another')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the generated data')
+    parser.add_argument('--dense-limit', type=int, default=20000, help='largest size measured with the dense similarity matrix')
+    parser.add_argument('--exact-limit', type=int, default=200000, help='largest size measured with the exact tiled similarities')
+    parser.add_argument('--block-size', type=int, default=2048, help='rows and columns of each tile of the similarity calculation')
+    parser.add_argument('--queries', type=int, default=100, help='pairs of jobs of the path query benchmarks')
+    parser.add_argument('--neo4j', action='store_true',
+                        help='also benchmark loading and the Api queries against the database of NEO4J_URI (ALL ITS DATA IS DELETED)')
+    parser.add_argument('--batch-size', type=int, default=5000, help='rows of each loading batch')
+    parser.add_argument('--writers', type=int, default=1, help='threads loading the data into the database')
+    parser.add_argument('--no-memory', action='store_true', help='only measure the times, without the run tracing the memory')
+    parser.add_argument('--output', default='benchmark_results.json', help='location of the JSON results')
+    # Used by run_size to run one size in a child process
+    parser.add_argument('--child-size', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--trace-memory', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child_size is not None:
+        benchmark_size(BenchmarkRecorder(args.output, {}, args.trace_memory), args.child_size, args)
+        sys.exit()
+
+    metadata = get_metadata(args)
+    results = []
+    for size in args.sizes:
+        timed = run_size(size, trace_memory=False)
+        results += merge_results(timed, [] if args.no_memory else run_size(size, trace_memory=True))
+        with open(args.output, 'w') as file:
+            json.dump({**metadata, 'results': results}, file, indent=2)
+    print(f'Results written to {args.output}')
@@ -0,0 +1,65 @@
+import numpy as np
+import pandas as pd
+from processing_and_loading.data_processing import CLUSTER_COLUMNS
+from processing_and_loading.csv_export import write_csv_chunks
+
+# Generates a job matrix with the same columns as the real data
+def generate_jobs(num_jobs: int, duplicate_fraction=0.01, noise=0.002, seed=0) -> pd.DataFrame:
+    """Generates random jobs with a membership score per cluster, like the rows of the real csv file
+
+    Each job has a dominant cluster and random scores in the others (summing 1). A fraction of the jobs
+    are near-duplicates of another job (its scores plus a little noise), which is what produces the
+    relationships above the 0.99 similarity threshold: unrelated random jobs are almost never that similar
+
+    Parameters
+    ----------
+    num_jobs : int
+        The number of jobs
+    duplicate_fraction : float, optional
+        The fraction of the jobs that are near-duplicates of another job
+    noise : float, optional
+        The standard deviation of the noise added to the near-duplicates
+    seed : int, optional
+        The seed of the random generator, the same arguments always give the same jobs
+
+    Returns
+    -------
+    DataFrame
+        a DataFrame with the JobId and c0-c21 columns
+    """
+    rng = np.random.default_rng(seed)
+    num_clusters = len(CLUSTER_COLUMNS)
+    scores = rng.gamma(0.3, size=(num_jobs, num_clusters))
+    scores[np.arange(num_jobs), rng.integers(0, num_clusters, num_jobs)] += rng.uniform(0.5, 3, num_jobs)
+
+    duplicates = rng.choice(num_jobs, int(num_jobs * duplicate_fraction), replace=False)
+    originals = rng.integers(0, num_jobs, len(duplicates))
+    scores[duplicates] = np.abs(scores[originals] + rng.normal(0, noise, (len(duplicates), num_clusters)))
+    scores /= scores.sum(axis=1, keepdims=True)
+
+    # 32 hexadecimal characters, like the real job IDs
+    halves = rng.integers(0, 2 ** 63, (num_jobs, 2))
+    df = pd.DataFrame(scores, columns=CLUSTER_COLUMNS)
+    df.insert(0, 'JobId', [f'{high:016x}{low:016x}' for high, low in halves])
+    return df
+
+# Writes generated jobs as a csv file
+def write_jobs_csv(path, num_jobs: int, duplicate_fraction=0.01, noise=0.002, seed=0, chunk_size=100000) -> None:
+    """Generates jobs (see generate_jobs) and writes them as a csv file with the columns of the real data
+
+    Parameters
+    ----------
+    path : str
+        The location of the csv file, it is overwritten
+    num_jobs : int
+        The number of jobs
+    duplicate_fraction : float, optional
+        The fraction of the jobs that are near-duplicates of another job
+    noise : float, optional
+        The standard deviation of the noise added to the near-duplicates
+    seed : int, optional
+        The seed of the random generator
+    chunk_size : int, optional
+        The number of rows formatted at a time
+    """
+    write_csv_chunks(generate_jobs(num_jobs, duplicate_fraction, noise, seed), path, chunk_size)
@@ -0,0 +1,243 @@
+import hashlib
+import json
+import os
+import shutil
+import time
+import urllib.error
+import urllib.request
+import numpy as np
+
+# Where the data processing keeps its intermediates between runs, one directory per version of the input
+ARTIFACTS_DIR = os.environ.get('ARTIFACTS_DIR', 'artifacts')
+
+# The arrays of a version. The job arrays have one row per job and the edge arrays one per relationship,
+# with the row numbers of its jobs
+ARRAYS = ('job_ids', 'clusters', 'membership_scores', 'vectors', 'edge_jobs', 'edge_similar_jobs', 'edge_scores')
+
+MANIFEST = 'manifest.json'
+CURRENT = 'CURRENT'
+
+# Where the inputs downloaded to identify their version are kept, in ARTIFACTS_DIR
+DOWNLOADS = 'downloads'
+
+# Identifies the version of the input without reading it when it is a URL
+def get_input_version(data) -> dict:
+    """Describes the version of the input data
+
+    For a URL, a HEAD request gives its ETag, Last-Modified and Content-Length. For a file, its contents are hashed
+
+    Parameters
+    ----------
+    data : str
+        The URL or file location of the csv file
+
+    Returns
+    -------
+    dict
+        the source and what identifies its version, or None if the server doesn't send an ETag or Last-Modified
+        (or doesn't answer HEAD requests)
+
+    Raises
+    ------
+    OSError
+        if the server can't be reached
+    """
+    if data.startswith(('http://', 'https://')):
+        try:
+            with urllib.request.urlopen(urllib.request.Request(data, method='HEAD'), timeout=10) as response:
+                headers = {name: response.headers.get(name) for name in ('ETag', 'Last-Modified', 'Content-Length')}
+        except urllib.error.HTTPError as exception:
+            # The server answered, only not to HEAD (e.g. 405 Method Not Allowed)
+            print(f'Could not check the version of {data} with a HEAD request: {exception}')
+            return None
+        if headers['ETag'] is None and headers['Last-Modified'] is None:
+            return None
+        return {'source': data, **headers}
+
+    return {'source': os.path.abspath(data), 'sha256': hash_file(data)}
+
+def hash_file(path) -> str:
+    """Returns the sha256 hex digest of the contents of a file, read in blocks"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+# Downloads the input when its version can only be told from its contents
+def download_input(data: str, root=ARTIFACTS_DIR):
+    """Downloads a URL to the downloads directory of the artifacts, hashing it while it is written
+
+    Only the last download is kept, it is read by the data processing instead of the URL
+
+    Parameters
+    ----------
+    data : str
+        The URL of the csv file
+    root : str, optional
+        The artifacts directory
+
+    Returns
+    -------
+    tuple
+        the location of the downloaded file and the version of the input (the URL and the sha256 of its contents)
+
+    Raises
+    ------
+    OSError
+        if the download fails
+    """
+    directory = os.path.join(root, DOWNLOADS)
+    os.makedirs(directory, exist_ok=True)
+    temporary = os.path.join(directory, f'download.tmp-{os.getpid()}')
+    digest = hashlib.sha256()
+    try:
+        with urllib.request.urlopen(data, timeout=60) as response, open(temporary, 'wb') as file:
+            for block in iter(lambda: response.read(1 << 20), b''):
+                digest.update(block)
+                file.write(block)
+    except OSError:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+        raise
+    path = os.path.join(directory, f'{digest.hexdigest()}.csv')
+    os.replace(temporary, path)
+    for name in os.listdir(directory):
+        if name.endswith('.csv') and os.path.join(directory, name) != path:
+            os.remove(os.path.join(directory, name))
+    return path, {'source': data, 'sha256': digest.hexdigest()}
+
+# Tells where to read the input from and which version it is
+def fetch_input(data: str, root=ARTIFACTS_DIR):
+    """Identifies the version of the input data, downloading it when the server can't tell
+
+    The ETag or Last-Modified of the URL (or the hash of a file) identify the version. When the server sends
+    neither, the URL is downloaded and its contents are hashed (see download_input). Only when the server
+    can't be reached is the version unknown
+
+    Parameters
+    ----------
+    data : str
+        The URL or file location of the csv file
+    root : str, optional
+        The artifacts directory
+
+    Returns
+    -------
+    tuple
+        the location to read the csv file from and its version (see get_input_version), None if the server
+        can't be reached
+    """
+    try:
+        input_version = get_input_version(data)
+        if input_version is None:
+            print(f'{data} does not tell its version, downloading it to hash its contents')
+            return download_input(data, root)
+    except OSError as exception:
+        print(f'WARNING: could not reach {data} ({exception}). Its version is unknown, the last artifacts of the source '
+              'will be used and may be out of date')
+        return data, None
+    return data, input_version
+
+# Builds the name of the directory of a version of the input and of the processing parameters
+def get_artifact_key(input_version: dict, parameters: dict) -> str:
+    """Hashes the version of the input and the parameters that change the results
+
+    Parameters
+    ----------
+    input_version : dict
+        The version of the input (see get_input_version)
+    parameters : dict
+        The processing parameters the arrays depend on
+
+    Returns
+    -------
+    str
+        the key of the artifacts
+    """
+    text = json.dumps({'input': input_version, 'parameters': parameters}, sort_keys=True)
+    return hashlib.sha256(text.encode()).hexdigest()[:16]
+
+# Writes the arrays of a version and marks it as the current one
+def save_artifacts(key: str, arrays: dict, manifest: dict, root=ARTIFACTS_DIR, write_extra=None) -> str:
+    """Writes the arrays of a version as .npy files with a manifest and makes it the current version
+
+    The files are written to a temporary directory that is renamed when complete, so a version directory
+    is never seen half written
+
+    Parameters
+    ----------
+    key : str
+        The key of the version (see get_artifact_key)
+    arrays : dict
+        The numpy arrays, with the names in ARRAYS
+    manifest : dict
+        What produced the arrays (input version, parameters...), saved as manifest.json
+    root : str, optional
+        The artifacts directory
+    write_extra : callable, optional
+        Called with the temporary directory to write other files of the version (such as the neighbour index)
+
+    Returns
+    -------
+    str
+        the directory of the version
+    """
+    directory = os.path.join(root, key)
+    temporary = f'{directory}.tmp-{os.getpid()}'
+    shutil.rmtree(temporary, ignore_errors=True)
+    os.makedirs(temporary)
+    for name in ARRAYS:
+        np.save(os.path.join(temporary, f'{name}.npy'), arrays[name])
+    if write_extra is not None:
+        write_extra(temporary)
+    manifest = {**manifest, 'key': key, 'created': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+                'jobs': len(arrays['job_ids']), 'relationships': len(arrays['edge_scores'])}
+    with open(os.path.join(temporary, MANIFEST), 'w') as file:
+        json.dump(manifest, file, indent=2)
+
+    if os.path.exists(directory):
+        shutil.rmtree(temporary)    # another run wrote the same version
+    else:
+        os.replace(temporary, directory)
+    set_current_artifacts(key, root)
+    return directory
+
+# Memory-maps the arrays of a version
+def load_artifacts(key: str, root=ARTIFACTS_DIR):
+    """Memory-maps the arrays of a version, so processes reading the same version share the pages
+
+    Parameters
+    ----------
+    key : str
+        The key of the version
+    root : str, optional
+        The artifacts directory
+
+    Returns
+    -------
+    tuple
+        a dictionary of read-only memory-mapped arrays (with the names in ARRAYS) and the manifest,
+        or None if the version has not been written
+    """
+    directory = os.path.join(root, key)
+    if not os.path.exists(os.path.join(directory, MANIFEST)):
+        return None
+    with open(os.path.join(directory, MANIFEST)) as file:
+        manifest = json.load(file)
+    arrays = {name: np.load(os.path.join(directory, f'{name}.npy'), mmap_mode='r') for name in ARRAYS}
+    return arrays, manifest
+
+def set_current_artifacts(key: str, root=ARTIFACTS_DIR) -> None:
+    """Makes a version the one the serving processes read"""
+    with open(os.path.join(root, CURRENT + '.tmp'), 'w') as file:
+        file.write(key)
+    os.replace(os.path.join(root, CURRENT + '.tmp'), os.path.join(root, CURRENT))
+
+def get_current_artifacts(root=ARTIFACTS_DIR):
+    """Returns the key of the last version written, or None if there is none"""
+    try:
+        with open(os.path.join(root, CURRENT)) as file:
+            return file.read().strip() or None
+    except FileNotFoundError:
+        return None
@@ -0,0 +1,206 @@
+import asyncio
+from db_logic.driver import get_async_driver, close_async_driver, get_driver
+from db_logic.cache import top_nodes_cache, path_cache, get_data_version
+from db_logic.graph_engine import load_engine
+from db_logic.neighbour_index import get_neighbour_index
+from db_logic.neo4j_logic import (SHORTEST_PATH_BY_WEIGHT_QUERY, SHORTEST_PATH_BY_NUM_NODES_QUERY,
+                                  ALL_NODES_QUERY, GRAPH_EXISTS_QUERY, MAX_PAGE_SIZE, check_cluster, decode_cursor)
+
+
+class AsyncApi:
+    """
+    A class to represent the API with the async Neo4j driver, used by the ASGI app
+
+    Same queries, caches and graph engine as Api, but the requests don't hold a thread while they wait for the database
+
+    ...
+    Methods
+    -------
+    close()
+        Closes the shared async driver
+
+    get_top_nodes(n, cluster, cursor) -> list
+        Retrieves a page of the top N nodes of a cluster from the top nodes cache
+
+    load_top_nodes_cache()
+        Fills the top nodes cache with every job in the database
+
+    check_graph_exists(graph: str) -> bool
+        Checks if a graph exists in the Graph Catalog
+
+    get_shortest_path_by_weight(jobId1: str, jobId2: str, max_cost: float) -> list
+        Retrieves the path between two nodes with the lowest total distance
+
+    get_shortest_path_by_num_nodes(jobId1: str, jobId2: str) -> list
+        Retrieves the path between two nodes with the fewest nodes
+
+    get_similar_jobs(jobId: str, k: int) -> list
+        Retrieves the most similar jobs of a job from the neighbour index
+    """
+
+    def __init__(self, use_engine=False) -> None:
+        self.use_engine = use_engine
+        self._cache_lock = None
+
+    @property
+    def driver(self):
+        return get_async_driver()
+
+    async def close(self):
+        """Closes the shared async driver"""
+        await close_async_driver()
+
+    @staticmethod
+    def _paths(records) -> list:
+        return [[{'JobId':node['JobId'],'membershipScore':node['membershipScore']} for node in record['nodes(path)']] for record in records]
+
+    async def _read(self, query: str, **parameters) -> list:
+        """Runs a read query in a managed transaction and returns its records"""
+        async def work(transaction):
+            result = await transaction.run(query, **parameters)
+            return [record async for record in result]
+
+        async with self.driver.session() as session:
+            return await session.execute_read(work)
+
+    async def check_graph_exists(self, graph='myGraph') -> bool:
+        """Checks if a graph exists in the Graph Catalog
+
+        Parameters
+        ----------
+        graph : str, optional
+            The name of the graph in the Graph Catalog
+
+        Returns
+        -------
+            bool
+                True if the graph exists
+        """
+        async with self.driver.session() as session:
+            result = await session.run(GRAPH_EXISTS_QUERY, graph=graph)
+            record = await result.single()
+            return record['exists']
+
+    async def _engine(self):
+        # Building the engine reads the whole graph, so it runs in a thread with the sync driver
+        return await asyncio.to_thread(load_engine, get_driver())
+
+    async def get_top_nodes(self, n: int, cluster: str, cursor=None) -> list:
+        """Retrieves the top N nodes of a cluster
+
+        Parameters
+        ----------
+        n : int
+            The top N nodes to retrieve, at most MAX_PAGE_SIZE
+        cluster : str
+            The cluster name
+        cursor : str, optional
+            The cursor of the previous page, the first page if None
+
+        Returns
+        -------
+        list
+            a list of dictionaries containing the job IDs and and the membership scores
+
+        Raises
+        ------
+        ValueError
+            If cluster is not one of the known clusters, n is out of range or the cursor is invalid
+        """
+        check_cluster(cluster)
+        if not 0 <= n <= MAX_PAGE_SIZE:
+            raise ValueError(f'n must be between 0 and {MAX_PAGE_SIZE}, got {n}. Use the cursor to read the next nodes')
+        after = decode_cursor(cursor) if cursor is not None else None
+        # Checking the data version may query the database, so it runs in a thread
+        if not await asyncio.to_thread(top_nodes_cache.is_fresh):
+            await self.load_top_nodes_cache()
+        return top_nodes_cache.get(n, cluster, after)
+
+    async def load_top_nodes_cache(self):
+        """Fills the top nodes cache with every job in the database, once for all the requests waiting"""
+        if self._cache_lock is None:
+            self._cache_lock = asyncio.Lock()
+        async with self._cache_lock:
+            if await asyncio.to_thread(top_nodes_cache.is_fresh):
+                return
+            # Read before the jobs, so a load that bumps it while they are read leaves the cache stale
+            version = await asyncio.to_thread(get_data_version)
+            records = await self._read(ALL_NODES_QUERY)
+            # Sorting every job takes a while, so it doesn't run on the event loop
+            await asyncio.to_thread(top_nodes_cache.fill, [record['JobId'] for record in records], [record['cluster'] for record in records],
+                                    [record['membershipScore'] for record in records], version)
+
+    async def get_shortest_path_by_weight(self, jobId1: str, jobId2: str, max_cost=None) -> list:
+        """Retrieves the path between two nodes with the lowest total distance
+
+        Parameters
+        ----------
+        jobId1 : str
+            Job ID of one of the nodes
+        jobId2 : str
+            Job ID of the other node
+        max_cost : float, optional
+            The maximum total distance of the path. The graph engine stops searching past it, the database only
+            filters the path it found (GDS has no cutoff)
+
+        Returns
+        -------
+        list
+            a list of paths (lists of dictionaries containing the job IDs and the membership scores)
+        """
+        if self.use_engine:
+            return (await self._engine()).shortest_path_by_weight(jobId1, jobId2, max_cost)
+        if max_cost is not None:
+            return self._paths(await self._read(SHORTEST_PATH_BY_WEIGHT_QUERY, jobId1=jobId1, jobId2=jobId2, maxCost=max_cost))
+        results = await asyncio.to_thread(path_cache.get, 'weight', jobId1, jobId2)     # may read the SQLite store
+        if results is None:
+            version = await asyncio.to_thread(get_data_version)     # the paths are not cached if a load bumps it meanwhile
+            results = self._paths(await self._read(SHORTEST_PATH_BY_WEIGHT_QUERY, jobId1=jobId1, jobId2=jobId2, maxCost=None))
+            await asyncio.to_thread(path_cache.set, 'weight', jobId1, jobId2, results, version)
+        return results
+
+    async def get_shortest_path_by_num_nodes(self, jobId1: str, jobId2: str) -> list:
+        """Retrieves the path between two nodes with the fewest nodes
+
+        Parameters
+        ----------
+        jobId1 : str
+            Job ID of one of the nodes
+        jobId2 : str
+            Job ID of the other node
+
+        Returns
+        -------
+        list
+            a list of paths (lists of dictionaries containing the job IDs and the membership scores)
+        """
+        if self.use_engine:
+            return (await self._engine()).shortest_path_by_num_nodes(jobId1, jobId2)
+        results = await asyncio.to_thread(path_cache.get, 'num_nodes', jobId1, jobId2)
+        if results is None:
+            version = await asyncio.to_thread(get_data_version)
+            results = self._paths(await self._read(SHORTEST_PATH_BY_NUM_NODES_QUERY, jobId1=jobId1, jobId2=jobId2))
+            await asyncio.to_thread(path_cache.set, 'num_nodes', jobId1, jobId2, results, version)
+        return results
+
+    async def get_similar_jobs(self, jobId: str, k=10) -> list:
+        """Retrieves the most similar jobs of a job from the neighbour index, without going to the database
+
+        Parameters
+        ----------
+        jobId : str
+            Job ID of the job
+        k : int, optional
+            The number of jobs to retrieve
+
+        Returns
+        -------
+        list
+            a list of dictionaries containing the job IDs and the similarity scores, from the most similar
+        """
+        if k < 0:
+            raise ValueError(f'k must be 0 or greater, got {k}')
+        index = get_neighbour_index()
+        if index is None:
+            raise ValueError('The similar jobs index has not been built')
+        return index.get(jobId, k)
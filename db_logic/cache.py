@@ -0,0 +1,347 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+from neo4j.exceptions import DriverError, Neo4jError
+from db_logic.driver import get_driver
+
+# The data version is bumped by the loader every time the data in the database changes, so the caches
+# filled before can tell they are stale. It is kept in the database (the DataVersion node), so the serving
+# processes also see the changes of a loader run from the command line. Each process reads it at most
+# once every DATA_VERSION_CHECK_INTERVAL seconds
+DATA_VERSION_CHECK_INTERVAL = float(os.environ.get('DATA_VERSION_CHECK_INTERVAL', 5))
+
+DATA_VERSION_QUERY = '''
+    MATCH (version:DataVersion)
+    RETURN version.version AS version
+'''
+
+BUMP_DATA_VERSION_QUERY = '''
+    MERGE (version:DataVersion)
+    SET version.version = coalesce(version.version, 0) + 1
+    RETURN version.version AS version
+'''
+
+_data_version = 0
+_checked_at = None
+_version_lock = threading.Lock()
+
+def get_data_version() -> int:
+    """Returns the current data version
+
+    The version is read from the database when the last read is older than DATA_VERSION_CHECK_INTERVAL
+    seconds. If the database can't be reached, the last version read is returned
+
+    Returns
+    -------
+    int
+        The data version, 0 if the data was never loaded
+    """
+    global _data_version, _checked_at
+    if _checked_at is not None and time.monotonic() - _checked_at < DATA_VERSION_CHECK_INTERVAL:
+        return _data_version
+    with _version_lock:
+        if _checked_at is None or time.monotonic() - _checked_at >= DATA_VERSION_CHECK_INTERVAL:
+            try:
+                with get_driver().session() as session:
+                    record = session.run(DATA_VERSION_QUERY).single()    # auto-commit, so it fails right away
+                _data_version = record['version'] if record is not None else 0
+            except (DriverError, Neo4jError, OSError):
+                pass
+            _checked_at = time.monotonic()
+        return _data_version
+
+def bump_data_version() -> int:
+    """Marks every cache filled so far as stale, in every process
+
+    Returns
+    -------
+    int
+        The new data version
+    """
+    global _data_version, _checked_at
+    with _version_lock:
+        with get_driver().session() as session:
+            _data_version = session.execute_write(lambda transaction: transaction.run(BUMP_DATA_VERSION_QUERY).single()['version'])
+        _checked_at = time.monotonic()
+        return _data_version
+
+
+class TopNodesCache:
+    """
+    In-memory top N nodes of every cluster
+
+    Keeps one array of job IDs and one of membership scores per cluster, sorted by membership score
+    (descending, ties by job ID), so the top N nodes are a slice of the arrays. A page after a given node
+    starts where a binary search finds the node
+
+    ...
+    Methods
+    -------
+    is_fresh() -> bool
+        Checks if the cache was filled with the current data version
+
+    fill(job_ids, clusters, scores, version: int)
+        Replaces the contents of the cache
+
+    fill_from_frame(df, version: int)
+        Replaces the contents of the cache with the jobs of a processed DataFrame
+
+    get(n: int, cluster: str, after: list) -> list
+        Returns the top N nodes of a cluster, optionally after a membership score and job ID
+    """
+
+    def __init__(self) -> None:
+        self.version = None
+        self.clusters = {}
+        self.lock = threading.Lock()
+
+    def is_fresh(self) -> bool:
+        """Checks if the cache was filled with the current data version"""
+        return self.version == get_data_version()
+
+    def fill(self, job_ids, clusters, scores, version=None) -> None:
+        """Replaces the contents of the cache
+
+        Parameters
+        ----------
+        job_ids : array-like
+            The job ID of each job
+        clusters : array-like
+            The cluster of each job
+        scores : array-like
+            The membership score of each job
+        version : int, optional
+            The data version read before the jobs were read, so a load that bumps the version in between leaves
+            the cache stale. By default the current version, for jobs that can't be older (e.g. just loaded)
+        """
+        version = get_data_version() if version is None else version
+        jobs = pd.DataFrame({'JobId': job_ids, 'BelongsTo': clusters, 'membershipScore': scores})
+        jobs = jobs.sort_values(['membershipScore', 'JobId'], ascending=[False, True])
+        self.clusters = {
+            cluster: (group['JobId'].to_numpy(), group['membershipScore'].to_numpy(), -group['membershipScore'].to_numpy())
+            for cluster, group in jobs.groupby('BelongsTo', sort=False)
+        }
+        self.version = version
+
+    def fill_from_frame(self, df:pd.DataFrame, version=None) -> None:
+        """Replaces the contents of the cache with the jobs of a processed DataFrame
+
+        Parameters
+        ----------
+        df : DataFrame
+            A DataFrame with the JobId, BelongsTo and MembershipScore columns and one row per job
+        version : int, optional
+            The data version of the jobs (see fill)
+        """
+        self.fill(df['JobId'].to_numpy(), df['BelongsTo'].to_numpy(), df['MembershipScore'].to_numpy(), version)
+
+    def get(self, n: int, cluster: str, after=None) -> list:
+        """Returns the top N nodes of a cluster
+
+        Parameters
+        ----------
+        n : int
+            The top N nodes to retrieve
+        cluster : str
+            The cluster name
+        after : list, optional
+            The membership score and the job ID of the node the result starts after (the last node of the previous page)
+
+        Returns
+        -------
+        list
+            a list of dictionaries containing the job IDs and the membership scores
+        """
+        if cluster not in self.clusters:
+            return []
+        job_ids, scores, negated = self.clusters[cluster]
+        start = 0
+        if after is not None:
+            # The scores are descending, so their negatives are sorted. Ties are sorted by job ID
+            score, jobId = after
+            first, last = np.searchsorted(negated, -score, 'left'), np.searchsorted(negated, -score, 'right')
+            start = first + np.searchsorted(job_ids[first:last], jobId, 'right')
+        return [{'JobId': job_id, 'membershipScore': score}
+                for job_id, score in zip(job_ids[start:start + n].tolist(), scores[start:start + n].tolist())]
+
+
+class PathCache:
+    """
+    LRU cache with expiration for the shortest paths between two jobs
+
+    The graph is projected UNDIRECTED, so the paths from a to b are the paths from b to a reversed: both
+    requests share an entry, stored from the smaller job ID to the bigger one. Optionally the entries are also
+    kept in a SQLite file, which every worker process of the host can read. The cache is cleared when the data
+    version changes
+
+    ...
+    Methods
+    -------
+    get(mode: str, jobId1: str, jobId2: str) -> list
+        Returns the cached paths or None
+
+    set(mode: str, jobId1: str, jobId2: str, paths: list, version: int)
+        Caches the paths, unless the data changed since they were computed
+
+    clear()
+        Removes every entry
+
+    stats() -> dict
+        Returns the hits, misses and size of the cache
+    """
+
+    def __init__(self, maxsize=10000, ttl=3600, store_path=None) -> None:
+        """
+        Parameters
+        ----------
+        maxsize : int, optional
+            The number of entries kept in memory (and in the store)
+        ttl : float, optional
+            The seconds an entry is valid for
+        store_path : str, optional
+            The location of a SQLite file shared by the processes. None keeps the entries only in memory
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.store_path = store_path
+        self.entries = OrderedDict()    # key -> (expires, paths), least recently used first
+        self.lock = threading.RLock()
+        self.version = None     # the data version of the entries, read on first use
+        self.hits = 0
+        self.misses = 0
+        self._store = None
+        self._store_pid = None
+        self._sets = 0
+
+    @staticmethod
+    def _key(mode, jobId1, jobId2):
+        """Returns the key of a pair of jobs and whether the paths must be reversed"""
+        if jobId1 <= jobId2:
+            return (mode, jobId1, jobId2), False
+        return (mode, jobId2, jobId1), True
+
+    @staticmethod
+    def _orient(paths, reverse):
+        return [list(reversed(path)) for path in paths] if reverse else paths
+
+    def _get_store(self):
+        """Returns the connection to the SQLite store of the current process, creating the table on first use"""
+        if self._store is None or self._store_pid != os.getpid():
+            self._store = sqlite3.connect(self.store_path, timeout=5, check_same_thread=False, isolation_level=None)
+            self._store.execute('PRAGMA journal_mode=WAL')
+            self._store.execute('''CREATE TABLE IF NOT EXISTS paths (
+                mode TEXT, job1 TEXT, job2 TEXT, paths TEXT, expires REAL, PRIMARY KEY (mode, job1, job2))''')
+            self._store_pid = os.getpid()
+        return self._store
+
+    def _check_version(self):
+        # Every process clears the (shared) store when it sees a new version, which also drops the entries
+        # that other processes wrote before they saw it
+        version = get_data_version()
+        if self.version is None:
+            self.version = version
+        elif self.version != version:
+            self.clear()
+
+    def get(self, mode: str, jobId1: str, jobId2: str):
+        """Returns the cached paths between two jobs
+
+        Parameters
+        ----------
+        mode : str
+            What the paths minimise (e.g. 'weight' or 'num_nodes')
+        jobId1 : str
+            Job ID of the source node
+        jobId2 : str
+            Job ID of the target node
+
+        Returns
+        -------
+        list
+            the paths from jobId1 to jobId2 or None if they are not cached
+        """
+        key, reverse = self._key(mode, jobId1, jobId2)
+        now = time.monotonic()
+        with self.lock:
+            self._check_version()
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] > now:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self._orient(entry[1], reverse)
+            if self.store_path:
+                row = self._get_store().execute(
+                    'SELECT paths, expires FROM paths WHERE mode=? AND job1=? AND job2=? AND expires>?', (*key, time.time())).fetchone()
+                if row is not None:
+                    paths = json.loads(row[0])
+                    self._remember(key, paths, now + row[1] - time.time())
+                    self.hits += 1
+                    return self._orient(paths, reverse)
+            self.misses += 1
+            return None
+
+    def _remember(self, key, paths, expires):
+        """Adds an entry in memory, evicting the least recently used if the cache is full"""
+        self.entries[key] = (expires, paths)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def set(self, mode: str, jobId1: str, jobId2: str, paths: list, version=None) -> None:
+        """Caches the paths between two jobs, unless the data version changed since they were computed
+
+        Parameters
+        ----------
+        mode : str
+            What the paths minimise (e.g. 'weight' or 'num_nodes')
+        jobId1 : str
+            Job ID of the source node
+        jobId2 : str
+            Job ID of the target node
+        paths : list
+            The paths from jobId1 to jobId2
+        version : int, optional
+            The data version read before the paths were computed. If a load bumped it since, the paths may be
+            of the old data and are not cached. By default the paths are cached
+        """
+        key, reverse = self._key(mode, jobId1, jobId2)
+        paths = self._orient(paths, reverse)
+        with self.lock:
+            self._check_version()
+            if version is not None and version != self.version:
+                return
+            self._remember(key, paths, time.monotonic() + self.ttl)
+            if self.store_path:
+                store = self._get_store()
+                store.execute('INSERT OR REPLACE INTO paths VALUES (?, ?, ?, ?, ?)', (*key, json.dumps(paths), time.time() + self.ttl))
+                self._sets += 1
+                if self._sets % 100 == 0:   # trim the store now and then, dropping expired and then the oldest entries
+                    store.execute('DELETE FROM paths WHERE expires<=?', (time.time(),))
+                    store.execute('''DELETE FROM paths WHERE rowid IN (
+                        SELECT rowid FROM paths ORDER BY expires DESC LIMIT -1 OFFSET ?)''', (self.maxsize,))
+
+    def clear(self) -> None:
+        """Removes every entry, also from the store"""
+        with self.lock:
+            self.entries.clear()
+            if self.store_path:
+                self._get_store().execute('DELETE FROM paths')
+            self.version = get_data_version()
+
+    def stats(self) -> dict:
+        """Returns the hits, misses and number of entries in memory"""
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self.entries)}
+
+
+# Shared by every request of the process
+top_nodes_cache = TopNodesCache()
+path_cache = PathCache(
+    maxsize=int(os.environ.get('PATH_CACHE_SIZE', 10000)),
+    ttl=float(os.environ.get('PATH_CACHE_TTL', 3600)),
+    store_path=os.environ.get('PATH_CACHE_STORE') or None,
+)
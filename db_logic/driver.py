@@ -0,0 +1,109 @@
+import atexit
+import os
+import threading
+from neo4j import AsyncGraphDatabase, GraphDatabase
+
+# Connection settings, they can be overridden with environment variables
+URI = os.environ.get('NEO4J_URI', 'bolt://database:7687')
+AUTH = (os.environ.get('NEO4J_USER', 'neo4j'), os.environ.get('NEO4J_PASSWORD', 'your_password'))
+MAX_CONNECTION_POOL_SIZE = int(os.environ.get('NEO4J_MAX_CONNECTION_POOL_SIZE', 50))
+CONNECTION_ACQUISITION_TIMEOUT = float(os.environ.get('NEO4J_CONNECTION_ACQUISITION_TIMEOUT', 10))   # seconds
+MAX_CONNECTION_LIFETIME = float(os.environ.get('NEO4J_MAX_CONNECTION_LIFETIME', 3600))              # seconds
+
+_driver = None
+_driver_pid = None
+_lock = threading.Lock()
+
+# One driver (and connection pool) per process, shared by every request
+def get_driver():
+    """Returns the driver of the current process, creating it on first use
+
+    A process forked from another one (e.g. a gunicorn worker) gets its own driver, as connections
+    can't be shared between processes
+
+    Returns
+    -------
+    Driver
+        The shared Neo4j driver
+    """
+    global _driver, _driver_pid
+    with _lock:
+        if _driver is None or _driver_pid != os.getpid():
+            _driver = GraphDatabase.driver(
+                URI,
+                auth=AUTH,
+                max_connection_pool_size=MAX_CONNECTION_POOL_SIZE,
+                connection_acquisition_timeout=CONNECTION_ACQUISITION_TIMEOUT,
+                max_connection_lifetime=MAX_CONNECTION_LIFETIME,
+            )
+            _driver_pid = os.getpid()
+        return _driver
+
+# Closes the connections of the shared driver when the process exits
+@atexit.register
+def close_driver():
+    """Closes the driver of the current process, if it was created"""
+    global _driver, _driver_pid
+    with _lock:
+        if _driver is not None and _driver_pid == os.getpid():
+            _driver.close()
+        _driver = None
+        _driver_pid = None
+
+# Connections of the pool of the shared driver, for the metrics
+def get_pool_stats() -> dict:
+    """Returns the connections of the pool of the shared driver, in use and idle
+
+    The driver doesn't expose its pool, so this reads its internals and returns an empty dictionary
+    if they change (or the driver hasn't been created)
+
+    Returns
+    -------
+    dict
+        the number of connections in use and idle, and the maximum size of the pool
+    """
+    driver = _driver
+    if driver is None or _driver_pid != os.getpid():
+        return {}
+    try:
+        pool = driver._pool
+        with pool.lock:
+            connections = [connection for address in pool.connections for connection in pool.connections[address]]
+        in_use = sum(bool(connection.in_use) for connection in connections)
+    except AttributeError:
+        return {}
+    return {'in_use': in_use, 'idle': len(connections) - in_use, 'max': MAX_CONNECTION_POOL_SIZE}
+
+_async_driver = None
+_async_driver_pid = None
+
+# The async driver of the ASGI app, also one per process
+def get_async_driver():
+    """Returns the async driver of the current process, creating it on first use
+
+    Must be called from the event loop of the process
+
+    Returns
+    -------
+    AsyncDriver
+        The shared async Neo4j driver
+    """
+    global _async_driver, _async_driver_pid
+    if _async_driver is None or _async_driver_pid != os.getpid():
+        _async_driver = AsyncGraphDatabase.driver(
+            URI,
+            auth=AUTH,
+            max_connection_pool_size=MAX_CONNECTION_POOL_SIZE,
+            connection_acquisition_timeout=CONNECTION_ACQUISITION_TIMEOUT,
+            max_connection_lifetime=MAX_CONNECTION_LIFETIME,
+        )
+        _async_driver_pid = os.getpid()
+    return _async_driver
+
+async def close_async_driver():
+    """Closes the async driver of the current process, if it was created"""
+    global _async_driver, _async_driver_pid
+    if _async_driver is not None and _async_driver_pid == os.getpid():
+        await _async_driver.close()
+    _async_driver = None
+    _async_driver_pid = None
@@ -0,0 +1,399 @@
+import heapq
+import threading
+import numpy as np
+from db_logic.cache import get_data_version
+
+
+class GraphEngine:
+    """
+    In-process copy of the similarity graph to answer path queries without going to the database
+
+    The graph is UNDIRECTED (like the projection in the Graph Catalog) and stored as CSR adjacency in numpy
+    arrays: the neighbours of node i are indices[indptr[i]:indptr[i + 1]] and the costs of the edges to them
+    are costs[indptr[i]:indptr[i + 1]]. Job IDs are mapped to node numbers with a dictionary
+
+    ...
+    Methods
+    -------
+    from_frames(nodes_df: DataFrame, edges_df: DataFrame) -> GraphEngine
+        Builds the engine from the processed DataFrames
+
+    from_database(driver: Driver) -> GraphEngine
+        Builds the engine from the jobs and relationships in the database
+
+    shortest_path_by_weight(jobId1: str, jobId2: str) -> list
+        Finds the path with the lowest total cost with a bidirectional Dijkstra
+
+    shortest_path_by_num_nodes(jobId1: str, jobId2: str) -> list
+        Finds the path with the fewest nodes with a bidirectional breadth first search
+
+    shortest_paths_from(jobId: str, targets: list, by_weight: bool) -> dict
+        Finds the paths from a job to several jobs with a single traversal
+
+    reachable_from(jobId: str, by_weight: bool, max_hops: int, max_cost: float) -> list
+        Finds every job within a number of hops or a cost of a job with a single traversal
+    """
+
+    def __init__(self, job_ids, membership_scores, sources, targets, costs) -> None:
+        """
+        Parameters
+        ----------
+        job_ids : array-like
+            The job ID of each node
+        membership_scores : array-like
+            The membership score of each node
+        sources : numpy.ndarray
+            The node number of one end of each edge
+        targets : numpy.ndarray
+            The node number of the other end of each edge
+        costs : numpy.ndarray
+            The cost of each edge, must not be negative
+        """
+        self.job_ids = list(job_ids)
+        self.membership_scores = np.asarray(membership_scores, dtype=np.float64).tolist()
+        self.index = {job_id: node for node, job_id in enumerate(self.job_ids)}
+        self.version = get_data_version()
+
+        # Every edge is stored in both directions, grouped by the node it starts from
+        num_nodes = len(self.job_ids)
+        starts = np.concatenate((sources, targets)).astype(np.int64)
+        ends = np.concatenate((targets, sources)).astype(np.int32)
+        edge_costs = np.concatenate((costs, costs)).astype(np.float64)
+        order = np.argsort(starts, kind='stable')
+        self.indices = ends[order]
+        self.costs = edge_costs[order]
+        self.indptr = np.zeros(num_nodes + 1, dtype=np.int64)
+        np.cumsum(np.bincount(starts, minlength=num_nodes), out=self.indptr[1:])
+
+    @classmethod
+    def from_frames(cls, nodes_df, edges_df):
+        """Builds the engine from the processed DataFrames
+
+        Parameters
+        ----------
+        nodes_df : DataFrame
+            A DataFrame with the JobId and MembershipScore columns and one row per job
+        edges_df : DataFrame
+            A DataFrame with the JobId, SimilarJobId and Distance columns and one row per relationship
+
+        Returns
+        -------
+        GraphEngine
+            the engine
+        """
+        index = {job_id: node for node, job_id in enumerate(nodes_df['JobId'].tolist())}
+        sources = np.fromiter((index[job_id] for job_id in edges_df['JobId'].tolist()), dtype=np.int64, count=len(edges_df))
+        targets = np.fromiter((index[job_id] for job_id in edges_df['SimilarJobId'].tolist()), dtype=np.int64, count=len(edges_df))
+        # The costs are the distances, the same property gds.shortestPath.dijkstra uses
+        return cls(nodes_df['JobId'].tolist(), nodes_df['MembershipScore'].to_numpy(), sources, targets,
+                   edges_df['Distance'].to_numpy())
+
+    @classmethod
+    def from_database(cls, driver):
+        """Builds the engine from the jobs and relationships in the database
+
+        Parameters
+        ----------
+        driver : Driver
+            The Neo4j driver
+
+        Returns
+        -------
+        GraphEngine
+            the engine
+        """
+        with driver.session() as session:
+            nodes = session.execute_read(lambda transaction: transaction.run(NODES_QUERY).values())
+            edges = session.execute_read(lambda transaction: transaction.run(EDGES_QUERY).values())
+        job_ids = [job_id for job_id, _ in nodes]
+        index = {job_id: node for node, job_id in enumerate(job_ids)}
+        sources = np.fromiter((index[source] for source, _, _ in edges), dtype=np.int64, count=len(edges))
+        targets = np.fromiter((index[target] for _, target, _ in edges), dtype=np.int64, count=len(edges))
+        costs = np.fromiter((distance for _, _, distance in edges), dtype=np.float64, count=len(edges))
+        return cls(job_ids, [score for _, score in nodes], sources, targets, costs)
+
+    def _node(self, node: int) -> dict:
+        return {'JobId': self.job_ids[node], 'membershipScore': self.membership_scores[node]}
+
+    def _neighbours(self, node: int):
+        start, end = self.indptr[node], self.indptr[node + 1]
+        return zip(self.indices[start:end].tolist(), self.costs[start:end].tolist())
+
+    def _build_path(self, meeting: int, parents_forward: dict, parents_backward: dict) -> list:
+        """Joins the halves of a path found by a bidirectional search at the meeting node"""
+        path = []
+        node = meeting
+        while node is not None:
+            path.append(node)
+            node = parents_forward[node]
+        path.reverse()
+        node = parents_backward[meeting]
+        while node is not None:
+            path.append(node)
+            node = parents_backward[node]
+        return [self._node(node) for node in path]
+
+    def shortest_path_by_num_nodes(self, jobId1: str, jobId2: str) -> list:
+        """Finds the path with the fewest nodes between two jobs
+
+        Runs a breadth first search from both ends at the same time, expanding the smaller frontier
+
+        Parameters
+        ----------
+        jobId1 : str
+            Job ID of the source node
+        jobId2 : str
+            Job ID of the target node
+
+        Returns
+        -------
+        list
+            a list with the path (a list of dictionaries containing the job IDs and the membership scores),
+            empty if the jobs are unknown or not connected
+        """
+        if jobId1 not in self.index or jobId2 not in self.index:
+            return []
+        source, target = self.index[jobId1], self.index[jobId2]
+        parents_forward, parents_backward = {source: None}, {target: None}
+        frontier_forward, frontier_backward = [source], [target]
+        if source == target:
+            return [self._build_path(source, parents_forward, parents_backward)]
+
+        while frontier_forward and frontier_backward:
+            forward = len(frontier_forward) <= len(frontier_backward)
+            frontier = frontier_forward if forward else frontier_backward
+            parents, others = (parents_forward, parents_backward) if forward else (parents_backward, parents_forward)
+            next_frontier = []
+            for node in frontier:
+                for neighbour, _ in self._neighbours(node):
+                    if neighbour in parents:
+                        continue
+                    parents[neighbour] = node
+                    if neighbour in others:
+                        return [self._build_path(neighbour, parents_forward, parents_backward)]
+                    next_frontier.append(neighbour)
+            if forward:
+                frontier_forward = next_frontier
+            else:
+                frontier_backward = next_frontier
+        return []
+
+    def shortest_path_by_weight(self, jobId1: str, jobId2: str, max_cost=None) -> list:
+        """Finds the path with the lowest total cost between two jobs
+
+        Runs Dijkstra from both ends, alternating between them, and stops when the sum of the smallest
+        tentative distances of both sides can't improve the best path found or is over max_cost
+
+        Parameters
+        ----------
+        jobId1 : str
+            Job ID of the source node
+        jobId2 : str
+            Job ID of the target node
+        max_cost : float, optional
+            The maximum total cost of the path
+
+        Returns
+        -------
+        list
+            a list with the path (a list of dictionaries containing the job IDs and the membership scores),
+            empty if the jobs are unknown, not connected or the path costs more than max_cost
+        """
+        if jobId1 not in self.index or jobId2 not in self.index:
+            return []
+        source, target = self.index[jobId1], self.index[jobId2]
+        max_cost = float('inf') if max_cost is None else max_cost
+        distances = ({source: 0.0}, {target: 0.0})
+        parents = ({source: None}, {target: None})
+        heaps = ([(0.0, source)], [(0.0, target)])
+        settled = (set(), set())
+        best, meeting = (0.0, source) if source == target else (float('inf'), None)
+
+        while heaps[0] and heaps[1] and heaps[0][0][0] + heaps[1][0][0] < best and heaps[0][0][0] + heaps[1][0][0] <= max_cost:
+            side = 0 if heaps[0][0][0] <= heaps[1][0][0] else 1
+            distance, node = heapq.heappop(heaps[side])
+            if node in settled[side]:
+                continue
+            settled[side].add(node)
+            for neighbour, cost in self._neighbours(node):
+                new_distance = distance + cost
+                if new_distance < distances[side].get(neighbour, float('inf')):
+                    distances[side][neighbour] = new_distance
+                    parents[side][neighbour] = node
+                    heapq.heappush(heaps[side], (new_distance, neighbour))
+                if neighbour in distances[1 - side]:
+                    total = distances[side][neighbour] + distances[1 - side][neighbour]
+                    if total < best:
+                        best, meeting = total, neighbour
+
+        if meeting is None or best > max_cost:
+            return []
+        return [self._build_path(meeting, parents[0], parents[1])]
+
+    def _single_source(self, source: int, by_weight: bool, targets=None, max_hops=None, max_cost=None):
+        """Runs Dijkstra (by_weight) or a breadth first search from a node
+
+        The search doesn't go past a distance of max_cost, so it stops early. The breadth first search also
+        stops at max_hops edges (its distance is the number of edges). Dijkstra doesn't: a node with too many
+        hops on its cheapest path may be on the cheapest path of a node further away, which must not be
+        reached by a more expensive path with fewer hops instead, so the caller filters the hops
+
+        Parameters
+        ----------
+        source : int
+            The node number to start from
+        by_weight : bool
+            If True, the cost of a path is the sum of the costs of its edges, otherwise its number of edges
+        targets : set, optional
+            The search stops once all these node numbers are reached
+        max_hops : int, optional
+            The maximum number of edges of the shortest paths, only used by the breadth first search
+        max_cost : float, optional
+            The maximum distance of the shortest paths
+
+        Returns
+        -------
+        tuple
+            the list of nodes reached (in order of distance), a dictionary with their distances, a dictionary
+            with their parents in the shortest path tree and a dictionary with their number of hops
+        """
+        remaining = set(targets) if targets is not None else None
+        max_cost = float('inf') if max_cost is None else max_cost
+        distances, parents, hops = {source: 0.0}, {source: None}, {source: 0}
+        reached = []
+        heap = [(0.0, source)]
+        while heap:
+            distance, node = heapq.heappop(heap)
+            if distance > distances[node]:
+                continue    # already reached with a lower cost
+            reached.append(node)
+            if remaining is not None:
+                remaining.discard(node)
+                if not remaining:
+                    break
+            if max_hops is not None and not by_weight and hops[node] >= max_hops:
+                continue
+            for neighbour, cost in self._neighbours(node):
+                new_distance = distance + (cost if by_weight else 1.0)
+                if new_distance <= max_cost and new_distance < distances.get(neighbour, float('inf')):
+                    distances[neighbour] = new_distance
+                    parents[neighbour] = node
+                    hops[neighbour] = hops[node] + 1
+                    heapq.heappush(heap, (new_distance, neighbour))
+        return reached, distances, parents, hops
+
+    def _path_to(self, node: int, parents: dict) -> list:
+        """Follows the parents from a node to the source of a search"""
+        path = []
+        while node is not None:
+            path.append(node)
+            node = parents[node]
+        path.reverse()
+        return [self._node(node) for node in path]
+
+    def shortest_paths_from(self, jobId: str, targets: list, by_weight=True) -> dict:
+        """Finds the shortest paths from a job to several jobs with a single traversal
+
+        Parameters
+        ----------
+        jobId : str
+            Job ID of the source node
+        targets : list
+            Job IDs of the target nodes
+        by_weight : bool, optional
+            If True, the paths with the lowest total cost are found, otherwise the paths with the fewest nodes
+
+        Returns
+        -------
+        dict
+            a dictionary from each target Job ID to a list with its path (a list of dictionaries containing the job IDs
+            and the membership scores), the list is empty if the jobs are unknown or not connected
+        """
+        paths = {target: [] for target in targets}
+        known = [target for target in paths if target in self.index]
+        if jobId not in self.index or not known:
+            return paths
+        _, _, parents, _ = self._single_source(self.index[jobId], by_weight, {self.index[target] for target in known})
+        for target in known:
+            if self.index[target] in parents:
+                paths[target] = [self._path_to(self.index[target], parents)]
+        return paths
+
+    def reachable_from(self, jobId: str, by_weight=True, max_hops=None, max_cost=None) -> list:
+        """Finds every job whose shortest path from a job is within the limits, with a single traversal
+
+        Like the single source query of the database, the shortest path of each job is found first and the job
+        is left out if that path has more than max_hops edges, even if a more expensive path has fewer
+
+        Parameters
+        ----------
+        jobId : str
+            Job ID of the source node
+        by_weight : bool, optional
+            If True, the cost of a path is the sum of the costs of its edges, otherwise its number of edges
+        max_hops : int, optional
+            The maximum number of edges of the shortest paths
+        max_cost : float, optional
+            The maximum cost of the shortest paths
+
+        Returns
+        -------
+        list
+            a list of dictionaries containing the job IDs, the membership scores, the cost and the number of hops
+            of the shortest path of each job reached (without the source), sorted by cost and job ID
+        """
+        if jobId not in self.index:
+            return []
+        source = self.index[jobId]
+        reached, distances, _, hops = self._single_source(source, by_weight, max_hops=max_hops, max_cost=max_cost)
+        jobs = [dict(self._node(node), cost=distances[node], hops=hops[node]) for node in reached
+                if node != source and (max_hops is None or hops[node] <= max_hops)]
+        jobs.sort(key=lambda job: (job['cost'], job['JobId']))
+        return jobs
+
+
+NODES_QUERY = '''
+    MATCH (job:Job)
+    RETURN job.JobId, job.membershipScore
+'''
+
+EDGES_QUERY = '''
+    MATCH (job1:Job)-[r:IS_SIMILAR_TO]->(job2:Job)
+    RETURN job1.JobId, job2.JobId, r.distance
+'''
+
+# The engine of the process, replaced when the data changes
+_engine = None
+_engine_lock = threading.Lock()
+
+def get_engine():
+    """Returns the engine of the process or None if there is none or it was built with an older data version"""
+    engine = _engine
+    if engine is None or engine.version != get_data_version():
+        return None
+    return engine
+
+def set_engine(engine: GraphEngine) -> None:
+    """Replaces the engine of the process"""
+    global _engine
+    _engine = engine
+
+def load_engine(driver) -> GraphEngine:
+    """Returns the engine of the process, building it from the database if it is missing or stale
+
+    Parameters
+    ----------
+    driver : Driver
+        The Neo4j driver
+
+    Returns
+    -------
+    GraphEngine
+        the engine
+    """
+    with _engine_lock:
+        engine = get_engine()
+        if engine is None:
+            engine = GraphEngine.from_database(driver)
+            set_engine(engine)
+        return engine
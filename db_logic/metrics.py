@@ -0,0 +1,146 @@
+import threading
+import time
+from contextlib import contextmanager
+
+# Upper bounds (in seconds) of the buckets of the latency histograms
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# What each metric measures, shown by the /metrics endpoint
+DESCRIPTIONS = {
+    'processing_stage_seconds_total': ('counter', 'Seconds spent in each stage of the data processing'),
+    'processing_stage_rows_total': ('counter', 'Jobs or relationships produced by each stage of the data processing'),
+    'ingest_batch_seconds': ('histogram', 'Seconds to commit a batch of jobs or relationships'),
+    'ingest_rows_total': ('counter', 'Jobs or relationships committed to the database'),
+    'ingest_retries_total': ('counter', 'Batches retried after a transient error (e.g. a deadlock)'),
+    'http_request_duration_seconds': ('histogram', 'Seconds to answer a request, by endpoint and status'),
+    'neo4j_query_seconds': ('histogram', 'Seconds waiting for the database, by query'),
+    'serialization_seconds': ('histogram', 'Seconds encoding the responses as JSON, by endpoint'),
+    'neo4j_pool_connections': ('gauge', 'Connections of the pool of the shared driver, by state'),
+    'neo4j_pool_max_connections': ('gauge', 'Maximum size of the pool of the shared driver'),
+    'path_cache_events_total': ('counter', 'Hits and misses of the path cache'),
+    'path_cache_entries': ('gauge', 'Pairs of jobs kept in the path cache'),
+}
+
+
+class Metrics:
+    """
+    In-process counters, gauges and histograms, rendered in the Prometheus text format
+
+    Every metric has a name (see DESCRIPTIONS) and a set of labels. Everything is kept in dictionaries
+    behind a lock, which is cheap enough to be updated on every request and batch. Each worker process
+    has its own metrics
+
+    ...
+    Methods
+    -------
+    inc(name: str, value: float, **labels)
+        Adds value to a counter
+
+    set(name: str, value: float, **labels)
+        Sets the value of a gauge
+
+    observe(name: str, value: float, **labels)
+        Adds a value to a histogram
+
+    timer(name: str, **labels)
+        Context manager that adds the seconds of its block to a histogram
+
+    stage(stage: str)
+        Context manager that adds the seconds of its block to the processing_stage_seconds_total counter
+
+    render() -> str
+        Returns every metric in the Prometheus text format
+    """
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.values = {}        # (name, labels) -> value of counters and gauges
+        self.histograms = {}    # (name, labels) -> [bucket counts, sum, count]
+
+    @staticmethod
+    def _key(name: str, labels: dict):
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name: str, value=1, **labels) -> None:
+        """Adds value to a counter"""
+        key = self._key(name, labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def set(self, name: str, value, **labels) -> None:
+        """Sets the value of a gauge"""
+        with self.lock:
+            self.values[self._key(name, labels)] = value
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        """Adds a value to a histogram"""
+        key = self._key(name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [[0] * len(BUCKETS), 0.0, 0]
+            for bucket, bound in enumerate(BUCKETS):
+                if value <= bound:
+                    histogram[0][bucket] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    @contextmanager
+    def timer(self, name: str, **labels):
+        """Adds the seconds spent in the with block to a histogram"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    @contextmanager
+    def stage(self, stage: str):
+        """Adds the seconds spent in the with block to a stage of the data processing"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.inc('processing_stage_seconds_total', time.perf_counter() - start, stage=stage)
+
+    @staticmethod
+    def _labels(labels, extra=()) -> str:
+        labels = tuple(labels) + tuple(extra)
+        if not labels:
+            return ''
+        escape = lambda value: str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        return '{' + ','.join(f'{name}="{escape(value)}"' for name, value in labels) + '}'
+
+    def render(self) -> str:
+        """Returns every metric in the Prometheus text exposition format
+
+        Returns
+        -------
+        str
+            the metrics, one sample per line
+        """
+        with self.lock:
+            values = dict(self.values)
+            histograms = {key: (list(buckets), total, count) for key, (buckets, total, count) in self.histograms.items()}
+
+        lines = []
+        names = sorted({name for name, _ in values} | {name for name, _ in histograms})
+        for name in names:
+            kind, description = DESCRIPTIONS.get(name, ('untyped', name))
+            lines.append(f'# HELP {name} {description}')
+            lines.append(f'# TYPE {name} {kind}')
+            for (metric, labels), value in sorted(values.items()):
+                if metric == name:
+                    lines.append(f'{name}{self._labels(labels)} {value}')
+            for (metric, labels), (buckets, total, count) in sorted(histograms.items()):
+                if metric == name:
+                    for bound, bucket_count in zip(BUCKETS, buckets):
+                        lines.append(f'{name}_bucket{self._labels(labels, [("le", bound)])} {bucket_count}')
+                    lines.append(f'{name}_bucket{self._labels(labels, [("le", "+Inf")])} {count}')
+                    lines.append(f'{name}_sum{self._labels(labels)} {total}')
+                    lines.append(f'{name}_count{self._labels(labels)} {count}')
+        return '\n'.join(lines) + '\n'
+
+
+# The metrics of the process
+metrics = Metrics()
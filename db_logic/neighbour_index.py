@@ -0,0 +1,181 @@
+import os
+import threading
+import time
+import numpy as np
+from db_logic.artifacts import ARTIFACTS_DIR, get_current_artifacts
+
+# The index is written with the other artifacts of the data processing, in the neighbours directory of
+# each version. NEIGHBOUR_INDEX_DIR reads an index from somewhere else
+NEIGHBOUR_INDEX_DIR = os.environ.get('NEIGHBOUR_INDEX_DIR')
+
+# The serving processes look for a newer version of the artifacts (a new CURRENT) at most once every
+# NEIGHBOUR_INDEX_CHECK_INTERVAL seconds
+NEIGHBOUR_INDEX_CHECK_INTERVAL = float(os.environ.get('NEIGHBOUR_INDEX_CHECK_INTERVAL', 5))
+
+
+class NeighbourIndex:
+    """
+    Most similar jobs of every job, precomputed by the data processing
+
+    Stored as three .npy files that are memory-mapped when loaded, so every worker process of a host shares
+    the same pages: the job IDs sorted (as fixed-width bytes), and for each of them the row numbers (int32)
+    and similarities (float32) of its k most similar jobs, from the most similar. A job is found with a binary
+    search on the sorted IDs and its neighbours are a row of the matrices
+
+    ...
+    Methods
+    -------
+    save(directory: str, job_ids, neighbours, scores)
+        Writes an index to a directory
+
+    load(directory: str) -> NeighbourIndex
+        Memory-maps an index written by save
+
+    get(jobId: str, k: int) -> list
+        Returns the k most similar jobs of a job
+    """
+
+    FILES = ('job_ids.npy', 'neighbours.npy', 'scores.npy')
+
+    def __init__(self, job_ids, neighbours, scores) -> None:
+        """
+        Parameters
+        ----------
+        job_ids : numpy.ndarray
+            The job IDs sorted, as bytes
+        neighbours : numpy.ndarray
+            The row numbers of the neighbours of each job, one row per job
+        scores : numpy.ndarray
+            The similarities of the neighbours of each job, one row per job
+        """
+        self.job_ids = job_ids
+        self.neighbours = neighbours
+        self.scores = scores
+
+    @staticmethod
+    def save(directory, job_ids, neighbours, scores) -> None:
+        """Writes an index to a directory, sorting the jobs by ID
+
+        Each file is written next to its final name and then renamed, so processes that have the old
+        files mapped keep reading them
+
+        Parameters
+        ----------
+        directory : str
+            The directory of the index
+        job_ids : array-like
+            The job ID of each row
+        neighbours : numpy.ndarray
+            The row numbers of the neighbours of each row (see calculate_top_neighbours), -1 after the last
+            neighbour of a row that has fewer
+        scores : numpy.ndarray
+            The similarities of the neighbours of each row
+        """
+        job_ids = np.asarray(job_ids)
+        job_ids = job_ids if job_ids.dtype.kind == 'S' else job_ids.astype(str).astype(bytes)
+        order = np.argsort(job_ids, kind='stable')
+        rank = np.empty(len(order), dtype=np.int32)
+        rank[order] = np.arange(len(order), dtype=np.int32)   # new row number of each old row
+
+        os.makedirs(directory, exist_ok=True)
+        neighbours = neighbours[order]
+        arrays = (job_ids[order], np.where(neighbours >= 0, rank[neighbours], -1).astype(np.int32), scores[order].astype(np.float32))
+        for name, array in zip(NeighbourIndex.FILES, arrays):
+            path = os.path.join(directory, name)
+            with open(path + '.tmp', 'wb') as file:
+                np.save(file, array)
+            os.replace(path + '.tmp', path)
+
+    @classmethod
+    def load(cls, directory):
+        """Memory-maps an index written by save
+
+        Parameters
+        ----------
+        directory : str
+            The directory of the index
+
+        Returns
+        -------
+        NeighbourIndex
+            the index
+        """
+        return cls(*(np.load(os.path.join(directory, name), mmap_mode='r') for name in cls.FILES))
+
+    def get(self, jobId: str, k=None) -> list:
+        """Returns the most similar jobs of a job
+
+        Parameters
+        ----------
+        jobId : str
+            Job ID of the job
+        k : int, optional
+            The number of jobs to return, all the ones in the index if None
+
+        Returns
+        -------
+        list
+            a list of dictionaries with the job IDs and the similarity scores, from the most similar.
+            Empty if the job is not in the index
+        """
+        key = jobId.encode()
+        row = np.searchsorted(self.job_ids, key)
+        if row == len(self.job_ids) or self.job_ids[row] != key:
+            return []
+        neighbours = self.neighbours[row, :k]
+        neighbours = neighbours[neighbours >= 0]   # the candidate index may find fewer than k
+        # The float32 scores are returned as the doubles with the same shortest representation (0.65, not 0.6499999761581421)
+        scores = self.scores[row, :len(neighbours)].astype(str).astype(float).tolist()
+        return [{'JobId': job_id.decode(), 'similarityScore': score} for job_id, score in zip(self.job_ids[neighbours], scores)]
+
+
+# The index of the process, loaded on the first request and reloaded when the current artifacts change
+_index = None
+_index_directory = None
+_checked_at = None
+_index_lock = threading.Lock()
+
+def set_neighbour_index(index: NeighbourIndex, directory=None) -> None:
+    """Replaces the index of the process
+
+    Parameters
+    ----------
+    index : NeighbourIndex
+        The index
+    directory : str, optional
+        The directory it was loaded from, so it is not loaded again
+    """
+    global _index, _index_directory
+    with _index_lock:
+        _index, _index_directory = index, directory
+
+def get_neighbour_index(directory=None):
+    """Returns the index of the process, memory-mapping it from directory
+
+    Without a directory, the index of the current artifacts is used: CURRENT is read again when the last read
+    is older than NEIGHBOUR_INDEX_CHECK_INTERVAL, and the index is reloaded when it points to another version
+
+    Parameters
+    ----------
+    directory : str, optional
+        The directory of the index. By default NEIGHBOUR_INDEX_DIR or the index of the current artifacts
+
+    Returns
+    -------
+    NeighbourIndex
+        the index, or None if it has not been built
+    """
+    global _index, _index_directory, _checked_at
+    directory = directory or NEIGHBOUR_INDEX_DIR
+    if directory is None and _checked_at is not None and time.monotonic() - _checked_at < NEIGHBOUR_INDEX_CHECK_INTERVAL:
+        return _index
+    if directory is not None and directory == _index_directory:
+        return _index
+    with _index_lock:
+        if directory is None:
+            key = get_current_artifacts()
+            directory = os.path.join(ARTIFACTS_DIR, key, 'neighbours') if key else ''
+            _checked_at = time.monotonic()
+        if directory != _index_directory and all(os.path.exists(os.path.join(directory, name)) for name in NeighbourIndex.FILES):
+            _index, _index_directory = NeighbourIndex.load(directory), directory
+        return _index
@@ -1,5 +1,204 @@
-from neo4j import GraphDatabase
+import base64
+import binascii
+import bisect
+import json
 from neo4j.exceptions import ServiceUnavailable
+from db_logic.driver import get_driver, close_driver
+from db_logic.cache import top_nodes_cache, path_cache, get_data_version
+from db_logic.graph_engine import load_engine
+from db_logic.neighbour_index import get_neighbour_index
+from db_logic.metrics import metrics
+
+# The clusters are the labels of the jobs. Labels can't be query parameters, so there is a fixed query text per cluster
+CLUSTERS = tuple(f'c{col_num}' for col_num in range(22))
+
+# All the queries take their values as $parameters, so each text is planned once and then reused from the plan cache
+TOP_NODES_QUERIES = {
+    cluster: f'''
+        MATCH (node:{cluster})
+        WHERE $afterScore IS NULL OR node.membershipScore < $afterScore
+            OR (node.membershipScore = $afterScore AND node.JobId > $afterJobId)
+        RETURN node.JobId AS JobId, node.membershipScore AS membershipScore
+        ORDER BY node.membershipScore DESC, node.JobId
+        LIMIT $n
+    '''
+    for cluster in CLUSTERS
+}
+
+# The Dijkstra procedures of GDS have no cost cutoff, so $maxCost only filters the path they stream: the
+# database still runs the whole search. Only the graph engine stops searching past max_cost
+SHORTEST_PATH_BY_WEIGHT_QUERY = '''
+    MATCH (source:Job {JobId:$jobId1}), (target:Job {JobId:$jobId2})
+    CALL gds.shortestPath.dijkstra.stream('myGraph', {
+        sourceNode: source,
+        targetNode: target,
+        relationshipWeightProperty: 'distance'
+    })
+    YIELD index, sourceNode, targetNode, totalCost, nodeIds, costs, path
+    WHERE $maxCost IS NULL OR totalCost <= $maxCost
+    RETURN
+        index,
+        gds.util.asNode(sourceNode).name AS sourceNodeName,
+        gds.util.asNode(targetNode).name AS targetNodeName,
+        totalCost,
+        [nodeId IN nodeIds | gds.util.asNode(nodeId).name] AS nodeNames,
+        costs,
+        nodes(path)
+    ORDER BY index
+'''
+
+SHORTEST_PATH_BY_NUM_NODES_QUERY = '''
+    MATCH (source:Job {JobId:$jobId1}), (target:Job {JobId:$jobId2})
+    MATCH path = shortestPath((source)-[*]-(target))
+    RETURN path,nodes(path)
+'''
+
+# A single Dijkstra from the source gives the paths to every target of the source
+BATCH_PATHS_BY_WEIGHT_QUERY = '''
+    MATCH (source:Job {JobId:$source})
+    MATCH (target:Job) WHERE target.JobId IN $targets
+    WITH source, collect(id(target)) AS targetIds
+    CALL gds.allShortestPaths.dijkstra.stream('myGraph', {
+        sourceNode: source,
+        relationshipWeightProperty: 'distance'
+    })
+    YIELD targetNode, path
+    WITH targetNode, path WHERE targetNode IN targetIds
+    RETURN gds.util.asNode(targetNode).JobId AS JobId, nodes(path)
+'''
+
+BATCH_PATHS_BY_NUM_NODES_QUERY = '''
+    UNWIND $pairs AS pair
+    MATCH (source:Job {JobId:pair[0]}), (target:Job {JobId:pair[1]})
+    WHERE source <> target
+    MATCH path = shortestPath((source)-[*]-(target))
+    RETURN pair[0] AS JobId1, pair[1] AS JobId2, nodes(path)
+'''
+
+# One traversal from the source gives the cost of the shortest path to every job. Without a weight property
+# every edge costs 1, so the cost is the number of hops. The hops are those of the cheapest path of each job, so
+# with a weight a job whose cheapest path is too long is left out (the graph engine does the same)
+SINGLE_SOURCE_QUERY = '''
+    MATCH (source:Job {{JobId:$jobId}})
+    CALL gds.allShortestPaths.dijkstra.stream('myGraph', {{
+        sourceNode: source{weight}
+    }})
+    YIELD targetNode, totalCost, nodeIds
+    WITH source, targetNode, totalCost, size(nodeIds) - 1 AS hops
+    WHERE targetNode <> id(source)
+        AND ($maxCost IS NULL OR totalCost <= $maxCost)
+        AND ($maxHops IS NULL OR hops <= $maxHops)
+    WITH gds.util.asNode(targetNode) AS target, totalCost AS cost, hops
+    WITH target.JobId AS JobId, target.membershipScore AS membershipScore, cost, hops
+    WHERE $afterCost IS NULL OR cost > $afterCost OR (cost = $afterCost AND JobId > $afterJobId)
+    RETURN JobId, membershipScore, cost, hops
+    ORDER BY cost, JobId
+    SKIP $offset
+    LIMIT $limit
+'''
+SINGLE_SOURCE_QUERIES = {
+    'weight': SINGLE_SOURCE_QUERY.format(weight=",\n        relationshipWeightProperty: 'distance'"),
+    'num_nodes': SINGLE_SOURCE_QUERY.format(weight=''),
+}
+
+# Modes of the batch and single source endpoints, what the paths minimise. 'weight' minimises the distance of
+# the edges (-log of the similarity), so the most similar jobs are the closest
+PATH_MODES = ('weight', 'num_nodes')
+MAX_BATCH_PAIRS = 1000
+MAX_PAGE_SIZE = 1000   # also the largest n of the top nodes
+# The sort values of the pages of the top nodes and of the jobs reached from a source, which their cursors keep
+TOP_NODES_ORDER = ('membershipScore', 'JobId')
+PATHS_FROM_SOURCE_ORDER = ('cost', 'JobId')
+
+# The cluster of a job is its only label besides Job
+ALL_NODES_QUERY = '''
+    MATCH (job:Job)
+    RETURN job.JobId AS JobId, [label IN labels(job) WHERE label <> 'Job'][0] AS cluster, job.membershipScore AS membershipScore
+'''
+
+DROP_GRAPH_QUERY = '''
+    CALL gds.graph.drop($graph) YIELD graphName
+    RETURN graphName
+'''
+
+GRAPH_EXISTS_QUERY = '''
+    CALL gds.graph.exists($graph)
+        YIELD graphName, exists
+    RETURN graphName, exists
+'''
+
+# Validates the cluster received by the endpoint, as it is used as a label
+def check_cluster(cluster: str) -> None:
+    """Raises a ValueError if cluster is not one of the known clusters (c0 to c21)
+
+    Parameters
+    ----------
+    cluster : str
+        The cluster name
+    """
+    if cluster not in TOP_NODES_QUERIES:
+        raise ValueError(f'Unknown cluster {cluster!r}, it must be one of c0 to c{len(CLUSTERS) - 1}')
+
+# The pages are found with a keyset: the sort values of the last job of a page, which the next page starts after.
+# Unlike an offset, the jobs before the page are not read again
+def encode_cursor(values) -> str:
+    """Encodes the sort values of the last job of a page as an opaque string for the client
+
+    Parameters
+    ----------
+    values : list
+        The sort values, e.g. the membership score and the job ID
+
+    Returns
+    -------
+    str
+        the cursor
+    """
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+def decode_cursor(cursor: str) -> list:
+    """Decodes a cursor received by an endpoint
+
+    Parameters
+    ----------
+    cursor : str
+        A cursor returned by encode_cursor
+
+    Returns
+    -------
+    list
+        the number and the job ID the page starts after
+
+    Raises
+    ------
+    ValueError
+        If the cursor was not returned by an endpoint
+    """
+    try:
+        value, jobId = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (binascii.Error, UnicodeError, TypeError, ValueError):
+        raise ValueError(f'Invalid cursor {cursor!r}') from None
+    if not isinstance(value, (int, float)) or not isinstance(jobId, str):
+        raise ValueError(f'Invalid cursor {cursor!r}')
+    return [value, jobId]
+
+def get_next_cursor(last: dict, count: int, size: int, keys: tuple):
+    """Returns the cursor of the next page, or None if the page is the last one (it has fewer jobs than requested)
+
+    Parameters
+    ----------
+    last : dict
+        The last job of the page
+    count : int
+        The number of jobs of the page
+    size : int
+        The number of jobs requested
+    keys : tuple
+        The keys of the sort values of the job, e.g. ('membershipScore', 'JobId')
+    """
+    if size == 0 or count < size:
+        return None
+    return encode_cursor([float(last[keys[0]]), last[keys[1]]])
 
 
 
@@ -9,12 +208,19 @@ class Api:
     A class to represent the API
 
     ...
+    Attributes
+    ----------
+    driver : Driver
+        The Neo4j driver shared by every request of the process (see db_logic.driver)
+    use_engine : bool
+        If True, the paths are found by the in-process graph engine (see db_logic.graph_engine) instead of the database
+
     Methods
     -------
     close()
-        Closes the driver
+        Closes the shared driver
 
-    project_graph()
+    project_graph(refresh: bool)
         Projects a graph to the Graph Catalog to allow running functions from gds
 
     check_graph_exists(graph="myGraoh")
@@ -25,67 +231,100 @@ class Api:
         and returns a list of dictionaries containing the job ID and the membership score of the node
     
     get_top_nodes(n, cluster) -> list
-        Method called when a request is made on the endpoint. Creates the database session to run the queries executed by 
-        _get_top_nodes
+        Method called when a request is made on the endpoint. Answers from the in-memory top nodes cache, which is
+        filled with load_top_nodes_cache when the data changes
+
+    load_top_nodes_cache()
+        Fills the top nodes cache with every job in the database
 
     _get_shortest_path_by_weight(transaction: Transaction, jobId1: str, jobId2: str) -> list
         Runs a query to the database to retrieve the shortest path between 2 nodes based on the weight of the edges
         and returns a list of dictionaries containing the job ID and the membership score of the node
 
     get_shortest_path_by_weight(jobId1: str, jobId2: str)
-        Method called when a request is made on the endpoint. Creates the database session to run the queries executed by 
-        _get_shortest_path_by_weight
+        Method called when a request is made on the endpoint. Answers with the graph engine, from the path cache or creates
+        the database session to run the queries executed by _get_shortest_path_by_weight
 
     _get_shortest_path_by_num_nodes(transaction: Transaction, jobId1: str, jobId2: str) -> list
         Runs a query to the database to retrieve the shortest path between 2 nodes based on the number of nodes
         and returns a list of dictionaries containing the job ID and the membership score of the node
 
     get_shortest_path_by_num_nodes( jobId1: str, jobId2: str)
-        Method called when a request is made on the endpoint. Creates the database session to run the queries executed by 
-        _get_shortest_path_by_num_nodes
+        Method called when a request is made on the endpoint. Answers with the graph engine, from the path cache or creates
+        the database session to run the queries executed by _get_shortest_path_by_num_nodes
+
+    _get_shortest_paths_batch(transaction: Transaction, pairs: list, mode: str) -> dict
+        Runs the queries to the database to retrieve the shortest paths between several pairs of nodes,
+        one traversal per source node
+
+    get_shortest_paths_batch(pairs: list, mode: str)
+        Method called when a request is made on the batch endpoint. Yields the paths of each pair in input order
+
+    get_paths_from_source(jobId: str, mode: str, max_hops: int, max_cost: float, limit: int, offset: int)
+        Method called when a request is made on the single source endpoint. Yields the jobs within the limits
+        from a job, found with a single traversal
+
+    get_similar_jobs(jobId: str, k: int) -> list
+        Method called when a request is made on the similar jobs endpoint. Answers from the precomputed neighbour index
+
+    get_cache_stats() -> dict
+        Returns the hit and miss counters of the caches
     """
 
-    def __init__(self) -> None:
-        self.driver =  GraphDatabase.driver("bolt://database:7687", auth=("neo4j", "your_password"))
+    def __init__(self, use_engine=False) -> None:
+        self.use_engine = use_engine
+
+    @property
+    def driver(self):
+        return get_driver()
 
 
     def close(self):
-        """Closes the driver
+        """Closes the shared driver
 
-        Currently unused as we open and close the driver with "with"
+        Only needed on shutdown, it is also closed when the process exits
 
         """
-        self.driver.close()
+        close_driver()
 
     
     # We need to project the graph to the Graph Catalog in order to run functions from gds
 
-    def project_graph(self):
+    def project_graph(self, refresh=False):
 
         """Projects the Graph to the Graph Catalog
 
         To run functions from the Data Science plugin, we need to project the graphs we want to work on
         to the Graph Catalog of the Database
 
+        Parameters
+        ----------
+        refresh : bool, optional
+            If True, the graph is dropped and projected again (e.g. after the data changed)
+
         """
 
         # We check if the graph myGraph exists in Graph Catalog, if not we run the query to create it
         # query exports all available labels (the clusters), their relationship and the properties of the relationship. 
         # Algorithms take direction into account, therefore we use UNDIRECTED
 
+        if refresh and self.check_graph_exists():
+            with self.driver.session() as session:
+                session.run(DROP_GRAPH_QUERY, graph='myGraph').consume()
+
         if not self.check_graph_exists():
             print(f'Projecting graph...')
-            query = f'''
+            query = '''
             CALL gds.graph.project(
                 'myGraph',    
-                ['c0', 'c1','c2', 'c3','c4', 'c5','c6', 'c7','c8', 'c9','c10', 'c11','c12', 'c13','c14', 'c15','c16', 'c17','c18', 'c19','c20', 'c21'],
-                {{IS_SIMILAR_TO:{{orientation:"UNDIRECTED", properties:"weight"}}}}        
+                $clusters,
+                {IS_SIMILAR_TO:{orientation:"UNDIRECTED", properties:["weight", "distance"]}}        
             )
             YIELD
             graphName AS graph, nodeProjection, nodeCount AS nodes, relationshipCount AS rels
             '''
             with self.driver.session() as session:
-                session.run(query)
+                session.run(query, clusters=list(CLUSTERS)).consume()
             print('Graph projected!')
         else:
             print(f'Graph already exists')
@@ -108,13 +347,8 @@ class Api:
                 True if the graph exists
         """
 
-        query = f'''
-            CALL gds.graph.exists("{graph}")
-                YIELD graphName, exists
-            RETURN graphName, exists
-        '''
         with self.driver.session() as session:
-            result = session.run(query)
+            result = session.run(GRAPH_EXISTS_QUERY, graph=graph)
             exists = result.values()[0][1]  # Returns a list with a list with the graphName and exists
             return exists
             
@@ -122,7 +356,7 @@ class Api:
         # All static methods execute the query for the session.
 
     @staticmethod
-    def _get_top_nodes(transaction, n: int, cluster: str):
+    def _get_top_nodes(transaction, n: int, cluster: str, after=None):
         """Executes the query to get the top N nodes
 
         Parameters
@@ -131,6 +365,8 @@ class Api:
             The top N nodes to retrieve
         cluster : str
             The cluster name
+        after : list, optional
+            The membership score and the job ID the nodes start after (see decode_cursor)
 
         Returns
         -------
@@ -138,39 +374,75 @@ class Api:
             a list of dictionaries containing the job IDs and and the membership scores
         """
 
-        query = f'''
-        MATCH (node:{cluster})
-        RETURN node
-        ORDER BY node.membershipScore DESC
-        LIMIT {n}
-        '''
+        query = TOP_NODES_QUERIES[cluster]
         try:
-            results = transaction.run(query)
-            return [{'JobId':record['node']['JobId'],'membershipScore':record['node']['membershipScore']} for record in results]
+            afterScore, afterJobId = after or (None, None)
+            results = transaction.run(query, n=n, afterScore=afterScore, afterJobId=afterJobId)
+            return [{'JobId':record['JobId'],'membershipScore':record['membershipScore']} for record in results]
         except ServiceUnavailable as exception:
             print(f'{query} raised an error:\n {exception}')
             raise
 
         
-    def get_top_nodes(self, n, cluster):
-        """Creates a session on demand when a request is received by the endpoint to retrieve the
-            top N nodes
+    def get_top_nodes(self, n, cluster, cursor=None):
+        """Retrieves the top N nodes when a request is received by the endpoint
+
+        The nodes come from the in-memory cache (db_logic.cache), which is filled from the database the first time
+        and every time the loader changes the data version. Bigger results are read in pages of at most MAX_PAGE_SIZE
+        nodes, each one starting after the cursor of the previous one (see get_next_cursor)
 
         Parameters
         ----------
         n : int
-            The top N nodes to retrieve
+            The top N nodes to retrieve, at most MAX_PAGE_SIZE
         cluster : str
             The cluster name
+        cursor : str, optional
+            The cursor of the previous page, the first page if None
 
         Returns
         -------
         list
             a list of dictionaries containing the job IDs and and the membership scores
+
+        Raises
+        ------
+        ValueError
+            If cluster is not one of the known clusters, n is out of range or the cursor is invalid
         """
-        with self.driver.session() as session:
-            results = session.execute_read(self._get_top_nodes,n,cluster)
-            return results
+        check_cluster(cluster)
+        if not 0 <= n <= MAX_PAGE_SIZE:
+            raise ValueError(f'n must be between 0 and {MAX_PAGE_SIZE}, got {n}. Use the cursor to read the next nodes')
+        after = decode_cursor(cursor) if cursor is not None else None
+        if not top_nodes_cache.is_fresh():
+            self.load_top_nodes_cache()
+        return top_nodes_cache.get(n, cluster, after)
+
+    @staticmethod
+    def _get_all_nodes(transaction):
+        """Executes the query to get every job
+
+        Returns
+        -------
+        list
+            a list of lists with the job ID, the cluster and the membership score of each job
+        """
+        return transaction.run(ALL_NODES_QUERY).values()
+
+    def load_top_nodes_cache(self):
+        """Fills the top nodes cache with every job in the database
+
+        Only one request fills the cache, the rest wait for it and use the result
+        """
+        with top_nodes_cache.lock:
+            if top_nodes_cache.is_fresh():
+                return
+            # Read before the jobs, so a load that bumps it while they are read leaves the cache stale
+            version = get_data_version()
+            with self.driver.session() as session, metrics.timer('neo4j_query_seconds', query='all_nodes'):
+                records = session.execute_read(self._get_all_nodes)
+            job_ids, clusters, scores = zip(*records) if records else ((), (), ())
+            top_nodes_cache.fill(job_ids, clusters, scores, version)
 
     
 # Shortest paths
@@ -178,15 +450,19 @@ class Api:
     #By edge weight
 
     @staticmethod
-    def _get_shortest_path_by_weight(transaction, jobId1: str, jobId2: str):
+    def _get_shortest_path_by_weight(transaction, jobId1: str, jobId2: str, max_cost=None):
         """Executes the query to get the path between two nodes based on edge weight
 
+        The path minimises the distance of the edges (-log of the weight), so it goes through the most similar jobs
+
         Parameters
         ----------
         jobId1 : str
             Job ID of one of the nodes
         jobId1 : str
             Job ID of the other node
+        max_cost : float, optional
+            The maximum total distance of the path
 
         Returns
         -------
@@ -194,53 +470,49 @@ class Api:
             a list of dictionaries containing the job IDs and and the membership scores
         """
 
-        query = f'''
-        MATCH (source), (target)
-        WHERE source.JobId="{jobId1}" AND target.JobId="{jobId2}"
-        CALL gds.shortestPath.dijkstra.stream('myGraph', {{
-            sourceNode: source,
-            targetNode: target,
-            relationshipWeightProperty: 'weight'
-        }})
-        YIELD index, sourceNode, targetNode, totalCost, nodeIds, costs, path
-        RETURN
-            index,
-            gds.util.asNode(sourceNode).name AS sourceNodeName,
-            gds.util.asNode(targetNode).name AS targetNodeName,
-            totalCost,
-            [nodeId IN nodeIds | gds.util.asNode(nodeId).name] AS nodeNames,
-            costs,
-            nodes(path)
-        ORDER BY index
-        '''
+        query = SHORTEST_PATH_BY_WEIGHT_QUERY
         
         try:
-            results = transaction.run(query)
+            results = transaction.run(query, jobId1=jobId1, jobId2=jobId2, maxCost=max_cost)
             return [ [{'JobId':node['JobId'],'membershipScore':node['membershipScore']} for node in record[f'nodes(path)']] for record in results]
         except ServiceUnavailable as exception:
-            print.error(f'{query} raised an error:\n {exception}')
+            print(f'{query} raised an error:\n {exception}')
             raise
 
         
-    def get_shortest_path_by_weight(self, jobId1: str, jobId2: str):
+    def get_shortest_path_by_weight(self, jobId1: str, jobId2: str, max_cost=None):
         """Creates a session on demand when a request is received by the endpoint to retrieve the
             list of nodes between two nodes by weight of the edge
 
+        Requests with max_cost are not cached
+
         Parameters
         ----------
         jobId1 : str
             Job ID of one of the nodes
         jobId1 : str
             Job ID of the other node
+        max_cost : float, optional
+            The maximum total distance of the path, no path is returned if the shortest one costs more. The graph
+            engine stops searching past it, the database only filters the path it found (GDS has no cutoff)
 
         Returns
         -------
         list
             a list of dictionaries containing the job IDs and and the membership scores
         """
-        with self.driver.session() as session:
-            results = session.execute_read(self._get_shortest_path_by_weight,jobId1,jobId2)
-            return results
+        if self.use_engine:
+            return load_engine(self.driver).shortest_path_by_weight(jobId1, jobId2, max_cost)
+        if max_cost is not None:
+            with self.driver.session() as session, metrics.timer('neo4j_query_seconds', query='shortest_path_by_weight'):
+                return session.execute_read(self._get_shortest_path_by_weight,jobId1,jobId2,max_cost)
+        results = path_cache.get('weight', jobId1, jobId2)
+        if results is None:
+            version = get_data_version()    # the paths are not cached if a load bumps it while they are found
+            with self.driver.session() as session, metrics.timer('neo4j_query_seconds', query='shortest_path_by_weight'):
+                results = session.execute_read(self._get_shortest_path_by_weight,jobId1,jobId2)
+            path_cache.set('weight', jobId1, jobId2, results, version)
+        return results
 
 
     # By number of nodes
@@ -265,27 +537,21 @@ class Api:
             a list of dictionaries containing the job IDs and and the membership scores
         """
 
-        # query = f'''
-        # MATCH (source), (target)
-        # WHERE source.JobId="{jobId1}" AND target.JobId="{jobId2}"
+        # query = '''
+        # MATCH (source:Job {JobId:$jobId1}), (target:Job {JobId:$jobId2})
         # WITH id(source) AS source, [id(target)] AS targetNodes
-        # CALL gds.bfs.stream('myGraph', {{
+        # CALL gds.bfs.stream('myGraph', {
         #     sourceNode: source,
         #     targetNodes: targetNodes
-        # }})
+        # })
         # YIELD path
         # RETURN path, nodes(path)
         # '''
 
-        query=f'''
-        MATCH (source), (target)
-        WHERE source.JobId="{jobId1}" AND target.JobId="{jobId2}"
-        MATCH path = shortestPath((source)-[*]-(target))
-        RETURN path,nodes(path)
-        '''
+        query = SHORTEST_PATH_BY_NUM_NODES_QUERY
         
         try:
-            results = transaction.run(query)
+            results = transaction.run(query, jobId1=jobId1, jobId2=jobId2)
             return [ [{'JobId':node['JobId'],'membershipScore':node['membershipScore']} for node in record[f'nodes(path)']] for record in results]
         except ServiceUnavailable as exception:
             print(f'{query} raised an error:\n {exception}')
@@ -308,6 +574,208 @@ class Api:
         list
             a list of dictionaries containing the job IDs and the membership scores
         """
+        if self.use_engine:
+            return load_engine(self.driver).shortest_path_by_num_nodes(jobId1, jobId2)
+        results = path_cache.get('num_nodes', jobId1, jobId2)
+        if results is None:
+            version = get_data_version()    # the paths are not cached if a load bumps it while they are found
+            with self.driver.session() as session, metrics.timer('neo4j_query_seconds', query='shortest_path_by_num_nodes'):
+                results = session.execute_read(self._get_shortest_path_by_num_nodes,jobId1,jobId2)
+            path_cache.set('num_nodes', jobId1, jobId2, results, version)
+        return results
+
+    # Several pairs at once
+
+    @staticmethod
+    def _get_shortest_paths_batch(transaction, pairs: list, mode: str):
+        """Executes the queries to get the paths between several pairs of nodes
+
+        Parameters
+        ----------
+        pairs : list
+            A list of (jobId1, jobId2) tuples
+        mode : str
+            'weight' to minimise the weight of the edges, 'num_nodes' to minimise the number of nodes
+
+        Returns
+        -------
+        dict
+            a dictionary from each pair to the list of paths between them (lists of dictionaries containing
+            the job IDs and the membership scores)
+        """
+        results = {pair: [] for pair in pairs}
+        try:
+            if mode == 'weight':
+                # Pairs are grouped by source so each source is traversed once
+                targets_by_source = {}
+                for jobId1, jobId2 in results:
+                    targets_by_source.setdefault(jobId1, []).append(jobId2)
+                for source, targets in targets_by_source.items():
+                    for record in transaction.run(BATCH_PATHS_BY_WEIGHT_QUERY, source=source, targets=targets):
+                        results[(source, record['JobId'])] = [[{'JobId':node['JobId'],'membershipScore':node['membershipScore']} for node in record['nodes(path)']]]
+            else:
+                for record in transaction.run(BATCH_PATHS_BY_NUM_NODES_QUERY, pairs=[list(pair) for pair in results]):
+                    results[(record['JobId1'], record['JobId2'])] = [[{'JobId':node['JobId'],'membershipScore':node['membershipScore']} for node in record['nodes(path)']]]
+            return results
+        except ServiceUnavailable as exception:
+            print(f'Batch of {len(pairs)} paths raised an error:\n {exception}')
+            raise
+
+    def get_shortest_paths_batch(self, pairs: list, mode='weight'):
+        """Finds the shortest paths between several pairs of nodes when a request is received by the batch endpoint
+
+        Pairs found in the path cache are not queried and the rest are queried in a single transaction. With the graph
+        engine, each source is traversed once, the first time it appears
+
+        Parameters
+        ----------
+        pairs : list
+            A list of (jobId1, jobId2) pairs, as tuples or lists
+        mode : str, optional
+            'weight' to minimise the weight of the edges, 'num_nodes' to minimise the number of nodes
+
+        Returns
+        -------
+        iterator
+            the list of paths (lists of dictionaries containing the job IDs and the membership scores) of each pair,
+            in the same order as pairs
+
+        Raises
+        ------
+        ValueError
+            If the mode is unknown, a pair doesn't have two job IDs or there are more than MAX_BATCH_PAIRS pairs
+        """
+        if mode not in PATH_MODES:
+            raise ValueError(f'Unknown mode {mode!r}, it must be one of {", ".join(PATH_MODES)}')
+        if not isinstance(pairs, (list, tuple)):
+            raise ValueError('The pairs must be a list')
+        if len(pairs) > MAX_BATCH_PAIRS:
+            raise ValueError(f'At most {MAX_BATCH_PAIRS} pairs can be requested at once, got {len(pairs)}')
+        if any(not isinstance(pair, (list, tuple)) or len(pair) != 2 or not all(isinstance(jobId, str) for jobId in pair) for pair in pairs):
+            raise ValueError('Each pair must have two job IDs')
+        pairs = [tuple(pair) for pair in pairs]
+
+        if self.use_engine:
+            return self._iter_engine_paths_batch(pairs, mode)
+
+        cached = {pair: path_cache.get(mode, *pair) for pair in set(pairs)}
+        missing = [pair for pair, paths in cached.items() if paths is None]
+        if missing:
+            version = get_data_version()
+            with self.driver.session() as session, metrics.timer('neo4j_query_seconds', query=f'shortest_paths_batch_{mode}'):
+                queried = session.execute_read(self._get_shortest_paths_batch, missing, mode)
+            for pair, paths in queried.items():
+                path_cache.set(mode, *pair, paths, version)
+            cached.update(queried)
+        return (cached[pair] for pair in pairs)
+
+    def _iter_engine_paths_batch(self, pairs: list, mode: str):
+        """Yields the paths of each pair with the graph engine, traversing each source once"""
+        engine = load_engine(self.driver)
+        targets_by_source = {}
+        for jobId1, jobId2 in pairs:
+            targets_by_source.setdefault(jobId1, set()).add(jobId2)
+        paths_by_source = {}
+        for jobId1, jobId2 in pairs:
+            if jobId1 not in paths_by_source:
+                paths_by_source[jobId1] = engine.shortest_paths_from(jobId1, targets_by_source[jobId1], mode == 'weight')
+            yield paths_by_source[jobId1][jobId2]
+
+    # Every job within some hops or cost of a job
+
+    def get_paths_from_source(self, jobId: str, mode='weight', max_hops=None, max_cost=None, limit=100, offset=0, cursor=None):
+        """Finds the jobs whose shortest path from a job is within the limits when a request is received by the endpoint
+
+        All the jobs come from a single traversal. The database results are streamed as they arrive. The pages
+        start after the cursor of the previous page (see get_next_cursor) or, for older clients, skip offset jobs
+
+        Parameters
+        ----------
+        jobId : str
+            Job ID of the source node
+        mode : str, optional
+            'weight' to minimise the weight of the edges, 'num_nodes' to minimise the number of nodes
+        max_hops : int, optional
+            The maximum number of edges of the paths. In weight mode it applies to the cheapest path of each job:
+            a job whose cheapest path has more edges is left out, even if a more expensive path has fewer
+        max_cost : float, optional
+            The maximum total cost of the paths. The graph engine stops searching past it, the database only
+            filters the jobs its traversal found (GDS has no cutoff)
+        limit : int, optional
+            The number of jobs of the page, at most MAX_PAGE_SIZE
+        offset : int, optional
+            The number of jobs skipped
+        cursor : str, optional
+            The cursor of the previous page
+
+        Returns
+        -------
+        iterator
+            dictionaries containing the job IDs, the membership scores, the cost and the number of hops of each job
+            reached, sorted by cost and job ID
+
+        Raises
+        ------
+        ValueError
+            If the mode is unknown, the limits are out of range or the cursor is invalid
+        """
+        if mode not in PATH_MODES:
+            raise ValueError(f'Unknown mode {mode!r}, it must be one of {", ".join(PATH_MODES)}')
+        if not 0 <= limit <= MAX_PAGE_SIZE or offset < 0:
+            raise ValueError(f'limit must be between 0 and {MAX_PAGE_SIZE} and offset 0 or greater')
+        if (max_hops is not None and max_hops < 0) or (max_cost is not None and max_cost < 0):
+            raise ValueError('max_hops and max_cost must be 0 or greater')
+        after = decode_cursor(cursor) if cursor is not None else None
+
+        if self.use_engine:
+            jobs = load_engine(self.driver).reachable_from(jobId, mode == 'weight', max_hops, max_cost)
+            if after is not None:
+                offset += bisect.bisect_right(jobs, tuple(after), key=lambda job: (job['cost'], job['JobId']))
+            return iter(jobs[offset:offset + limit])
+        return self._iter_paths_from_source(jobId, mode, max_hops, max_cost, limit, offset, after)
+
+    def _iter_paths_from_source(self, jobId, mode, max_hops, max_cost, limit, offset, after=None):
+        """Yields the records of the single source query while they arrive"""
+        afterCost, afterJobId = after or (None, None)
         with self.driver.session() as session:
-            results = session.execute_read(self._get_shortest_path_by_num_nodes,jobId1,jobId2)
-            return results
\ No newline at end of file
+            results = session.run(SINGLE_SOURCE_QUERIES[mode], jobId=jobId, maxHops=max_hops, maxCost=max_cost, limit=limit, offset=offset,
+                                  afterCost=afterCost, afterJobId=afterJobId)
+            for record in results:
+                yield {'JobId': record['JobId'], 'membershipScore': record['membershipScore'], 'cost': record['cost'], 'hops': record['hops']}
+
+    def get_similar_jobs(self, jobId: str, k=10) -> list:
+        """Retrieves the most similar jobs of a job from the neighbour index (see db_logic.neighbour_index)
+
+        Parameters
+        ----------
+        jobId : str
+            Job ID of the job
+        k : int, optional
+            The number of jobs to retrieve, at most the number of neighbours kept by the data processing
+
+        Returns
+        -------
+        list
+            a list of dictionaries containing the job IDs and the similarity scores, from the most similar
+
+        Raises
+        ------
+        ValueError
+            If k is negative or the index has not been built
+        """
+        if k < 0:
+            raise ValueError(f'k must be 0 or greater, got {k}')
+        index = get_neighbour_index()
+        if index is None:
+            raise ValueError('The similar jobs index has not been built')
+        return index.get(jobId, k)
+
+    def get_cache_stats(self):
+        """Returns the hit and miss counters of the path cache (also exported by the /metrics endpoint)
+
+        Returns
+        -------
+        dict
+            a dictionary with the hits, misses and number of entries of the path cache
+        """
+        return {'paths': path_cache.stats()}
\ No newline at end of file
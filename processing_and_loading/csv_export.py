@@ -0,0 +1,107 @@
+import pandas as pd
+
+# Headers understood by neo4j-admin database import. JobId is both the import ID (in the Job ID space)
+# and a property of the node, so relationships refer to jobs by their JobId. The numbers are doubles (float
+# is 32-bit in neo4j-admin), so an imported database keeps the same values as the transactional loader
+NODES_HEADER = ['JobId:ID(Job)', 'membershipScore:double', ':LABEL', 'vector:double[]']
+RELATIONSHIPS_HEADER = [':START_ID(Job)', ':END_ID(Job)', 'weight:double', 'distance:double', ':TYPE']
+
+# Writes DataFrames one after the other to a csv file, so only one of them is in memory at a time
+def write_csv_blocks(blocks, path, header: list) -> None:
+    """Writes blocks of rows to a csv file
+
+    Parameters
+    ----------
+    blocks : iterable
+        DataFrames with the columns of the header, written in order
+    path : str
+        The location of the csv file, it is overwritten
+    header : list
+        The columns of the file, used when there are no blocks
+    """
+    with open(path, 'w', newline='') as file:
+        for number, block in enumerate(blocks):
+            if number == 0:
+                header = list(block.columns)
+                file.write(','.join(header) + '\n')
+            block.to_csv(file, header=False, index=False)
+        if file.tell() == 0:
+            file.write(','.join(header) + '\n')
+
+# Splits a DataFrame into blocks of rows
+def iter_chunks(df:pd.DataFrame, chunk_size=100000):
+    """Yields the rows of a DataFrame chunk_size at a time"""
+    for start in range(0, len(df), chunk_size):
+        yield df.iloc[start:start + chunk_size]
+
+# Writes a dataframe to a csv file in chunks, so only a chunk is formatted in memory at a time
+def write_csv_chunks(df:pd.DataFrame, path, chunk_size=100000) -> None:
+    """Writes a dataframe to a csv file chunk by chunk
+
+    Parameters
+    ----------
+    df : DataFrame
+        The dataframe to be written, its columns are the header of the file
+    path : str
+        The location of the csv file, it is overwritten
+    chunk_size : int, optional
+        An int representing the number of rows formatted at a time
+    """
+    write_csv_blocks(iter_chunks(df, chunk_size), path, list(df.columns))
+
+# Writes the jobs as a nodes file for neo4j-admin
+def export_nodes_csv(df, path, chunk_size=100000) -> None:
+    """Writes the jobs as a header-annotated nodes csv file for neo4j-admin database import
+
+    Parameters
+    ----------
+    df : DataFrame or iterable
+        The dataframe with the JobId, BelongsTo and MembershipScore columns (and optionally the Vector column)
+        and one row per job, or an iterable of such dataframes, which are written one at a time
+    path : str
+        The location of the csv file
+    chunk_size : int, optional
+        An int representing the number of rows formatted at a time
+    """
+    def nodes(block):
+        nodes = pd.DataFrame(
+            {
+                NODES_HEADER[0]: block['JobId'].values,
+                NODES_HEADER[1]: block['MembershipScore'].values,
+                NODES_HEADER[2]: 'Job;' + block['BelongsTo'].astype(str).values,   # same labels as the transactional loader
+            }
+        )
+        if 'Vector' in block.columns:
+            nodes[NODES_HEADER[3]] = [';'.join(map(repr, vector.tolist())) for vector in block['Vector']]   # arrays are split by ;
+        return nodes
+
+    blocks = iter_chunks(df, chunk_size) if isinstance(df, pd.DataFrame) else df
+    write_csv_blocks(map(nodes, blocks), path, NODES_HEADER[:3])
+
+# Writes the relationships as a relationships file for neo4j-admin
+def export_relationships_csv(df, path, chunk_size=100000) -> None:
+    """Writes the relationships as a header-annotated relationships csv file for neo4j-admin database import
+
+    Parameters
+    ----------
+    df : DataFrame or iterable
+        The dataframe with the JobId, SimilarJobId, SimilarityScore and Distance columns, or an iterable of
+        such dataframes, which are written one at a time
+    path : str
+        The location of the csv file
+    chunk_size : int, optional
+        An int representing the number of rows formatted at a time
+    """
+    def relationships(block):
+        return pd.DataFrame(
+            {
+                RELATIONSHIPS_HEADER[0]: block['JobId'].values,
+                RELATIONSHIPS_HEADER[1]: block['SimilarJobId'].values,
+                RELATIONSHIPS_HEADER[2]: block['SimilarityScore'].values,
+                RELATIONSHIPS_HEADER[3]: block['Distance'].values,
+                RELATIONSHIPS_HEADER[4]: 'IS_SIMILAR_TO',
+            }
+        )
+
+    blocks = iter_chunks(df, chunk_size) if isinstance(df, pd.DataFrame) else df
+    write_csv_blocks(map(relationships, blocks), path, RELATIONSHIPS_HEADER)
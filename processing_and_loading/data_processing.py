@@ -1,6 +1,10 @@
+import os
+import tempfile
+from multiprocessing import Pool
 import pandas as pd
 import numpy as np
 import sklearn.metrics as metrics
+from db_logic.metrics import metrics as instrumentation
 
 # Loads csv data from source
 def load_data(data)-> pd.DataFrame:
@@ -18,6 +22,61 @@ def load_data(data)-> pd.DataFrame:
     """
     return pd.read_csv(data)
 
+# The clusters are the numeric columns of the csv data
+CLUSTER_COLUMNS = [f'c{col_num}' for col_num in range(22)]
+
+# Reads the csv data chunk by chunk into compact arrays
+def read_jobs(data, chunk_size=100000):
+    """Reads the csv data in chunks into compact numpy arrays, one row per job
+
+    Only one chunk is parsed at a time. The vectors are kept as float32 and the job IDs as fixed-width bytes,
+    so the memory used is close to 22 x 4 bytes plus the length of the ID per job instead of a float64 DataFrame
+    with a python string per job. The membership scores are kept as float64, so they are the values of the file.
+    If a job ID is repeated, its last row is kept
+
+    Parameters
+    ----------
+    data : str
+        The file location (or URL) of the csv file
+    chunk_size : int, optional
+        The number of rows parsed at a time
+
+    Returns
+    -------
+    tuple
+        numpy arrays with the job IDs (bytes, unique), the cluster of each job (index of the highest column), the
+        membership scores (float64) and the vectors normalised to unit length (float32, one row per job)
+    """
+    dtypes = {column: np.float64 for column in CLUSTER_COLUMNS}
+    dtypes['JobId'] = str
+    job_ids, clusters, scores, vectors = [], [], [], []
+    chunks = iter(pd.read_csv(data, usecols=['JobId'] + CLUSTER_COLUMNS, dtype=dtypes, chunksize=chunk_size))
+    while True:
+        with instrumentation.stage('load'):
+            chunk = next(chunks, None)
+            if chunk is None:
+                break
+            values = chunk[CLUSTER_COLUMNS].to_numpy(dtype=np.float64)
+            job_ids.append(np.asarray(chunk['JobId'].to_numpy(), dtype=bytes))   # as wide as the longest ID
+        instrumentation.inc('processing_stage_rows_total', len(chunk), stage='load')
+        with instrumentation.stage('cluster_assignment'):
+            clusters.append(values.argmax(axis=1).astype(np.int8))
+            scores.append(values.max(axis=1))
+        with instrumentation.stage('normalisation'):
+            vectors.append(normalise_vectors(values.astype(np.float32)))
+    if not job_ids:
+        return (np.empty(0, dtype='S1'), np.empty(0, dtype=np.int8), np.empty(0, dtype=np.float64),
+                np.empty((0, len(CLUSTER_COLUMNS)), dtype=np.float32))
+    job_ids, clusters, scores, vectors = np.concatenate(job_ids), np.concatenate(clusters), np.concatenate(scores), np.concatenate(vectors)
+
+    # The jobs are nodes with a unique ID, so a repeated ID keeps its last row
+    _, last = np.unique(job_ids[::-1], return_index=True)
+    if len(last) < len(job_ids):
+        keep = np.sort(len(job_ids) - 1 - last)
+        print(f'{len(job_ids) - len(keep)} rows have the job ID of a later row, keeping the last row of each job')
+        job_ids, clusters, scores, vectors = job_ids[keep], clusters[keep], scores[keep], vectors[keep]
+    return job_ids, clusters, scores, vectors
+
 # Determines the label of the column with highest value (the cluster of the job)
 def assign_cluster(df:pd.DataFrame) -> pd.Series:
     """Provides a Series with the column name of the highest value in each row
@@ -66,10 +125,36 @@ def calculate_self_similarity_matrix(df:pd.DataFrame):
     """
     return metrics.pairwise.cosine_similarity(df,df)
 
+# Gets the pairs of jobs above the threshold and their similarity scores in a single pass
+def get_similarity_triplets(matrix, weight_threshold = 0.99):
+    """Extracts the (i, j, score) triplets above the threshold from the upper triangle of a similarity matrix
+
+    The diagonal and the lower triangle are skipped without copying the matrix, and the three arrays
+    come from the same mask so they are always aligned
+
+    Parameters
+    ----------
+    matrix : numpy.ndarray
+        A numpy matrix array containing the cosine similarities
+    weight_threshold : float
+        A float representing the cutoff threshold to keep the similarities
+    
+    Returns
+    -------
+    tuple
+        a tuple of numpy 1D arrays with the row indexes, the column indexes and the similarities
+    """
+    rows, cols = np.nonzero(matrix >= weight_threshold)
+    upper = cols > rows
+    rows, cols = rows[upper], cols[upper]
+    return rows, cols, matrix[rows, cols]
+
 # Gets the similarity scores with the threshold applied
 def get_similarities_from_matrix(matrix,weight_threshold = 0.99):
     """Calculates the similarity of a numeric DataFrame with itself
 
+    Prefer get_similarity_triplets when the pairs are needed too
+
     Parameters
     ----------
     matrix : numpy.ndarray
@@ -83,11 +168,7 @@ def get_similarities_from_matrix(matrix,weight_threshold = 0.99):
     array
         a numpy 1D array containing the values of the cosine similarities
     """
-
-    # Generates a triangular matrix to eliminate duplicates
-    triangular_matrix = erase_diags(matrix)
-    similarities = triangular_matrix[triangular_matrix >= weight_threshold]   # array of scalars
-    return similarities
+    return get_similarity_triplets(matrix, weight_threshold)[2]
 
 # Erases de diagonal of the matrix as its elements represent the similarity of a job against itself
 def erase_diags(array):
@@ -111,6 +192,8 @@ def erase_diags(array):
 def get_relation_pairs(array, weight_threshold = 0.99):
     """Calculates the similarity of a numeric DataFrame with itself
 
+    Prefer get_similarity_triplets when the similarities are needed too
+
     Parameters
     ----------
     matrix : numpy.ndarray
@@ -123,5 +206,572 @@ def get_relation_pairs(array, weight_threshold = 0.99):
     array
         a numpy 1D array containing the indexes of the non-zero values of the array
     """
+    rows, cols, _ = get_similarity_triplets(array, weight_threshold)
+    return np.column_stack((rows, cols))
+
+# Converts float32 values to the doubles that are written the same way, e.g. 0.65 instead of 0.6499999761581421
+def to_shortest_doubles(values) -> np.ndarray:
+    """Converts float32 values (such as the similarities) to the float64 values with the same shortest representation
+
+    The float32 value closest to 0.65 is 0.6499999761581421 as a float64, which is what the database and the api
+    would get. Its shortest representation is 0.65, which is also what the csv export writes
+
+    Parameters
+    ----------
+    values : numpy.ndarray
+        A numpy array of float32 values. Other types are only converted to float64
+
+    Returns
+    -------
+    numpy.ndarray
+        a numpy float64 array
+    """
+    values = np.asarray(values)
+    if values.dtype != np.float32:
+        return values.astype(np.float64)
+    return values.astype(str).astype(np.float64)
+
+# Converts similarities to distances for the shortest path searches
+def similarity_to_distance(similarities) -> np.ndarray:
+    """Calculates the distance of each similarity as -log(similarity)
+
+    More similar jobs are closer, and the distance of a path is -log of the product of the similarities
+    of its edges. Similarities of 1 or more (rounding) have a distance of 0
+
+    Parameters
+    ----------
+    similarities : numpy.ndarray
+        A numpy 1D array containing positive cosine similarities
+
+    Returns
+    -------
+    numpy.ndarray
+        a numpy 1D array containing the distances
+    """
+    return np.maximum(-np.log(similarities), 0)
+
+# Normalises every row so the cosine similarity of two rows is their dot product
+def normalise_vectors(df) -> np.ndarray:
+    """Scales each numeric row of a DataFrame to unit length
+
+    Rows whose norm is 0 are left as zeros, so their similarity with any other row is 0
+    (same behaviour as sklearn's cosine_similarity). float32 data stays float32, anything else is float64
+
+    Parameters
+    ----------
+    df : DataFrame
+        A pandas DataFrame (or 2D array) with the numeric columns
     
-    return np.argwhere(erase_diags(array) >= weight_threshold)
\ No newline at end of file
+    Returns
+    -------
+    numpy.ndarray
+        a numpy matrix array with the rows scaled to unit length
+    """
+    vectors = np.asarray(df)
+    vectors = vectors if vectors.dtype in (np.float32, np.float64) else vectors.astype(np.float64)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return vectors / norms
+
+# Keeps the k best columns of each row among the best so far and new candidates
+def _merge_top(best_scores, best_cols, scores, cols, k):
+    """Merges the k best columns of each row found so far with new candidate columns
+
+    Parameters
+    ----------
+    best_scores : numpy.ndarray
+        The similarities of the best columns of each row so far, -inf where there is none
+    best_cols : numpy.ndarray
+        The best columns of each row so far, -1 where there is none
+    scores : numpy.ndarray
+        The similarities of the candidates of each row
+    cols : numpy.ndarray
+        The candidate columns of each row
+    k : int
+        The number of columns kept
+
+    Returns
+    -------
+    tuple
+        the similarities and the columns of the k best columns of each row, unsorted
+    """
+    merged_scores = np.hstack([best_scores, scores])
+    merged_cols = np.hstack([best_cols, np.broadcast_to(cols, scores.shape)])
+    if merged_scores.shape[1] <= k:
+        return merged_scores, merged_cols
+    top = np.argpartition(-merged_scores, k - 1, axis=1)[:, :k]
+    return np.take_along_axis(merged_scores, top, axis=1), np.take_along_axis(merged_cols, top, axis=1)
+
+# Merges only the similarities of a tile that can still be among the k best of their row
+def _merge_tile(best_scores, best_cols, tile, col_start, k):
+    """Merges the columns of a tile that beat the k-th best similarity of their row so far
+
+    Once every row has k columns, few similarities of a new tile beat the k-th best, so they are gathered in a
+    small matrix (one row per row with any of them) instead of partitioning the whole tile. The columns of a
+    tile come after the ones already kept, so a similarity equal to the k-th best can't replace it (ties by column)
+
+    Parameters
+    ----------
+    best_scores : numpy.ndarray
+        The similarities of the best columns of each row so far, -inf where there is none
+    best_cols : numpy.ndarray
+        The best columns of each row so far, -1 where there is none
+    tile : numpy.ndarray
+        The similarities of the rows with the columns of the tile
+    col_start : int
+        The column of the first column of the tile
+    k : int
+        The number of columns kept
+
+    Returns
+    -------
+    tuple
+        the similarities and the columns of the k best columns of each row, unsorted
+    """
+    above = tile > best_scores.min(axis=1)[:, None]
+    count = np.count_nonzero(above)
+    if count == 0:
+        return best_scores, best_cols
+    if count > 4 * above.size // (k + 4):
+        # The first tiles of a row change most of its best columns, partitioning the whole tile is cheaper
+        return _merge_top(best_scores, best_cols, tile, np.arange(col_start, col_start + tile.shape[1]), k)
+    rows, cols = np.divmod(np.flatnonzero(above), tile.shape[1])   # much faster than np.nonzero on a matrix
+    counts = np.bincount(rows, minlength=len(tile))
+    touched = np.flatnonzero(counts)
+    # Position of each similarity among the ones of its row (they come row by row)
+    positions = np.arange(len(rows)) - (np.cumsum(counts) - counts)[rows]
+    slots = (np.cumsum(counts > 0) - 1)[rows]
+    scores = np.full((len(touched), counts.max()), -np.inf, dtype=best_scores.dtype)
+    candidates = np.full(scores.shape, -1, dtype=best_cols.dtype)
+    scores[slots, positions] = tile[rows, cols]
+    candidates[slots, positions] = cols + col_start
+    best_scores[touched], best_cols[touched] = _merge_top(best_scores[touched], best_cols[touched], scores, candidates, k)
+    return best_scores, best_cols
+
+# Sorts the best columns of each row from the most similar
+def _sort_top(best_scores, best_cols):
+    """Sorts the columns of each row by similarity (descending, ties by column)"""
+    order = np.lexsort((best_cols, -best_scores), axis=1)
+    return np.take_along_axis(best_cols, order, axis=1).astype(np.int32), np.take_along_axis(best_scores, order, axis=1)
+
+# Calculates the thresholded similarities of a block of rows against the columns at or after it
+def _similarity_row_block(vectors, row_start, row_end, weight_threshold=0.99, block_size=2048, k=0):
+    """Calculates the upper triangle similarities of the rows row_start:row_end tile by tile
+
+    Only the tiles on or above the diagonal are computed and, within each tile, only the pairs
+    with column index greater than the row index are kept, so every pair appears once. With k, the
+    tiles before the diagonal are also computed and the k most similar columns of every row are kept
+    from the same tiles, merging them tile by tile, so the peak memory depends on block_size and k
+
+    Parameters
+    ----------
+    vectors : numpy.ndarray
+        A numpy matrix array with the rows normalised to unit length
+    row_start : int
+        The first row of the block
+    row_end : int
+        The row after the last row of the block
+    weight_threshold : float
+        A float representing the cutoff threshold to keep the similarities
+    block_size : int
+        The number of columns of each tile
+    k : int, optional
+        The number of most similar columns kept for each row, whatever their similarity
+
+    Returns
+    -------
+    tuple
+        a tuple of numpy 1D arrays with the row indexes, the column indexes and the similarities, and
+        numpy matrix arrays with the k most similar columns of each row of the block and their similarities
+        (see calculate_top_neighbours)
+    """
+    num_rows = vectors.shape[0]
+    row_tile = vectors[row_start:row_end]
+    rows, cols, scores = [], [], []
+    best_scores = np.full((row_end - row_start, k), -np.inf, dtype=np.float32)
+    best_cols = np.full((row_end - row_start, k), -1, dtype=np.int64)
+    for col_start in range(0 if k else row_start, num_rows, block_size):
+        col_end = min(col_start + block_size, num_rows)
+        tile = row_tile @ vectors[col_start:col_end].T
+        if col_end > row_start:
+            tile_rows, tile_cols = np.divmod(np.flatnonzero(tile >= weight_threshold), tile.shape[1])
+            tile_scores = tile[tile_rows, tile_cols]
+            tile_rows += row_start
+            tile_cols += col_start
+            upper = tile_cols > tile_rows   # drops the diagonal and the lower triangle
+            rows.append(tile_rows[upper])
+            cols.append(tile_cols[upper])
+            scores.append(tile_scores[upper])
+        if k:
+            tile = tile.astype(np.float32, copy=False)
+            if col_start < row_end and row_start < col_end:
+                # a job is not its own neighbour
+                diagonal = np.arange(max(row_start, col_start), min(row_end, col_end))
+                tile[diagonal - row_start, diagonal - col_start] = -np.inf
+            best_scores, best_cols = _merge_tile(best_scores, best_cols, tile, col_start, k)
+    neighbours, neighbour_scores = _sort_top(best_scores, best_cols)
+    if not rows:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0, dtype=vectors.dtype), neighbours, neighbour_scores
+    return np.concatenate(rows), np.concatenate(cols), np.concatenate(scores), neighbours, neighbour_scores
+
+# Calculates the similarities above the threshold without building the full similarity matrix
+def calculate_blocked_similarities(vectors, weight_threshold=0.99, block_size=2048, k=0):
+    """Calculates the similarities above the threshold of a normalised matrix with itself by tiles
+
+    Peak memory depends on block_size (block_size x block_size similarities per tile) instead of
+    the square of the number of rows. With k, the most similar rows of every row are found in the
+    same pass (see calculate_top_neighbours), which computes the whole matrix instead of its upper triangle
+
+    Parameters
+    ----------
+    vectors : numpy.ndarray
+        A numpy matrix array with the rows normalised to unit length (see normalise_vectors)
+    weight_threshold : float
+        A float representing the cutoff threshold to keep the similarities
+    block_size : int
+        The number of rows and columns of each tile
+    k : int, optional
+        The number of most similar rows of each row to find, 0 to find none
+
+    Returns
+    -------
+    tuple
+        a tuple of numpy 1D arrays with the row indexes, the column indexes and the similarities
+        (same format as get_similarity_triplets). With k, also the neighbours and their similarities
+        (same format as calculate_top_neighbours)
+    """
+    num_rows = vectors.shape[0]
+    k = max(min(k, num_rows - 1), 0)
+    rows, cols, scores, neighbours, neighbour_scores = [], [], [], [], []
+    for row_start in range(0, num_rows, block_size):
+        row_end = min(row_start + block_size, num_rows)
+        block = _similarity_row_block(vectors, row_start, row_end, weight_threshold, block_size, k)
+        for results, result in zip((rows, cols, scores, neighbours, neighbour_scores), block):
+            results.append(result)
+    return _concatenate_results(vectors, rows, cols, scores, neighbours, neighbour_scores, k)
+
+# Joins the results of the blocks of rows
+def _concatenate_results(vectors, rows, cols, scores, neighbours, neighbour_scores, k):
+    """Concatenates the pairs and the neighbours of the blocks of rows, in the same order as the rows"""
+    if rows:
+        triplets = np.concatenate(rows), np.concatenate(cols), np.concatenate(scores)
+    else:
+        triplets = np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0, dtype=vectors.dtype)
+    if not k:
+        return triplets
+    if not neighbours:
+        return (*triplets, np.empty((0, k), dtype=np.int32), np.empty((0, k), dtype=np.float32))
+    return (*triplets, np.concatenate(neighbours), np.concatenate(neighbour_scores))
+
+# Calculates the similarities above the threshold between the rows of two matrices
+def calculate_cross_similarities(vectors, other_vectors, weight_threshold=0.99, block_size=2048):
+    """Calculates the similarities above the threshold of every row of a normalised matrix against every row of another by tiles
+
+    Used to score a few new jobs against the stored ones, the work grows with len(vectors) x len(other_vectors)
+
+    Parameters
+    ----------
+    vectors : numpy.ndarray
+        A numpy matrix array with the rows normalised to unit length (see normalise_vectors)
+    other_vectors : numpy.ndarray
+        A numpy matrix array with the same columns, also normalised
+    weight_threshold : float
+        A float representing the cutoff threshold to keep the similarities
+    block_size : int
+        The number of rows and columns of each tile
+
+    Returns
+    -------
+    tuple
+        a tuple of numpy 1D arrays with the row indexes (in vectors), the column indexes (in other_vectors)
+        and the similarities
+    """
+    rows, cols, scores = [], [], []
+    for row_start in range(0, vectors.shape[0], block_size):
+        row_tile = vectors[row_start:row_start + block_size]
+        for col_start in range(0, other_vectors.shape[0], block_size):
+            tile = row_tile @ other_vectors[col_start:col_start + block_size].T
+            tile_rows, tile_cols = np.nonzero(tile >= weight_threshold)
+            scores.append(tile[tile_rows, tile_cols])
+            rows.append(tile_rows + row_start)
+            cols.append(tile_cols + col_start)
+    if not rows:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0, dtype=vectors.dtype)
+    return np.concatenate(rows), np.concatenate(cols), np.concatenate(scores)
+
+# Finds the most similar jobs of every job, whatever their similarity
+def calculate_top_neighbours(vectors, k=10, block_size=2048):
+    """Finds the k most similar rows of every row of a normalised matrix by tiles, without a threshold
+
+    Each block of rows keeps its k best columns so far and merges them with every tile of columns,
+    so peak memory depends on block_size and k instead of the square of the number of rows. The data
+    processing finds them while calculating the thresholded similarities (calculate_blocked_similarities
+    with k), this only finds the neighbours
+
+    Parameters
+    ----------
+    vectors : numpy.ndarray
+        A numpy matrix array with the rows normalised to unit length (see normalise_vectors)
+    k : int
+        The number of neighbours of each row (at most the number of rows - 1)
+    block_size : int
+        The number of rows and columns of each tile
+
+    Returns
+    -------
+    tuple
+        a numpy int32 matrix array with the row indexes of the neighbours of each row and a float32 one with their
+        similarities, sorted from the most similar (ties by row index)
+    """
+    num_rows = vectors.shape[0]
+    k = max(min(k, num_rows - 1), 0)
+    if not k:
+        return np.empty((num_rows, 0), dtype=np.int32), np.empty((num_rows, 0), dtype=np.float32)
+    return calculate_blocked_similarities(vectors, np.inf, block_size, k)[3:]
+
+# Calculates a block of rows inside a worker process
+def _similarity_worker(task):
+    """Calculates the upper triangle similarities of a block of rows from the memory mapped vectors
+
+    Parameters
+    ----------
+    task : tuple
+        The path of the .npy file with the normalised vectors, the first row, the row after the last row,
+        the threshold, the tile size and the number of neighbours of each row
+
+    Returns
+    -------
+    tuple
+        a tuple of numpy 1D arrays with the row indexes, the column indexes and the similarities, and the
+        neighbours of the rows and their similarities (see _similarity_row_block)
+    """
+    path, row_start, row_end, weight_threshold, block_size, k = task
+    vectors = np.load(path, mmap_mode='r')  # pages are shared between the workers instead of pickling the matrix
+    return _similarity_row_block(vectors, row_start, row_end, weight_threshold, block_size, k)
+
+# Calculates the similarities above the threshold in several processes, yielding each block when it is done
+def iter_parallel_similarities(vectors, weight_threshold=0.99, block_size=2048, workers=None, k=0):
+    """Calculates the similarities above the threshold of a normalised matrix with itself in a process pool
+
+    The matrix is written once to a memory mapped .npy file that every worker opens, and the rows are split
+    in blocks of block_size rows. Blocks near the top of the matrix have more columns to the right of the
+    diagonal, so blocks are handed out one at a time to balance the workers. With k, the neighbours of the
+    rows are found in the same pass (see _similarity_row_block) and the blocks are yielded in row order
+
+    Parameters
+    ----------
+    vectors : numpy.ndarray
+        A numpy matrix array with the rows normalised to unit length (see normalise_vectors)
+    weight_threshold : float
+        A float representing the cutoff threshold to keep the similarities
+    block_size : int
+        The number of rows and columns of each tile
+    workers : int, optional
+        The number of processes. Defaults to the number of CPUs
+    k : int, optional
+        The number of most similar rows of each row to find, 0 to find none
+
+    Yields
+    ------
+    tuple
+        a tuple of numpy 1D arrays with the row indexes, the column indexes and the similarities of a block
+        of rows, and the neighbours of its rows and their similarities, in completion order (row order with k)
+    """
+    num_rows = vectors.shape[0]
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'vectors.npy')
+        np.save(path, np.ascontiguousarray(vectors))
+        tasks = [(path, row_start, min(row_start + block_size, num_rows), weight_threshold, block_size, k)
+                 for row_start in range(0, num_rows, block_size)]
+        with Pool(processes=workers) as pool:
+            yield from (pool.imap if k else pool.imap_unordered)(_similarity_worker, tasks)
+
+# Calculates the similarities above the threshold using several processes
+def calculate_parallel_similarities(vectors, weight_threshold=0.99, block_size=2048, workers=None, k=0):
+    """Calculates the similarities above the threshold of a normalised matrix with itself in a process pool
+
+    Same result as calculate_blocked_similarities, see iter_parallel_similarities
+
+    Parameters
+    ----------
+    vectors : numpy.ndarray
+        A numpy matrix array with the rows normalised to unit length (see normalise_vectors)
+    weight_threshold : float
+        A float representing the cutoff threshold to keep the similarities
+    block_size : int
+        The number of rows and columns of each tile
+    workers : int, optional
+        The number of processes. Defaults to the number of CPUs
+    k : int, optional
+        The number of most similar rows of each row to find, 0 to find none
+
+    Returns
+    -------
+    tuple
+        a tuple of numpy 1D arrays with the row indexes, the column indexes and the similarities
+        (same format as get_similarity_triplets). With k, also the neighbours and their similarities
+        (same format as calculate_top_neighbours)
+    """
+    k = max(min(k, vectors.shape[0] - 1), 0)
+    rows, cols, scores, neighbours, neighbour_scores = [], [], [], [], []
+    for block in iter_parallel_similarities(vectors, weight_threshold, block_size, workers, k):
+        for results, result in zip((rows, cols, scores, neighbours, neighbour_scores), block):
+            results.append(result)
+    return _concatenate_results(vectors, rows, cols, scores, neighbours, neighbour_scores, k)
+
+# Assigns every row to candidate buckets so only rows that may be similar are compared
+def get_candidate_buckets(vectors, num_planes=8, num_tables=6, seed=0):
+    """Provides the bucket keys of each row for several angular LSH tables
+
+    The key of a row is the signs of its projections on num_planes random hyperplanes. The hyperplanes go
+    through the mean of the rows, as every score is positive and hyperplanes through the origin would split
+    them unevenly. Rows whose angle is small are likely to share the key in at least one table. In the first
+    table the key also includes the dominant cluster of the row (same as assign_cluster, normalising does not
+    change the highest column), which keeps its buckets small. It is left out of the other tables, so similar
+    rows whose highest columns are almost tied (and so may have different dominant clusters) can still meet
+
+    Parameters
+    ----------
+    vectors : numpy.ndarray
+        A numpy matrix array with the rows normalised to unit length
+    num_planes : int, optional
+        The number of random hyperplanes (bits of the signature) of each table
+    num_tables : int, optional
+        The number of independent tables. More tables increase recall and the number of candidates
+    seed : int, optional
+        The seed of the random hyperplanes
+
+    Returns
+    -------
+    numpy.ndarray
+        a numpy matrix array of shape (num_tables, rows) containing the bucket key of each row in each table
+    """
+    rng = np.random.default_rng(seed)
+    clusters = np.argmax(vectors, axis=1).astype(np.int64)
+    offsets = vectors.mean(axis=0)
+    bit_values = 1 << np.arange(num_planes, dtype=np.int64)
+    keys = np.empty((num_tables, vectors.shape[0]), dtype=np.int64)
+    for table in range(num_tables):
+        planes = rng.standard_normal((vectors.shape[1], num_planes)).astype(vectors.dtype)
+        signatures = ((vectors @ planes) >= offsets @ planes) @ bit_values
+        keys[table] = (clusters << num_planes) + signatures if table == 0 else signatures
+    return keys
+
+# Calculates the similarities above the threshold only between rows sharing a candidate bucket
+def calculate_candidate_similarities(vectors, weight_threshold=0.99, block_size=2048, num_planes=8, num_tables=6, seed=0, k=0):
+    """Calculates the similarities above the threshold of a normalised matrix with itself within candidate buckets
+
+    This is an approximation of calculate_blocked_similarities: pairs that never share a bucket are
+    not scored, see estimate_candidate_recall to measure how many are missed. The pairs that are
+    returned have their exact score. With k, the neighbours of each row are also taken from the rows
+    sharing one of its buckets, so a row in small buckets may have fewer than k (padded with -1)
+
+    Parameters
+    ----------
+    vectors : numpy.ndarray
+        A numpy matrix array with the rows normalised to unit length (see normalise_vectors)
+    weight_threshold : float
+        A float representing the cutoff threshold to keep the similarities
+    block_size : int
+        The number of rows and columns of each tile inside a bucket
+    num_planes : int, optional
+        The number of random hyperplanes of each LSH table (see get_candidate_buckets)
+    num_tables : int, optional
+        The number of LSH tables (see get_candidate_buckets)
+    seed : int, optional
+        The seed of the random hyperplanes
+    k : int, optional
+        The number of most similar rows of each row to find, 0 to find none
+
+    Returns
+    -------
+    tuple
+        a tuple of numpy 1D arrays with the row indexes, the column indexes and the similarities
+        (same format as get_similarity_triplets). With k, also the neighbours and their similarities
+        (same format as calculate_top_neighbours, -1 and -inf where a row has fewer than k)
+    """
+    num_rows = vectors.shape[0]
+    k = max(min(k, num_rows - 1), 0)
+    rows, cols, scores = [], [], []
+    best_scores = np.full((num_rows, k), -np.inf, dtype=np.float32)
+    best_cols = np.full((num_rows, k), -1, dtype=np.int64)
+    for table_keys in get_candidate_buckets(vectors, num_planes, num_tables, seed):
+        order = np.argsort(table_keys, kind='stable')     # stable keeps the members of each bucket sorted
+        boundaries = np.flatnonzero(np.diff(table_keys[order])) + 1
+        # Every row is in one bucket of the table, so the neighbours of the table are merged once for all the rows
+        table_scores = np.full((num_rows, k), -np.inf, dtype=np.float32)
+        table_cols = np.full((num_rows, k), -1, dtype=np.int64)
+        for members in np.split(order, boundaries):
+            if len(members) < 2:
+                continue
+            bucket = calculate_blocked_similarities(vectors[members], weight_threshold, block_size, min(k, len(members) - 1))
+            rows.append(members[bucket[0]])
+            cols.append(members[bucket[1]])
+            scores.append(bucket[2])
+            if k:
+                table_cols[members, :bucket[3].shape[1]] = members[bucket[3]]
+                table_scores[members, :bucket[4].shape[1]] = bucket[4]
+        if k:
+            # A neighbour already found in another table is not counted twice
+            table_scores[(table_cols[:, :, None] == best_cols[:, None, :]).any(axis=2)] = -np.inf
+            best_scores, best_cols = _merge_top(best_scores, best_cols, table_scores, table_cols, k)
+    if rows:
+        # A pair found in several tables is kept once
+        rows, cols, scores = np.concatenate(rows), np.concatenate(cols), np.concatenate(scores)
+        _, unique = np.unique(rows * num_rows + cols, return_index=True)
+        triplets = rows[unique], cols[unique], scores[unique]
+    else:
+        triplets = np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0, dtype=vectors.dtype)
+    if not k:
+        return triplets
+    best_cols[np.isneginf(best_scores)] = -1
+    return (*triplets, *_sort_top(best_scores, best_cols))
+
+# Checks how many of the exact pairs the candidate buckets find
+def estimate_candidate_recall(vectors, rows, cols, weight_threshold=0.99, sample_size=1000, block_size=2048, seed=0):
+    """Estimates the recall of calculate_candidate_similarities against the exact calculation
+
+    The exact pairs are calculated only for a random sample of rows (sample x all rows), so the
+    check is linear in the number of rows
+
+    Parameters
+    ----------
+    vectors : numpy.ndarray
+        A numpy matrix array with the rows normalised to unit length
+    rows : numpy.ndarray
+        The row indexes returned by calculate_candidate_similarities
+    cols : numpy.ndarray
+        The column indexes returned by calculate_candidate_similarities
+    weight_threshold : float
+        A float representing the cutoff threshold used to calculate the pairs
+    sample_size : int, optional
+        The number of rows checked
+    block_size : int, optional
+        The number of columns of each tile of the exact calculation
+    seed : int, optional
+        The seed of the sample
+
+    Returns
+    -------
+    float
+        the fraction of the exact pairs of the sampled rows that were found (1.0 if there are none)
+    """
+    num_rows = vectors.shape[0]
+    rng = np.random.default_rng(seed)
+    sample = rng.choice(num_rows, size=min(sample_size, num_rows), replace=False)
+
+    # Exact pairs of the sample, without the similarity of each row with itself
+    sample_vectors = vectors[sample]
+    exact = []
+    for col_start in range(0, num_rows, block_size):
+        tile = sample_vectors @ vectors[col_start:col_start + block_size].T
+        sample_rows, others = np.nonzero(tile >= weight_threshold)
+        sample_rows = sample[sample_rows]
+        others += col_start
+        not_self = sample_rows != others
+        exact.append(np.minimum(sample_rows, others)[not_self] * num_rows + np.maximum(sample_rows, others)[not_self])
+    exact = np.unique(np.concatenate(exact)) if exact else np.empty(0, dtype=np.int64)
+    if len(exact) == 0:
+        return 1.0
+    found = np.isin(exact, rows.astype(np.int64) * num_rows + cols)
+    return float(found.mean())
@@ -1,9 +1,14 @@
+import queue
+import threading
+import time
+import numpy as np
 import pandas as pd
 from neo4j import GraphDatabase
+from db_logic.driver import URI, AUTH as auth
+from db_logic.neo4j_logic import CLUSTERS
+from db_logic.metrics import metrics
 # from py2neo import Graph, Node, Relationship
 
-URI = 'bolt://database:7687'
-auth = ("neo4j", "your_password")
 # Execute transaction
 def run_batch_transaction(transaction, queries) -> None:
     """Executes a batch of queries in a transaction 
@@ -37,51 +42,430 @@ def run_transaction(transaction, query) -> None:
     return result.values()
 
 
-# Load data into db
-def load_df_into_db_batch(df:pd.DataFrame, batch_size= 5000):
-    """ Loads a dataframe into the database in batches 
+def run_unwind_transaction(transaction, query, rows) -> None:
+    """Executes a query that unwinds a batch of rows in a transaction
+
+    Parameters
+    ----------
+    transaction : Transaction
+        The transaction to be excuted
+    query : string
+        A string with the query, it receives the batch as the $rows parameter
+    rows : list
+        A list of dictionaries, one per row of the batch
+
+    """
+    transaction.run(query, rows=rows)
+
+# All jobs share the Job label (besides the label of their cluster) so a single constraint covers them
+CONSTRAINT_QUERY = '''
+    CREATE CONSTRAINT job_id IF NOT EXISTS FOR (job:Job) REQUIRE job.JobId IS UNIQUE
+'''
+
+# Jobs loaded before the Job label existed only have the label of their cluster. The migration runs while any
+# job lacks the Job label, so a migration interrupted between its batches of 10000 jobs is finished by the next
+# run (it only touches the jobs without the label, so running it again is safe)
+UNLABELLED_JOBS_QUERY = '''
+    MATCH (job) WHERE job.JobId IS NOT NULL AND NOT job:Job
+    WITH job LIMIT 1
+    RETURN count(job) > 0 AS unlabelled
+'''
+JOB_LABEL_QUERY = '''
+    MATCH (job) WHERE job.JobId IS NOT NULL AND NOT job:Job
+    CALL { WITH job SET job:Job } IN TRANSACTIONS OF 10000 ROWS
+'''
+
+# The jobs are created first, so the relationships only need to look them up by the indexed JobId
+RELATIONSHIPS_QUERY = '''
+    UNWIND $rows AS row
+    MATCH (job1:Job {JobId:row.JobId})
+    MATCH (job2:Job {JobId:row.SimilarJobId})
+    MERGE (job1)-[r:IS_SIMILAR_TO]->(job2)
+    SET r.weight = row.SimilarityScore, r.distance = row.Distance
+'''
+
+# Removes the relationships of the jobs of a batch, for jobs whose vector changed
+DELETE_RELATIONSHIPS_QUERY = '''
+    UNWIND $rows AS row
+    MATCH (:Job {JobId:row.JobId})-[r:IS_SIMILAR_TO]-()
+    DELETE r
+'''
+
+# The normalised vectors stored in the jobs, to score new jobs against them
+VECTORS_QUERY = '''
+    MATCH (job:Job) WHERE job.vector IS NOT NULL
+    RETURN job.JobId AS JobId, job.vector AS vector
+'''
+
+# Relationships loaded before the distance property existed, with the same formula as similarity_to_distance
+DISTANCE_QUERY = '''
+    MATCH ()-[r:IS_SIMILAR_TO]->() WHERE r.distance IS NULL
+    CALL {
+        WITH r
+        SET r.distance = CASE WHEN r.weight >= 1 THEN 0.0 ELSE -log(r.weight) END
+    } IN TRANSACTIONS OF 10000 ROWS
+    RETURN count(r)
+'''
+
+# Builds the query that loads a batch of jobs. Labels can't be parameters, so there is one
+# query text per cluster, which Neo4j plans once and reuses for every batch
+def get_nodes_query(label: str, relabel=False, vectors=False) -> str:
+    """Builds the UNWIND query that merges a batch of jobs of a cluster
+
+    Parameters
+    ----------
+    label : str
+        The cluster of the jobs
+    relabel : bool, optional
+        If True, the labels of the other clusters are removed first, for jobs that may have changed cluster
+    vectors : bool, optional
+        If True, the vector of each job (row.Vector) is stored too
+
+    Returns
+    -------
+    str
+        The query, it receives the batch as the $rows parameter
+    """
+    remove = f"REMOVE job:{':'.join(cluster for cluster in CLUSTERS if cluster != label)}" if relabel else ''
+    vector = ', job.vector = row.Vector' if vectors else ''
+    return f'''
+        UNWIND $rows AS row
+        MERGE (job:Job {{JobId:row.JobId}})
+        {remove}
+        SET job:{label}, job.membershipScore = row.MembershipScore{vector}
+    '''
+
+# Splits a dataframe in batches of parameters for an UNWIND query
+def get_batches(df: pd.DataFrame, columns: list, batch_size=5000):
+    """Yields the rows of a dataframe as lists of dictionaries of at most batch_size rows
+
+    The values are taken column by column (as python types) instead of with iterrows
 
     Parameters
     ----------
     df : Dataframe
-        The dataframe to be loaded
+        The dataframe to be split
+    columns : list
+        The columns to include in each row
     batch_size : int, optional
-        An int representing the number of transactions in a batch
+        An int representing the number of rows in a batch
+
+    Yields
+    ------
+    list
+        a list of dictionaries with the columns as keys
     """
+    for start in range(0, len(df), batch_size):
+        chunk = df.iloc[start:start + batch_size]
+        values = [chunk[column].tolist() for column in columns]
+        # Columns of arrays (the vectors) are sent as lists
+        values = [[value.tolist() for value in column] if column and isinstance(column[0], np.ndarray) else column for column in values]
+        yield [dict(zip(columns, row)) for row in zip(*values)]
 
-    # Initialise driver
-    driver =  GraphDatabase.driver(URI, auth=auth)
+# Creates the constraint on the job ID, which also creates the index used to look jobs up
+def create_constraints():
+    """ Creates the uniqueness constraint on JobId and labels the jobs loaded without the Job label,
+    if any job lacks it
+    """
+    with GraphDatabase.driver(URI, auth=auth) as driver:
+        with driver.session() as session:
+            session.run(CONSTRAINT_QUERY).consume()
+            if session.run(UNLABELLED_JOBS_QUERY).single()['unlabelled']:
+                session.run(JOB_LABEL_QUERY).consume()  # auto-commit, as it commits its own transactions
 
-    batch = []
+class ConcurrentWriter:
+    """
+    Writes batches of UNWIND queries with several threads, each with its own session of a shared driver
 
-    # iterate through dataframe to generate the queries
-    for index, row in df.iterrows():
-        jobId1 = row['JobId']
-        jobId2 = row['SimilarJobId']
-        label1 = row['BelongsTo']
-        label2 = row['SimilarBelongsTo']
-        member_score1 = row['MembershipScore']
-        member_score2 = row['SimilarMembershipScore']
-        weight = row['SimilarityScore']
+    Every thread has a bounded queue: submit blocks while the queue of the thread is full (backpressure),
+    so batches are built while the database writes the previous ones without holding the whole load in memory.
+    Batches sent to the same thread are committed in order, so batches that touch the same jobs must be
+    sent to the same thread to avoid deadlocks (see get_relationship_rounds)
 
-        query = f'''
-        MERGE (job1:{label1} {{JobId:"{jobId1}",membershipScore:{member_score1}}})
-        MERGE (job2:{label2} {{JobId:"{jobId2}",membershipScore:{member_score2}}})
-        MERGE (job1)-[r:IS_SIMILAR_TO {{weight:{weight}}}]-(job2)
-        '''
+    ...
+    Methods
+    -------
+    submit(worker: int, query: str, rows: list, kind: str)
+        Queues a batch for the thread number worker
 
-        # Append query to the batch and load into db
-        batch.append(query)
-        if (index + 1) % batch_size == 0:
-            with driver.session() as session:
-                session.write_transaction(run_batch_transaction,batch)
-            print(f'Committed so far {index} transactions. \nCommitted {batch_size} new transactions')
-            batch = []
-            
-    # Load into db leftover queries
-    if batch:
+    progress
+        Optional function called with the number of rows committed so far after every batch
+
+    wait()
+        Waits until every queued batch is committed
+
+    close()
+        Waits for the queued batches, stops the threads, closes the driver and prints the throughput
+    """
+
+    def __init__(self, workers=1, queue_size=2, progress=None, name='rows') -> None:
+        """
+        Parameters
+        ----------
+        workers : int, optional
+            The number of threads (and sessions) writing at the same time
+        queue_size : int, optional
+            The number of batches each thread can have waiting
+        progress : callable, optional
+            Called with the number of rows committed so far after every batch
+        name : str, optional
+            What the rows are (jobs, relationships), the label of the ingest metrics
+        """
+        self.workers = workers
+        self.progress = progress
+        self.name = name
+        self.driver = GraphDatabase.driver(URI, auth=auth)
+        self.queues = [queue.Queue(maxsize=queue_size) for _ in range(workers)]
+        self.lock = threading.Lock()
+        self.errors = []
+        self.rows = 0
+        self.batches = 0
+        self.retries = 0
+        self.start_time = time.perf_counter()
+        self.threads = [threading.Thread(target=self._write, args=(batches,), daemon=True) for batches in self.queues]
+        for thread in self.threads:
+            thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _write(self, batches):
+        """Commits the batches of a queue with a session of its own until it receives None"""
+        with self.driver.session() as session:
+            while True:
+                batch = batches.get()
+                try:
+                    if batch is None:
+                        return
+                    query, rows, kind = batch
+                    attempts = []
+
+                    # execute_write retries transient errors (such as deadlocks) calling the function again
+                    def work(transaction):
+                        attempts.append(1)
+                        run_unwind_transaction(transaction, query, rows)
+
+                    start = time.perf_counter()
+                    session.execute_write(work)
+                    metrics.observe('ingest_batch_seconds', time.perf_counter() - start, kind=self.name)
+                    metrics.inc('ingest_rows_total', len(rows), kind=self.name)
+                    metrics.inc('ingest_retries_total', len(attempts) - 1, kind=self.name)
+                    with self.lock:
+                        self.rows += len(rows)
+                        self.batches += 1
+                        self.retries += len(attempts) - 1
+                        print(f'Committed so far {self.rows} {kind}')
+                        if self.progress is not None:
+                            self.progress(self.rows)
+                except Exception as exception:
+                    with self.lock:
+                        self.errors.append(exception)
+                finally:
+                    batches.task_done()
+
+    def _raise_errors(self):
+        if self.errors:
+            raise self.errors[0]
+
+    def submit(self, worker: int, query: str, rows: list, kind='rows'):
+        """Queues a batch for a thread, blocking while its queue is full
+
+        Parameters
+        ----------
+        worker : int
+            The number of the thread, batches of the same thread are committed in order
+        query : str
+            The UNWIND query, it receives the batch as the $rows parameter
+        rows : list
+            A list of dictionaries, one per row of the batch
+        kind : str, optional
+            What the rows are, for the progress messages
+        """
+        self._raise_errors()
+        self.queues[worker % self.workers].put((query, rows, kind))
+
+    def wait(self):
+        """Waits until every queued batch is committed"""
+        for batches in self.queues:
+            batches.join()
+        self._raise_errors()
+
+    def close(self):
+        """Waits for the queued batches, stops the threads and closes the driver"""
+        for batches in self.queues:
+            batches.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.driver.close()
+        elapsed = time.perf_counter() - self.start_time
+        print(f'Committed {self.rows} rows in {self.batches} batches in {elapsed:.1f}s '
+              f'({self.rows / max(elapsed, 1e-9):.0f} rows/s, {self.retries} retries)')
+        self._raise_errors()
+
+    def stats(self) -> dict:
+        """Returns the rows, batches and retries committed so far and the rows per second"""
+        elapsed = time.perf_counter() - self.start_time
+        return {'rows': self.rows, 'batches': self.batches, 'retries': self.retries,
+                'seconds': elapsed, 'rows_per_second': self.rows / max(elapsed, 1e-9)}
+
+# Splits the relationships in rounds of groups that don't share any job
+def get_relationship_rounds(df:pd.DataFrame, partitions: int):
+    """Splits the relationships in rounds of groups so that no two groups of a round share a job
+
+    Jobs are hashed into partitions and a relationship belongs to the group of the (unordered) pair of
+    partitions of its jobs. The first round has the groups within a single partition and the rest follow
+    a round-robin schedule, where each partition appears in only one group per round. Writing the groups
+    of a round concurrently never locks the same job from two transactions
+
+    Parameters
+    ----------
+    df : Dataframe
+        The dataframe with the JobId and SimilarJobId columns
+    partitions : int
+        The number of partitions, which is the number of groups written concurrently
+
+    Yields
+    ------
+    list
+        a list of dataframes, the groups of a round
+    """
+    source = pd.util.hash_array(df['JobId'].to_numpy(dtype=object)) % partitions
+    target = pd.util.hash_array(df['SimilarJobId'].to_numpy(dtype=object)) % partitions
+    groups = dict(tuple(df.groupby(np.minimum(source, target) * partitions + np.maximum(source, target), sort=False)))
+
+    # Round-robin (circle method) pairings of the partitions, with a placeholder if the number is odd
+    players = list(range(partitions)) + ([None] if partitions % 2 else [])
+    rounds = [[(partition, partition) for partition in range(partitions)]]
+    for _ in range(len(players) - 1):
+        half = len(players) // 2
+        rounds.append([(a, b) for a, b in zip(players[:half], reversed(players[half:])) if a is not None and b is not None])
+        players = [players[0]] + [players[-1]] + players[1:-1]
+
+    for pairs in rounds:
+        keys = [min(a, b) * partitions + max(a, b) for a, b in pairs]
+        round_groups = [groups[key] for key in keys if key in groups]
+        if round_groups:
+            yield round_groups
+
+# Reads the vectors stored in the jobs
+def get_stored_vectors():
+    """ Reads the normalised vectors stored in the jobs
+
+    Returns
+    -------
+
+    tuple
+        a numpy array with the job IDs and a numpy matrix array with their vectors, one row per job
+        (empty if no job has a vector, e.g. the jobs were loaded before the vectors were stored)
+    """
+    with GraphDatabase.driver(URI, auth=auth) as driver:
+        with driver.session() as session:
+            records = session.run(VECTORS_QUERY).values()
+    job_ids = np.array([record[0] for record in records], dtype=object)
+    # One column per cluster, also when no job has a vector yet
+    vectors = np.array([record[1] for record in records], dtype=np.float64).reshape(len(records), len(CLUSTERS))
+    return job_ids, vectors
+
+# Removes the relationships of some jobs
+def delete_relationships(job_ids, batch_size=5000):
+    """ Deletes every IS_SIMILAR_TO relationship of the given jobs, in batches
+
+    Parameters
+    ----------
+    job_ids : list
+        The job IDs whose relationships are deleted
+    batch_size : int, optional
+        An int representing the number of jobs in a batch
+    """
+    rows = [{'JobId': job_id} for job_id in job_ids]
+    with GraphDatabase.driver(URI, auth=auth) as driver:
+        with driver.session() as session:
+            for start in range(0, len(rows), batch_size):
+                session.execute_write(run_unwind_transaction, DELETE_RELATIONSHIPS_QUERY, rows[start:start + batch_size])
+
+# Adds the distance to the relationships that don't have it
+def add_missing_distances() -> int:
+    """ Sets the distance property of the relationships loaded without it
+
+    Returns
+    -------
+
+    int
+        The number of relationships updated
+    """
+    with GraphDatabase.driver(URI, auth=auth) as driver:
         with driver.session() as session:
-                session.write_transaction(run_batch_transaction,batch)
+            # CALL {} IN TRANSACTIONS only runs in an auto-commit transaction
+            return session.run(DISTANCE_QUERY).single()[0]
+
+# Load jobs into db
+def load_nodes_into_db_batch(df:pd.DataFrame, batch_size= 5000, workers=1, progress=None, relabel=False):
+    """ Loads the jobs of a dataframe into the database in batches
+
+    Every job is a different node, so the batches are spread over the writer threads
+
+    Parameters
+    ----------
+    df : Dataframe
+        The dataframe to be loaded, with the JobId, BelongsTo and MembershipScore columns (and optionally
+        the Vector column) and one row per job
+    batch_size : int, optional
+        An int representing the number of rows in a batch
+    workers : int, optional
+        The number of threads writing at the same time
+    progress : callable, optional
+        Called with the number of rows committed so far after every batch
+    relabel : bool, optional
+        If True, the jobs may already exist with the label of another cluster, which is removed
+    """
+    vectors = 'Vector' in df.columns
+    columns = ['JobId', 'MembershipScore'] + (['Vector'] if vectors else [])
+    batch_number = 0
+
+    with ConcurrentWriter(workers, progress=progress, name='jobs') as writer:
+        for label, group in df.groupby('BelongsTo', sort=False):
+            query = get_nodes_query(label, relabel, vectors)
+            for rows in get_batches(group, columns, batch_size):
+                writer.submit(batch_number, query, rows, kind=f'of {len(df)} jobs')
+                batch_number += 1
+
+# Load relationships into db
+def load_df_into_db_batch(df:pd.DataFrame, batch_size= 5000, workers=1, progress=None):
+    """ Loads a dataframe into the database in batches 
+
+    Each batch is sent as a parameter of a single UNWIND query. The jobs must have been loaded
+    before with load_nodes_into_db_batch. The relationships are written round by round (see
+    get_relationship_rounds), each group of a round by a different thread
+
+    Parameters
+    ----------
+    df : Dataframe
+        The dataframe to be loaded, with the JobId, SimilarJobId, SimilarityScore and Distance columns
+    batch_size : int, optional
+        An int representing the number of rows in a batch
+    workers : int, optional
+        The number of threads writing at the same time
+    progress : callable, optional
+        Called with the number of rows committed so far after every batch
+    """
+    columns = ['JobId', 'SimilarJobId', 'SimilarityScore', 'Distance']
+
+    with ConcurrentWriter(workers, progress=progress, name='relationships') as writer:
+        for round_groups in get_relationship_rounds(df, workers):
+            # Interleave the batches of the groups so every thread has work while the batches are built.
+            # All the batches of a group go to the same thread
+            pending = list(enumerate(get_batches(group, columns, batch_size) for group in round_groups))
+            while pending:
+                for worker, batches in list(pending):
+                    rows = next(batches, None)
+                    if rows is None:
+                        pending.remove((worker, batches))
+                    else:
+                        writer.submit(worker, RELATIONSHIPS_QUERY, rows, kind=f'of {len(df)} relationships')
+            writer.wait()   # next round only when no group of this one is being written
 
 # Check if database is online before running script
 def check_db_online():
@@ -95,12 +479,41 @@ def check_db_online():
     try:
         with GraphDatabase.driver(URI, auth=auth) as driver:
             with driver.session() as session:
-                session.execute_read(run_transaction, query)
+                session.run(query).consume()    # auto-commit, so it fails right away instead of retrying
         print('Database is online')
         return True
     except Exception:
         print('Database not online')
         return False
+
+# Wait for the database with exponential backoff
+def wait_for_db(initial_delay=1, max_delay=30, timeout=None) -> bool:
+    """ Checks if the database is online until it is, doubling the wait between checks
+
+    Parameters
+    ----------
+    initial_delay : float, optional
+        The seconds waited after the first failed check
+    max_delay : float, optional
+        The maximum seconds waited between two checks
+    timeout : float, optional
+        The seconds after which it gives up. None waits forever
+
+    Returns
+    -------
+
+    bool
+        True if the database is online, False if the timeout expired
+    """
+    start_time = time.monotonic()
+    delay = initial_delay
+    while not check_db_online():
+        if timeout is not None and time.monotonic() - start_time + delay > timeout:
+            return False
+        print(f'Retrying in {delay:.0f}s')
+        time.sleep(delay)
+        delay = min(delay * 2, max_delay)
+    return True
     
 
 
@@ -114,7 +527,7 @@ def check_data_in_db():
         The number of nodes that the script loads into the db
     """
     query = f'''
-        MATCH (n) RETURN count(n)
+        MATCH (n:Job) RETURN count(n)
     '''
     with GraphDatabase.driver(URI, auth=auth) as driver:
         with driver.session() as session:
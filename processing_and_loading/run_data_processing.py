@@ -1,8 +1,20 @@
+import argparse
+import os
+import threading
 import time
+import numpy as np
 import pandas as pd
-from processing_and_loading.data_processing import load_data, assign_cluster, calculate_self_similarity_matrix, get_membership_score, get_similarities_from_matrix, get_relation_pairs
-from processing_and_loading.neo4j_loader import load_df_into_db_batch, check_db_online, check_data_in_db
+from processing_and_loading.data_processing import CLUSTER_COLUMNS, read_jobs, to_shortest_doubles, similarity_to_distance, calculate_blocked_similarities, calculate_parallel_similarities, calculate_candidate_similarities, estimate_candidate_recall, calculate_cross_similarities
+from processing_and_loading.neo4j_loader import create_constraints, add_missing_distances, load_nodes_into_db_batch, load_df_into_db_batch, wait_for_db, check_data_in_db, get_stored_vectors, delete_relationships
+from processing_and_loading.csv_export import export_nodes_csv, export_relationships_csv
 from db_logic.neo4j_logic import Api
+from db_logic.cache import bump_data_version, top_nodes_cache
+from db_logic.graph_engine import GraphEngine, set_engine
+from db_logic.neighbour_index import NeighbourIndex, set_neighbour_index
+from db_logic.metrics import metrics
+from db_logic.artifacts import ARTIFACTS_DIR, fetch_input, get_artifact_key, save_artifacts, load_artifacts, get_current_artifacts, set_current_artifacts
+
+DATA_URL = 'http://dropbox.jobtome.com/data/samples/job_graph_matrix.csv'
 
 class DataProcessor:
     """
@@ -12,82 +24,449 @@ class DataProcessor:
     Methods
     -------
 
+    build_graph_data
+        Processes the data into jobs and relationships
+
+    export_csv
+        Processes the data and writes it as CSV files for neo4j-admin import
+
     process_data
         Processes and loads data to db
+
+    process_delta
+        Scores new or changed jobs against the stored ones and loads only them and their relationships
+
+    start
+        Runs process_data in a background thread
+
+    get_status
+        Returns the stage of the ingestion and its progress
+
+    get_artifacts
+        Returns the processed arrays, from the artifacts of a previous run if the input didn't change
+
+    get_jobs_frame
+        Builds the DataFrame of the jobs from their arrays
+
+    get_relationships_frame
+        Builds the DataFrame of the relationships from the row numbers of their jobs
     """
-    def __init__(self) -> None:
-        pass
+    def __init__(self, block_size=2048, workers=1, candidate_index=False, recall_sample=1000, min_recall=0.95, writers=1, build_engine=False, top_k=0) -> None:
+        """
+        Parameters
+        ----------
+        block_size : int, optional
+            The number of rows and columns of each tile of the similarity calculation. Peak memory
+            of the similarity calculation grows with its square
+        workers : int, optional
+            The number of processes used to calculate the exact similarities. None uses every CPU.
+            Ignored when candidate_index is True, unless its recall is below min_recall
+        candidate_index : bool, optional
+            If True, only the jobs sharing an LSH bucket are compared (approximate, near-linear)
+            instead of every pair of jobs
+        recall_sample : int, optional
+            The number of jobs used to estimate the recall of the candidate index against the exact calculation.
+            0 skips the check
+        min_recall : float, optional
+            If the estimated recall of the candidate index is below it, the similarities are calculated again
+            with the exact calculation
+        writers : int, optional
+            The number of threads (each with its own session) loading the data into the database
+        build_engine : bool, optional
+            If True, the in-process graph engine used by Api(use_engine=True) is built from the processed data after loading it
+        top_k : int, optional
+            The number of most similar jobs of each job kept in the neighbour index (see db_logic.neighbour_index),
+            whatever their similarity. They are found in the same pass as the similarities, which then covers every
+            tile instead of the upper triangle, so the index is only built when asked for. 0 skips the index
+        """
+        self.block_size = block_size
+        self.workers = workers
+        self.candidate_index = candidate_index
+        self.recall_sample = recall_sample
+        self.min_recall = min_recall
+        self.writers = writers
+        self.build_engine = build_engine
+        self.top_k = top_k
+        self.status = {'stage': 'idle', 'ready': False, 'error': None, 'jobs': 0, 'relationships': 0,
+                       'jobs_loaded': 0, 'relationships_loaded': 0}
+        self.start_time = None
+        self.thread = None
+
+    def _set_status(self, **status):
+        self.status = {**self.status, **status}
+        if 'stage' in status:
+            print(f"Ingestion stage: {status['stage']}")
+
+    def get_status(self) -> dict:
+        """
+        Returns the stage of the ingestion (idle, waiting_for_database, processing, loading_jobs,
+        loading_relationships, projecting, ready or failed), the jobs and relationships processed
+        and loaded so far and the seconds since it started
+
+        Returns
+        -------
+        dict
+            the status of the ingestion
+        """
+        status = dict(self.status)
+        status['seconds'] = time.monotonic() - self.start_time if self.start_time is not None else 0
+        return status
+
+    def start(self):
+        """
+        Runs process_data in a daemon thread, so the app can serve requests (and report the
+        progress) while the data is loaded
+
+        Returns
+        -------
+        Thread
+            the thread processing the data
+        """
+        def run():
+            try:
+                self.process_data()
+            except Exception as exception:
+                self._set_status(stage='failed', error=repr(exception))
+                raise
+
+        self.thread = threading.Thread(target=run, name='data-processing', daemon=True)
+        self.thread.start()
+        return self.thread
+
+    def build_graph_data(self):
+        """
+        Processes the data into the jobs and the relationships between them, reusing the artifacts of a previous
+        run when the input and the parameters haven't changed (see get_artifacts)
+
+        Returns
+        -------
+        tuple
+            a DataFrame with one row per job (JobId, BelongsTo, MembershipScore, Vector) and a DataFrame with
+            one row per relationship
+        """
+        arrays = self.get_artifacts()
+        with metrics.stage('pair_extraction'):
+            df = self.get_jobs_frame(arrays['job_ids'], arrays['clusters'], arrays['membership_scores'], arrays['vectors'])
+            processed_df = self.get_relationships_frame(df, arrays['edge_jobs'], arrays['edge_similar_jobs'], arrays['edge_scores'])
+        metrics.inc('processing_stage_rows_total', len(processed_df), stage='pair_extraction')
+        return df, processed_df
+
+    @staticmethod
+    def get_relationships_frame(df, jobs, similar_jobs, similarities):
+        """
+        Builds the DataFrame of the relationships from the row numbers of their jobs
+
+        Parameters
+        ----------
+        df : DataFrame
+            The jobs (see get_jobs_frame)
+        jobs : numpy.ndarray
+            The row number of one job of each relationship
+        similar_jobs : numpy.ndarray
+            The row number of the other job of each relationship
+        similarities : numpy.ndarray
+            The similarity of each relationship
+
+        Returns
+        -------
+        DataFrame
+            a DataFrame with one row per relationship
+        """
+        # Obtain new dataframe. The job columns are categoricals over the jobs, so each relationship only
+        # stores the row numbers of its jobs instead of a copy of their IDs
+        job_ids = pd.CategoricalDtype(df['JobId'])
+        clusters = df['BelongsTo'].cat.codes.to_numpy()
+        scores = df['MembershipScore'].to_numpy()
+        similarities = to_shortest_doubles(similarities)
+        return pd.DataFrame(
+            {
+                'JobId':pd.Categorical.from_codes(jobs, dtype=job_ids),
+                'SimilarJobId':pd.Categorical.from_codes(similar_jobs, dtype=job_ids),
+                'BelongsTo':pd.Categorical.from_codes(clusters[jobs], dtype=df['BelongsTo'].dtype),
+                'MembershipScore':scores[jobs],
+                'SimilarMembershipScore':scores[similar_jobs],
+                'SimilarBelongsTo':pd.Categorical.from_codes(clusters[similar_jobs], dtype=df['BelongsTo'].dtype),
+                'SimilarityScore':similarities,
+                'Distance':similarity_to_distance(similarities)
+            }
+        )
+
+    def get_artifacts(self):
+        """
+        Returns the jobs and relationships as arrays, memory-mapped from the artifacts directory (see
+        db_logic.artifacts) when a previous run processed the same input with the same parameters. Otherwise
+        the data is downloaded and processed, and the arrays (and the neighbour index) are written there for
+        the next runs and the serving processes
+
+        Returns
+        -------
+        dict
+            the numpy arrays, with the names in db_logic.artifacts.ARRAYS
+        """
+        parameters = {'weight_threshold': 0.99, 'candidate_index': self.candidate_index, 'min_recall': self.min_recall, 'top_k': self.top_k}
+        location, input_version = fetch_input(DATA_URL)
+        if input_version is not None:
+            artifacts = load_artifacts(get_artifact_key(input_version, parameters))
+        else:
+            # The source is unreachable, the last artifacts of the source are the best guess
+            key = get_current_artifacts()
+            artifacts = load_artifacts(key) if key else None
+            if artifacts is not None and (artifacts[1]['input']['source'] != DATA_URL or artifacts[1]['parameters'] != parameters):
+                artifacts = None
+
+        if artifacts is not None:
+            arrays, manifest = artifacts
+            print(f"Using the artifacts {manifest['key']} ({manifest['jobs']} jobs, {manifest['relationships']} relationships)")
+            set_current_artifacts(manifest['key'])
+            if self.top_k:
+                directory = os.path.join(ARTIFACTS_DIR, manifest['key'], 'neighbours')
+                set_neighbour_index(NeighbourIndex.load(directory), directory)
+            return arrays
+
+        print('Processing data...')
+        job_ids, clusters, scores, vectors = read_jobs(location)
+
+        # Calculate similarities and identify relationships tile by tile, the full matrix does not fit in memory.
+        # The most similar jobs of every job (also below the threshold, for the similar jobs endpoint) are found
+        # in the same pass
+        with metrics.stage('similarity'):
+            exact = not self.candidate_index
+            if self.candidate_index:
+                jobs, similar_jobs, similarities, *top = calculate_candidate_similarities(vectors, block_size=self.block_size, k=self.top_k)
+                if self.recall_sample:
+                    recall = estimate_candidate_recall(vectors, jobs, similar_jobs, sample_size=self.recall_sample, block_size=self.block_size)
+                    print(f'Candidate index recall on {self.recall_sample} sampled jobs: {recall:.4f}')
+                    if recall < self.min_recall:
+                        print(f'WARNING: the candidate index recall is below {self.min_recall}, calculating the exact similarities instead')
+                        exact = True
+            if exact and self.workers == 1:
+                jobs, similar_jobs, similarities, *top = calculate_blocked_similarities(vectors, block_size=self.block_size, k=self.top_k)
+            elif exact:
+                jobs, similar_jobs, similarities, *top = calculate_parallel_similarities(vectors, block_size=self.block_size, workers=self.workers, k=self.top_k)
+        metrics.inc('processing_stage_rows_total', len(similarities), stage='similarity')
+
+        write_index = None
+        if top:
+            neighbours, neighbour_scores = top
+            write_index = lambda directory: NeighbourIndex.save(os.path.join(directory, 'neighbours'), job_ids, neighbours, neighbour_scores)
+
+        arrays = {'job_ids': job_ids, 'clusters': clusters, 'membership_scores': scores, 'vectors': vectors,
+                  'edge_jobs': jobs.astype(np.int32), 'edge_similar_jobs': similar_jobs.astype(np.int32), 'edge_scores': similarities}
+        key = get_artifact_key(input_version, parameters) if input_version is not None else f'unversioned-{int(time.time())}'
+        directory = save_artifacts(key, arrays, {'input': input_version or {'source': DATA_URL}, 'parameters': parameters},
+                                   write_extra=write_index)
+        print(f'Artifacts written to {directory}')
+        if write_index:
+            set_neighbour_index(NeighbourIndex.load(os.path.join(directory, 'neighbours')), os.path.join(directory, 'neighbours'))
+        return arrays
+
+    @staticmethod
+    def get_jobs_frame(job_ids, clusters, scores, vectors):
+        """
+        Builds the DataFrame of the jobs from their arrays
+
+        Parameters
+        ----------
+        job_ids : numpy.ndarray
+            The job IDs as bytes, they must be unique
+        clusters : numpy.ndarray
+            The index of the cluster of each job
+        scores : numpy.ndarray
+            The membership score of each job
+        vectors : numpy.ndarray
+            The normalised vector of each job
+
+        Returns
+        -------
+        DataFrame
+            a DataFrame with one row per job (JobId, BelongsTo as a categorical, MembershipScore and Vector)
+        """
+        return pd.DataFrame(
+            {
+                'JobId':job_ids.astype(str).astype(object),
+                'BelongsTo':pd.Categorical.from_codes(clusters, categories=CLUSTER_COLUMNS),
+                'MembershipScore':to_shortest_doubles(scores),   # artifacts of older versions have float32 scores
+                # The normalised vectors are stored in the jobs, so new jobs can be scored against them later
+                'Vector':list(vectors)
+            }
+        )
+
+    def prepare_jobs(self, data):
+        """
+        Loads the jobs chunk by chunk and finds their cluster, membership score and normalised vector
+
+        Parameters
+        ----------
+        data : str
+            The location of the csv file, the job IDs must be unique
+
+        Returns
+        -------
+        tuple
+            a DataFrame with one row per job (see get_jobs_frame) and a float32 numpy matrix array with their
+            normalised vectors
+        """
+        job_ids, clusters, scores, vectors = read_jobs(data)
+        return self.get_jobs_frame(job_ids, clusters, scores, vectors), vectors
+
+    def export_csv(self, directory, chunk_size=100000):
+        """
+        Processes the data and writes it as CSV files for neo4j-admin database import, without using the db
+
+        The files are written from the arrays of the artifacts chunk_size rows at a time, so the DataFrames
+        of all the jobs and relationships are never built
+
+        Parameters
+        ----------
+        directory : str
+            The directory where nodes.csv and relationships.csv are written
+        chunk_size : int, optional
+            The number of jobs or relationships formatted at a time
+        """
+        arrays = self.get_artifacts()
+        job_ids = arrays['job_ids']
+        print(f'Processing done!\n Writing CSV files to {directory}:')
+        os.makedirs(directory, exist_ok=True)
+
+        def job_blocks():
+            for start in range(0, len(job_ids), chunk_size):
+                end = start + chunk_size
+                yield self.get_jobs_frame(job_ids[start:end], arrays['clusters'][start:end],
+                                          arrays['membership_scores'][start:end], arrays['vectors'][start:end])
+
+        def relationship_blocks():
+            for start in range(0, len(arrays['edge_scores']), chunk_size):
+                end = start + chunk_size
+                similarities = to_shortest_doubles(arrays['edge_scores'][start:end])
+                yield pd.DataFrame(
+                    {
+                        'JobId':job_ids[arrays['edge_jobs'][start:end]].astype(str),
+                        'SimilarJobId':job_ids[arrays['edge_similar_jobs'][start:end]].astype(str),
+                        'SimilarityScore':similarities,
+                        'Distance':similarity_to_distance(similarities)
+                    }
+                )
+
+        export_nodes_csv(job_blocks(), os.path.join(directory, 'nodes.csv'))
+        export_relationships_csv(relationship_blocks(), os.path.join(directory, 'relationships.csv'))
+        print('CSV files written!')
 
     def process_data(self):
         """
         Processes and loads data to db
         """
-        # Check db is online before proceeding. I couldn't find a way to prevent queries from retrying, so the retry here seems to not make sense 
-        # It makes sense for the first time this is run
-        db_online = False
+        self.start_time = time.monotonic()
+        self._set_status(stage='waiting_for_database', ready=False, error=None)
+
+        # Check db is online before proceeding, waiting longer after each failed check while it starts
         print('Checking if database is online...')
-        time.sleep(30)
-        while db_online == False:
-            db_online = check_db_online()
+        wait_for_db()
 
-            # Wait 10s if not online and retry
-            if db_online == False:
-                print('Retrying in 10s')
-                time.sleep(10)
+        create_constraints()
 
         # Check databased has data from script (THIS IS NOT FOR PRODUCTION, JUST FOR INTERVIEW)
         data_in_db = check_data_in_db()
         # No records on the db
         if data_in_db == 0:          
 
-            print('Processing data...')
-            url = 'http://dropbox.jobtome.com/data/samples/job_graph_matrix.csv'
-
-            # load data and define numerical columns
-            df = load_data(url)
-            cluster_cols = [f'c{col_num}' for col_num in range(22)]
-
-            # identify the cluster the job belongs to and create the membershipscore column
-            df['BelongsTo'] = assign_cluster(df[cluster_cols])
-            df["MembershipScore"] = get_membership_score(df[cluster_cols])
-
-            # Calculate similarities
-            similarity_matrix = calculate_self_similarity_matrix(df[cluster_cols])
-            similarities = get_similarities_from_matrix(similarity_matrix)
-
-            # Identify relationships
-            relation_pairs = get_relation_pairs(similarity_matrix)
-            jobs = relation_pairs[:,0]
-            similar_jobs = relation_pairs[:,1]
-            df_jobs = df.iloc[jobs]
-            df_similar_jobs = df.iloc[similar_jobs]
-
-            # Obtain new dataframe
-            processed_df = pd.DataFrame(
-                {
-                    'JobId':df_jobs['JobId'].values,
-                    'SimilarJobId':df_similar_jobs['JobId'].values,
-                    'BelongsTo':df_jobs['BelongsTo'].values,
-                    'MembershipScore':df_jobs['MembershipScore'].values,
-                    'SimilarMembershipScore':df_similar_jobs['MembershipScore'].values,
-                    'SimilarBelongsTo':df_similar_jobs['BelongsTo'].values,
-                    'SimilarityScore':similarities
-                }
-            )
-            # Save dataframe to csv and load into neo4j
-            #processed_df.to_csv('processed.csv',header=True,index=None)
+            self._set_status(stage='processing')
+            nodes_df, processed_df = self.build_graph_data()
+            self._set_status(jobs=len(nodes_df), relationships=len(processed_df))
             print(f'Processing done!\n Loading data into database:')
 
-            # Load dataframe into db in batches (default 5000)
-            load_df_into_db_batch(processed_df)
+            # Load the jobs first and then the relationships between them into db in batches (default 5000)
+            self._set_status(stage='loading_jobs')
+            load_nodes_into_db_batch(nodes_df, workers=self.writers, progress=lambda rows: self._set_status(jobs_loaded=rows))
+            self._set_status(stage='loading_relationships')
+            load_df_into_db_batch(processed_df, workers=self.writers, progress=lambda rows: self._set_status(relationships_loaded=rows))
             print('Data loaded!')
-            del processed_df    # Free up space
+
+            # The data changed, so the caches are stale. The top nodes can be filled without querying the db
+            top_nodes_cache.fill_from_frame(nodes_df, bump_data_version())
+            if self.build_engine:
+                set_engine(GraphEngine.from_frames(nodes_df, processed_df))
+            del nodes_df, processed_df    # Free up space
             
 
         else:
             print('Data from this script already in db!')
-        Api().project_graph()
+
+        # Relationships loaded before distances existed need them, and the projected graph must be replaced to include them
+        self._set_status(stage='projecting')
+        distances_added = add_missing_distances()
+        Api().project_graph(refresh=distances_added > 0)
+        self._set_status(stage='ready', ready=True)
+
+    def process_delta(self, data):
+        """
+        Loads a csv file of new or changed jobs (same columns as the full data) into a database that already
+        has the data. Only these jobs are scored, against each other and against the vectors stored in the
+        database, so the work grows with the size of the change. The relationships of changed jobs are
+        replaced and the projected graph is refreshed. The neighbour index and the artifacts are not updated
+
+        Parameters
+        ----------
+        data : str
+            The location of the csv file with the new or changed jobs
+        """
+        wait_for_db()
+        create_constraints()
+
+        print('Processing new or changed jobs...')
+        df, vectors = self.prepare_jobs(data)
+        stored_ids, stored_vectors = get_stored_vectors()
+        changed = np.isin(df['JobId'].to_numpy(dtype=object), stored_ids)
+        print(f'{len(df)} jobs: {changed.sum()} changed, {len(df) - changed.sum()} new ({len(stored_ids)} stored jobs with vectors)')
+
+        # Changed jobs are scored with their new vector, so their stored one is left out
+        others = ~np.isin(stored_ids, df['JobId'].to_numpy(dtype=object))
+        stored_ids, stored_vectors = stored_ids[others], stored_vectors[others]
+        jobs, similar_jobs, similarities = calculate_blocked_similarities(vectors, block_size=self.block_size)
+        cross_jobs, cross_similar_jobs, cross_similarities = calculate_cross_similarities(vectors, stored_vectors, block_size=self.block_size)
+
+        job_ids = df['JobId'].to_numpy(dtype=object)
+        similarities = to_shortest_doubles(np.concatenate([similarities, cross_similarities]))
+        processed_df = pd.DataFrame(
+            {
+                'JobId':np.concatenate([job_ids[jobs], job_ids[cross_jobs]]),
+                'SimilarJobId':np.concatenate([job_ids[similar_jobs], stored_ids[cross_similar_jobs]]),
+                'SimilarityScore':similarities,
+                'Distance':similarity_to_distance(similarities)
+            }
+        )
+        print(f'Processing done!\n Loading {len(processed_df)} relationships into database:')
+
+        # The old relationships of the changed jobs are stale, and they may have changed cluster
+        delete_relationships(job_ids[changed].tolist())
+        load_nodes_into_db_batch(df[['JobId', 'BelongsTo', 'MembershipScore', 'Vector']], workers=self.writers, relabel=True)
+        load_df_into_db_batch(processed_df, workers=self.writers)
+        print('Data loaded!')
+
+        # The caches of every serving process are stale once the graph is projected again
+        Api().project_graph(refresh=True)
+        bump_data_version()
+        if self.top_k:
+            print('The similar jobs index is not updated by a delta, process the full data again to rebuild it')
 
 
 if __name__ == '__main__':
-    DataProcessor().process_data()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='Processes the job data and loads it into the database')
+    parser.add_argument('--export-csv', metavar='DIRECTORY',
+                        help='write the jobs and relationships as CSV files for neo4j-admin database import instead of loading them')
+    parser.add_argument('--block-size', type=int, default=2048, help='rows and columns of each tile of the similarity calculation')
+    parser.add_argument('--workers', type=int, default=1, help='processes used to calculate the similarities')
+    parser.add_argument('--candidate-index', action='store_true', help='only compare jobs sharing an LSH bucket (approximate)')
+    parser.add_argument('--min-recall', type=float, default=0.95,
+                        help='estimated recall of the candidate index below which the exact similarities are calculated instead')
+    parser.add_argument('--writers', type=int, default=1, help='threads loading the data into the database')
+    parser.add_argument('--top-k', type=int, default=0, help='most similar jobs of each job kept in the neighbour index for the similar jobs endpoint (0, the default, skips it)')
+    parser.add_argument('--delta', metavar='CSV', help='only load the new or changed jobs of a csv file into the loaded data')
+    args = parser.parse_args()
+
+    processor = DataProcessor(block_size=args.block_size, workers=args.workers, candidate_index=args.candidate_index, min_recall=args.min_recall, writers=args.writers, top_k=args.top_k)
+    if args.export_csv:
+        processor.export_csv(args.export_csv)
+    elif args.delta:
+        processor.process_delta(args.delta)
+    else:
+        processor.process_data()
\ No newline at end of file
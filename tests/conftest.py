@@ -0,0 +1,10 @@
+import time
+import pytest
+from db_logic import cache
+
+# The tests run without a database: the data version is never read again, so it stays 0
+@pytest.fixture(autouse=True)
+def no_database(monkeypatch):
+    monkeypatch.setattr(cache, 'DATA_VERSION_CHECK_INTERVAL', float('inf'))
+    monkeypatch.setattr(cache, '_checked_at', time.monotonic())
+    monkeypatch.setattr(cache, '_data_version', 0)
@@ -0,0 +1,24 @@
+from db_logic import cache
+from db_logic.cache import PathCache, TopNodesCache, get_data_version
+
+PATH = [[{'JobId': 'a', 'membershipScore': 0.5}, {'JobId': 'b', 'membershipScore': 0.6}]]
+
+
+def test_paths_found_before_a_load_are_not_cached(monkeypatch):
+    path_cache = PathCache()
+    version = get_data_version()
+    monkeypatch.setattr(cache, '_data_version', version + 1)     # a load bumps the version while the path is found
+    path_cache.set('weight', 'a', 'b', PATH, version)
+    assert path_cache.get('weight', 'a', 'b') is None
+    path_cache.set('weight', 'a', 'b', PATH, get_data_version())
+    assert path_cache.get('weight', 'b', 'a') == [list(reversed(PATH[0]))]
+
+def test_top_nodes_read_before_a_load_are_stale(monkeypatch):
+    top_nodes_cache = TopNodesCache()
+    version = get_data_version()
+    monkeypatch.setattr(cache, '_data_version', version + 1)
+    top_nodes_cache.fill(['a', 'b'], ['c0', 'c0'], [0.5, 0.6], version)
+    assert not top_nodes_cache.is_fresh()
+    top_nodes_cache.fill(['a', 'b'], ['c0', 'c0'], [0.5, 0.6])
+    assert top_nodes_cache.is_fresh()
+    assert [job['JobId'] for job in top_nodes_cache.get(2, 'c0')] == ['b', 'a']
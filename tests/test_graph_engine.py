@@ -0,0 +1,141 @@
+import heapq
+from collections import deque
+import numpy as np
+import pytest
+from db_logic.graph_engine import GraphEngine
+
+NUM_NODES = 200
+
+
+@pytest.fixture(scope='module')
+def graph():
+    """A random sparse graph with a few components, as the engine and as an adjacency dictionary"""
+    rng = np.random.default_rng(0)
+    sources = rng.integers(0, NUM_NODES, 400)
+    targets = rng.integers(0, NUM_NODES, 400)
+    keep = sources != targets
+    sources, targets = sources[keep], targets[keep]
+    costs = rng.uniform(0.001, 0.02, len(sources))
+    job_ids = [f'job{node:03d}' for node in range(NUM_NODES)]
+    engine = GraphEngine(job_ids, rng.uniform(0, 1, NUM_NODES), sources, targets, costs)
+    adjacency = {job_id: {} for job_id in job_ids}
+    for source, target, cost in zip(sources.tolist(), targets.tolist(), costs.tolist()):
+        a, b = job_ids[source], job_ids[target]
+        cost = min(cost, adjacency[a].get(b, float('inf')))   # parallel edges: the cheapest one counts
+        adjacency[a][b] = adjacency[b][a] = cost
+    return engine, adjacency
+
+# Textbook Dijkstra, the distances from a job to every job it reaches
+def dijkstra(adjacency, source):
+    distances = {source: 0.0}
+    heap = [(0.0, source)]
+    while heap:
+        distance, node = heapq.heappop(heap)
+        if distance > distances[node]:
+            continue
+        for neighbour, cost in adjacency[node].items():
+            if distance + cost < distances.get(neighbour, float('inf')):
+                distances[neighbour] = distance + cost
+                heapq.heappush(heap, (distance + cost, neighbour))
+    return distances
+
+# Textbook breadth first search, the number of edges from a job to every job it reaches
+def bfs(adjacency, source):
+    hops = {source: 0}
+    queue = deque([source])
+    while queue:
+        node = queue.popleft()
+        for neighbour in adjacency[node]:
+            if neighbour not in hops:
+                hops[neighbour] = hops[node] + 1
+                queue.append(neighbour)
+    return hops
+
+def path_cost(adjacency, path):
+    job_ids = [node['JobId'] for node in path]
+    return sum(adjacency[a][b] for a, b in zip(job_ids, job_ids[1:]))
+
+def pairs_to_check():
+    rng = np.random.default_rng(1)
+    return [(f'job{a:03d}', f'job{b:03d}') for a, b in rng.integers(0, NUM_NODES, (100, 2)).tolist()]
+
+
+def test_shortest_path_by_weight(graph):
+    engine, adjacency = graph
+    for jobId1, jobId2 in pairs_to_check():
+        distances = dijkstra(adjacency, jobId1)
+        paths = engine.shortest_path_by_weight(jobId1, jobId2)
+        if jobId2 not in distances:
+            assert paths == []
+            continue
+        path = paths[0]
+        assert (path[0]['JobId'], path[-1]['JobId']) == (jobId1, jobId2)
+        assert path_cost(adjacency, path) == pytest.approx(distances[jobId2])
+
+def test_shortest_path_by_num_nodes(graph):
+    engine, adjacency = graph
+    for jobId1, jobId2 in pairs_to_check():
+        hops = bfs(adjacency, jobId1)
+        paths = engine.shortest_path_by_num_nodes(jobId1, jobId2)
+        if jobId2 not in hops:
+            assert paths == []
+            continue
+        path = paths[0]
+        assert (path[0]['JobId'], path[-1]['JobId']) == (jobId1, jobId2)
+        assert len(path) == hops[jobId2] + 1
+        path_cost(adjacency, path)     # every step is an edge
+
+def test_shortest_paths_from(graph):
+    engine, adjacency = graph
+    targets = [f'job{node:03d}' for node in range(0, NUM_NODES, 7)] + ['unknown']
+    distances = dijkstra(adjacency, 'job005')
+    paths = engine.shortest_paths_from('job005', targets)
+    for target in targets:
+        if target not in distances:
+            assert paths[target] == []
+        else:
+            assert path_cost(adjacency, paths[target][0]) == pytest.approx(distances[target])
+
+def test_reachable_from(graph):
+    engine, adjacency = graph
+    distances = dijkstra(adjacency, 'job010')
+    max_cost = sorted(distances.values())[len(distances) // 2]
+    jobs = engine.reachable_from('job010', max_cost=max_cost)
+    expected = {job_id: distance for job_id, distance in distances.items() if 0 < distance <= max_cost and job_id != 'job010'}
+    assert {job['JobId'] for job in jobs} == expected.keys()
+    assert all(job['cost'] == pytest.approx(expected[job['JobId']]) for job in jobs)
+
+    hops = bfs(adjacency, 'job010')
+    jobs = engine.reachable_from('job010', by_weight=False, max_hops=2)
+    assert {job['JobId']: job['hops'] for job in jobs} == {job_id: hop for job_id, hop in hops.items() if 0 < hop <= 2}
+
+# The single source query of the database: the cheapest path of every job (allShortestPaths.dijkstra), then
+# WHERE totalCost <= $maxCost AND size(nodeIds) - 1 <= $maxHops on that path
+def single_source_query(adjacency, source, max_hops=None, max_cost=None):
+    distances, hops = {source: 0.0}, {source: 0}
+    heap = [(0.0, source)]
+    while heap:
+        distance, node = heapq.heappop(heap)
+        if distance > distances[node]:
+            continue
+        for neighbour, cost in adjacency[node].items():
+            if distance + cost < distances.get(neighbour, float('inf')):
+                distances[neighbour], hops[neighbour] = distance + cost, hops[node] + 1
+                heapq.heappush(heap, (distance + cost, neighbour))
+    return {job_id: (distance, hops[job_id]) for job_id, distance in distances.items()
+            if job_id != source and (max_cost is None or distance <= max_cost) and (max_hops is None or hops[job_id] <= max_hops)}
+
+def test_reachable_from_max_hops_by_weight_matches_the_database(graph):
+    engine, adjacency = graph
+    for source in ('job000', 'job010', 'job123'):
+        for max_hops, max_cost in ((1, None), (2, None), (3, 0.03), (0, None)):
+            jobs = engine.reachable_from(source, max_hops=max_hops, max_cost=max_cost)
+            expected = single_source_query(adjacency, source, max_hops, max_cost)
+            assert {job['JobId'] for job in jobs} == expected.keys()
+            assert all(job['cost'] == pytest.approx(expected[job['JobId']][0]) and job['hops'] == expected[job['JobId']][1] for job in jobs)
+
+def test_expensive_short_path_is_not_reported():
+    """a-b-c-d is the cheapest path to d (3 hops), so with max_hops=1 d is left out instead of reached by the a-d edge"""
+    engine = GraphEngine(['a', 'b', 'c', 'd'], [1, 1, 1, 1], np.array([0, 1, 2, 0]), np.array([1, 2, 3, 3]), np.array([0.1, 0.1, 0.1, 1.0]))
+    assert [job['JobId'] for job in engine.reachable_from('a', max_hops=1)] == ['b']
+    assert [job['JobId'] for job in engine.reachable_from('a', by_weight=False, max_hops=1)] == ['b', 'd']
@@ -0,0 +1,70 @@
+import numpy as np
+import pandas as pd
+import pytest
+from processing_and_loading import neo4j_loader
+from processing_and_loading.data_processing import CLUSTER_COLUMNS, calculate_cross_similarities
+from processing_and_loading.neo4j_loader import JOB_LABEL_QUERY, create_constraints, get_relationship_rounds, get_stored_vectors
+
+
+class FakeDriver:
+    """Answers every query with the same records, and keeps the queries run"""
+
+    def __init__(self, records) -> None:
+        self.records = records
+        self.queries = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        return False
+
+    def session(self):
+        return self
+
+    def run(self, query, **parameters):
+        self.queries.append(query)
+        return self
+
+    def values(self):
+        return self.records
+
+    def single(self):
+        return self.records[0]
+
+    def consume(self):
+        return None
+
+
+def test_relationship_rounds_are_disjoint():
+    rng = np.random.default_rng(0)
+    df = pd.DataFrame({'JobId': rng.integers(0, 500, 3000).astype(str), 'SimilarJobId': rng.integers(0, 500, 3000).astype(str)})
+    for partitions in (1, 4, 5):
+        written = []
+        for round_groups in get_relationship_rounds(df, partitions):
+            jobs = [set(group['JobId']) | set(group['SimilarJobId']) for group in round_groups]
+            assert sum(len(group_jobs) for group_jobs in jobs) == len(set().union(*jobs))
+            written += [group.index for group in round_groups]
+        assert sorted(np.concatenate(written).tolist()) == list(range(len(df)))
+
+def test_no_stored_vectors(monkeypatch):
+    """A database without vectors (empty, loaded before they were stored or imported from CSV) leaves the new jobs unscored"""
+    monkeypatch.setattr(neo4j_loader.GraphDatabase, 'driver', lambda *args, **kwargs: FakeDriver([]))
+    job_ids, vectors = get_stored_vectors()
+    assert job_ids.shape == (0,) and vectors.shape == (0, len(CLUSTER_COLUMNS))
+    rows, cols, scores = calculate_cross_similarities(np.eye(2, len(CLUSTER_COLUMNS)), vectors)
+    assert len(rows) == len(cols) == len(scores) == 0
+
+def test_stored_vectors(monkeypatch):
+    records = [['a', [1.0] + [0.0] * (len(CLUSTER_COLUMNS) - 1)], ['b', [0.0, 1.0] + [0.0] * (len(CLUSTER_COLUMNS) - 2)]]
+    monkeypatch.setattr(neo4j_loader.GraphDatabase, 'driver', lambda *args, **kwargs: FakeDriver(records))
+    job_ids, vectors = get_stored_vectors()
+    assert job_ids.tolist() == ['a', 'b'] and vectors.shape == (2, len(CLUSTER_COLUMNS))
+
+@pytest.mark.parametrize('unlabelled', [True, False])
+def test_job_label_migration_runs_while_jobs_lack_the_label(monkeypatch, unlabelled):
+    """Also when some jobs already have the label, e.g. after a migration interrupted between its batches"""
+    driver = FakeDriver([{'unlabelled': unlabelled}])
+    monkeypatch.setattr(neo4j_loader.GraphDatabase, 'driver', lambda *args, **kwargs: driver)
+    create_constraints()
+    assert (JOB_LABEL_QUERY in driver.queries) == unlabelled
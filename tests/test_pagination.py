@@ -0,0 +1,35 @@
+import numpy as np
+import pandas as pd
+import pytest
+from db_logic.cache import TopNodesCache
+from db_logic.neo4j_logic import TOP_NODES_ORDER, encode_cursor, decode_cursor, get_next_cursor
+
+
+def test_cursor_round_trip():
+    for values in ([0.65, 'abc'], [1, 'job'], [0.6499999761581421, '']):
+        assert decode_cursor(encode_cursor(values)) == values
+
+@pytest.mark.parametrize('cursor', ['not base64!', encode_cursor(['0.5', 'job']), encode_cursor([0.5]), encode_cursor({'a': 1})])
+def test_invalid_cursor(cursor):
+    with pytest.raises(ValueError):
+        decode_cursor(cursor)
+
+def test_top_nodes_pages():
+    """Following the cursors gives every job of the cluster once, in order, including ties on the page boundaries"""
+    rng = np.random.default_rng(0)
+    job_ids = np.array([f'job{number:03d}' for number in rng.permutation(300)])
+    scores = rng.choice([0.5, 0.65, 0.7, 0.9], 300)     # many ties
+    clusters = rng.choice(['c0', 'c1'], 300)
+    top_nodes_cache = TopNodesCache()
+    top_nodes_cache.fill(job_ids, clusters, scores)
+
+    expected = pd.DataFrame({'JobId': job_ids, 'membershipScore': scores})[clusters == 'c0']
+    expected = expected.sort_values(['membershipScore', 'JobId'], ascending=[False, True]).to_dict('records')
+    jobs, cursor = [], None
+    while True:
+        page = top_nodes_cache.get(7, 'c0', decode_cursor(cursor) if cursor else None)
+        jobs += page
+        cursor = get_next_cursor(page[-1] if page else None, len(page), 7, TOP_NODES_ORDER)
+        if cursor is None:
+            break
+    assert jobs == expected
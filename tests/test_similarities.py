@@ -0,0 +1,86 @@
+import numpy as np
+import pytest
+from sklearn.metrics.pairwise import cosine_similarity
+from benchmarks.synthetic import generate_jobs
+from processing_and_loading.data_processing import CLUSTER_COLUMNS, normalise_vectors, calculate_blocked_similarities, calculate_parallel_similarities, calculate_candidate_similarities, calculate_top_neighbours
+
+THRESHOLD = 0.99
+K = 5
+
+
+@pytest.fixture(scope='module')
+def vectors():
+    df = generate_jobs(1200, duplicate_fraction=0.1, seed=1)
+    return normalise_vectors(df[CLUSTER_COLUMNS].to_numpy(dtype=np.float32))
+
+@pytest.fixture(scope='module')
+def dense(vectors):
+    """The full similarity matrix, with the similarity of each job with itself left out"""
+    similarities = cosine_similarity(vectors)
+    np.fill_diagonal(similarities, -np.inf)
+    return similarities
+
+# Pairs of the upper triangle above the threshold, as a dictionary from (row, column) to similarity
+def get_dense_pairs(dense):
+    rows, cols = np.nonzero(np.triu(dense >= THRESHOLD, 1))
+    return dict(zip(zip(rows.tolist(), cols.tolist()), dense[rows, cols].tolist()))
+
+def to_pairs(rows, cols, scores):
+    return dict(zip(zip(rows.tolist(), cols.tolist()), scores.tolist()))
+
+def assert_same_pairs(pairs, expected):
+    assert pairs.keys() == expected.keys()
+    assert np.allclose([pairs[pair] for pair in expected], list(expected.values()), atol=1e-5)
+
+
+# The dense top k, ties by row index like calculate_top_neighbours
+def get_dense_top(dense, k):
+    order = np.lexsort((np.broadcast_to(np.arange(len(dense)), dense.shape), -dense), axis=1)[:, :k]
+    return order, np.take_along_axis(dense, order, axis=1)
+
+def test_blocked_matches_dense(vectors, dense):
+    expected = get_dense_pairs(dense)
+    assert expected
+    for block_size in (100, 256, 5000):
+        assert_same_pairs(to_pairs(*calculate_blocked_similarities(vectors, THRESHOLD, block_size)), expected)
+
+def test_parallel_matches_dense(vectors, dense):
+    pairs = to_pairs(*calculate_parallel_similarities(vectors, THRESHOLD, block_size=256, workers=2))
+    assert_same_pairs(pairs, get_dense_pairs(dense))
+
+def test_candidates_are_exact_pairs(vectors, dense):
+    """The candidate pairs are a subset of the exact pairs, with their exact scores, and few are missed"""
+    expected = get_dense_pairs(dense)
+    pairs = to_pairs(*calculate_candidate_similarities(vectors, THRESHOLD, 256))
+    assert pairs.keys() <= expected.keys()
+    assert np.allclose([pairs[pair] for pair in pairs], [expected[pair] for pair in pairs], atol=1e-5)
+    assert len(pairs) >= 0.9 * len(expected)
+
+def test_top_neighbours_match_dense(vectors, dense):
+    _, expected_scores = get_dense_top(dense, K)
+    neighbours, scores = calculate_top_neighbours(vectors, K, block_size=256)
+    assert np.allclose(scores, expected_scores, atol=1e-5)
+    # Rows whose neighbours are near ties may be ordered differently, so only the scores of the neighbours are compared
+    assert np.allclose(dense[np.arange(len(dense))[:, None], neighbours], expected_scores, atol=1e-5)
+
+def test_fused_top_neighbours_match_separate_pass(vectors):
+    neighbours, scores = calculate_top_neighbours(vectors, K, block_size=256)
+    blocked = calculate_blocked_similarities(vectors, THRESHOLD, 256, k=K)
+    parallel = calculate_parallel_similarities(vectors, THRESHOLD, 256, workers=2, k=K)
+    for result in (blocked, parallel):
+        assert np.array_equal(result[3], neighbours)
+        assert np.array_equal(result[4], scores)
+    assert_same_pairs(to_pairs(*blocked[:3]), to_pairs(*calculate_blocked_similarities(vectors, THRESHOLD, 256)))
+
+def test_candidate_neighbours(vectors, dense):
+    """Neighbours found in the buckets have their exact score, are never repeated and are padded at the end"""
+    *_, neighbours, neighbour_scores = calculate_candidate_similarities(vectors, THRESHOLD, 256, k=K)
+    found = neighbours >= 0
+    assert np.allclose(neighbour_scores[found], dense[np.nonzero(found)[0], neighbours[found]], atol=1e-5)
+    assert all(len(set(row[row >= 0].tolist())) == np.count_nonzero(row >= 0) for row in neighbours)
+    assert np.all(np.diff(found.astype(int), axis=1) <= 0)
+
+def test_k_is_clamped_to_the_number_of_rows(vectors):
+    neighbours, scores = calculate_top_neighbours(vectors[:3], K)
+    assert neighbours.shape == scores.shape == (3, 2)
+    assert calculate_top_neighbours(vectors[:1], K)[0].shape == (1, 0)